@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+
+"""Benchmark memory use of collecting ntuple info in datasetInfo.py.
+
+Compares the old method (a dict per ntuple in a list, converted to a DataFrame
+with categoricals at the end) with NtupleAccumulator (chunks of typed arrays,
+written to CSV as they fill), for --nNtuples synthetic ntuples.
+Reports time taken & peak memory usage (from tracemalloc, python 3 only).
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from datasetInfo import NtupleAccumulator, DEFAULT_CHUNK_SIZE
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def iter_ntuples(n_ntuples):
+    """Yield synthetic (xmldir, ntuple, size, user, year), with realistic numbers of distinct values"""
+    for i in range(n_ntuples):
+        year = ["2016v3", "2017v2", "2018"][i % 3]
+        user = "user%d" % (i % 50)
+        xmldir = "RunII_102X_v2/%s/MC_%d" % (year, (i // 1000) % 500)
+        ntuple = ("/pnfs/desy.de/cms/tier2/store/user/%s/RunII_102X_v2/MC_%d/crab_%d/190101_123456/%04d/Ntuple_%d.root"
+                  % (user, (i // 1000) % 500, i // 1000, (i // 1000) % 10, i))
+        yield xmldir, ntuple, 100. + (i % 1000) / 10., user, year
+
+
+def old_method(n_ntuples, csv_filename, chunk_size):
+    data = []
+    for xmldir, ntuple, size, user, year in iter_ntuples(n_ntuples):
+        data.append({
+            "xmldir": xmldir,
+            "ntuple": ntuple,
+            "size": size,
+            "user": user,
+            "year": year,
+        })
+    df = pd.DataFrame(data)
+    df['user'] = df['user'].astype('category')
+    df['xmldir'] = df['xmldir'].astype('category')
+    df['year'] = df['year'].astype('category')
+    df.to_csv(csv_filename)
+
+
+def accumulator_method(n_ntuples, csv_filename, chunk_size):
+    with open(csv_filename, "w") as f:
+        def _write_csv(chunk):
+            chunk.to_csv(f, header=(f.tell() == 0))
+        accumulator = NtupleAccumulator(chunk_size=chunk_size, sinks=[_write_csv])
+        for xmldir, ntuple, size, user, year in iter_ntuples(n_ntuples):
+            accumulator.add(xmldir=xmldir, ntuple=ntuple, size=size, user=user, year=year)
+        accumulator.flush()
+
+
+def run(name, func, n_ntuples, csv_filename, chunk_size):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    func(n_ntuples, csv_filename, chunk_size)
+    duration = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("%-12s: %6.2f s, peak memory %s" % (name, duration,
+                                              "%.1f MB" % (peak / 1024. / 1024.) if peak is not None else "n/a"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nNtuples", type=int, default=1000000, help="Number of ntuples")
+    parser.add_argument("--chunkSize", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Chunk size for NtupleAccumulator")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print("Collecting info for", args.nNtuples, "ntuples")
+        run("dict list", old_method, args.nNtuples, os.path.join(tmp_dir, "old.csv"), args.chunkSize)
+        run("accumulator", accumulator_method, args.nNtuples, os.path.join(tmp_dir, "new.csv"), args.chunkSize)
+    finally:
+        shutil.rmtree(tmp_dir)
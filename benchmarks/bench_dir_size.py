@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+
+"""Benchmark directory sizing: old os.walk + lstat method vs fs_utils scandir-based methods.
+
+Makes a synthetic CRAB-like output directory with --nFiles empty ntuple files:
+
+    <tmp>/crab_X/190101_123456/0000/Ntuple_1.root ... Ntuple_999.root
+                              /0001/Ntuple_1000.root ...
+                              /0000/log/cmsRun_1.log.tar.gz ...
+
+then times how long each method takes to get its total size.
+Note that on a local disk, metadata is cached after the first pass so this
+mostly measures overhead; on dCache/NFS, where each call has a network
+round-trip, the threaded version gains much more.
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fs_utils import summarise_tree, DirSizer
+
+
+def make_tree(top_dir, n_files, files_per_dir=1000, log_every=10):
+    """Make CRAB-like directory with `n_files` ntuples, plus some log files"""
+    task_dir = os.path.join(top_dir, "crab_X", "190101_123456")
+    for i in range(n_files):
+        subdir = os.path.join(task_dir, "%04d" % (i // files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(os.path.join(subdir, "log"))
+        open(os.path.join(subdir, "Ntuple_%d.root" % i), "w").close()
+        if i % log_every == 0:
+            open(os.path.join(subdir, "log", "cmsRun_%d.log.tar.gz" % i), "w").close()
+    return task_dir
+
+
+def walk_lstat_size(path):
+    """Old method from XMLNtupleDirDataGenerator.get_size"""
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            try:
+                stat = os.lstat(fp)
+            except OSError:
+                continue
+            total_size += stat.st_size
+    return total_size
+
+
+def scandir_size(path):
+    return summarise_tree(path).size
+
+
+def threaded_size(path, jobs):
+    with DirSizer(jobs=jobs) as sizer:
+        return sizer.summarise(path).size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nFiles", type=int, default=1000000,
+                        help="Number of ntuple files in synthetic tree")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[4, 16],
+                        help="Numbers of threads to try for DirSizer")
+    parser.add_argument("--nRepeats", type=int, default=3,
+                        help="Number of times to run each method, fastest is reported")
+    parser.add_argument("--tmpDir", default=None,
+                        help="Where to make the synthetic tree, e.g. on the filesystem you want to test")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmpDir)
+    try:
+        print("Making tree with", args.nFiles, "files in", tmp_dir)
+        start = time.time()
+        task_dir = make_tree(tmp_dir, args.nFiles)
+        print("Took %.1f s" % (time.time() - start))
+
+        methods = [
+            ("os.walk+lstat", walk_lstat_size),
+            ("scandir", scandir_size),
+        ]
+        for jobs in args.jobs:
+            methods.append(("DirSizer(%d)" % jobs, lambda path, jobs=jobs: threaded_size(path, jobs)))
+
+        n_total = sum(len(files) for _, _, files in os.walk(task_dir))
+        print("%-16s %10s %12s" % ("method", "time [s]", "files/s"))
+        for name, func in methods:
+            durations = []
+            for _ in range(args.nRepeats):
+                start = time.time()
+                func(task_dir)
+                durations.append(time.time() - start)
+            duration = min(durations)
+            print("%-16s %10.3f %12.0f" % (name, duration, n_total / duration))
+    finally:
+        shutil.rmtree(tmp_dir)
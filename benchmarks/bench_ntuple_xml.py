@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+
+"""Benchmark ntuple_xml against the old regex & ElementTree XML parsers.
+
+Writes a synthetic XML with --nEntries entries (some EMPTY/BAD, some inside
+multi-line comments), then times how long each method takes to list the
+active ntuples, along with peak memory usage (from tracemalloc, python 3 only).
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from CommentedTreeBuilder import CommentedTreeBuilder
+from ntuple_xml import get_ntuple_filenames, iter_ntuple_records
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def make_xml(filename, n_entries):
+    """Write synthetic XML file with `n_entries` ntuples"""
+    with open(filename, "w") as f:
+        for i in range(n_entries):
+            line = '<In FileName="/pnfs/desy.de/cms/tier2/store/user/someone/RunII_102X_v2/MC_TTbar/crab_TTbar/190101_123456/%04d/Ntuple_%d.root" Lumi="0.0"/>' % (i // 1000, i)
+            if i % 97 == 0:
+                f.write("<!--EMPTY %s -->\n" % line)
+            elif i % 101 == 0:
+                f.write("<!-- BAD %s -->\n" % line)
+            elif i % 1009 == 0:
+                f.write("<!--\n%s\n-->\n" % line)
+            else:
+                f.write(line + "\n")
+        f.write('<!-- < NumberEntries="%d" Method=weights /> -->\n' % n_entries)
+
+
+def regex_filenames(xml_filename):
+    """Old line-by-line regex method, as used in datasetInfo etc"""
+    with open(xml_filename) as f:
+        is_comment = False
+        fname_pattern = r'< ?In FileName="(.+)" Lumi="0\.0" ?\/>'
+        for line in f:
+            line = line.strip()
+            if line.startswith("<!--"):
+                is_comment = True
+            if line.endswith("-->"):
+                is_comment = False
+                continue
+            if is_comment:
+                continue
+
+            match = re.search(fname_pattern, line.strip())
+            if match is not None:
+                yield match.group(1)
+
+
+def elementtree_filenames(xml_filename):
+    """Old ElementTree method, as used in xmlToTxt etc"""
+    with open(xml_filename) as f:
+        xml_str = "<data>%s</data>" % f.read()
+    parser = ET.XMLParser(target=CommentedTreeBuilder())
+    root = ET.fromstring(xml_str, parser)
+    for child in root:
+        if child.tag == "In":
+            yield child.attrib['FileName']
+
+
+def time_method(func, xml_filename):
+    start = time.time()
+    n = sum(1 for _ in func(xml_filename))
+    return n, time.time() - start
+
+
+def peak_memory(func, xml_filename):
+    """Peak memory in bytes. Done separately from timing, since tracemalloc
+    slows down allocation-heavy code a lot."""
+    if not tracemalloc:
+        return -1
+    tracemalloc.start()
+    sum(1 for _ in func(xml_filename))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--nEntries", type=int, default=100000,
+                        help="Number of entries in synthetic XML")
+    parser.add_argument("--nRepeats", type=int, default=3,
+                        help="Number of times to run each method, fastest is reported")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        xml_filename = os.path.join(tmp_dir, "bench.xml")
+        make_xml(xml_filename, args.nEntries)
+        file_size = os.path.getsize(xml_filename) / (1024. * 1024.)
+        print("XML with", args.nEntries, "entries, %.1f MB" % file_size)
+
+        methods = [
+            ("regex", regex_filenames),
+            ("ElementTree", elementtree_filenames),
+            ("ntuple_xml", get_ntuple_filenames),
+            # includes commented-out entries
+            ("records", iter_ntuple_records),
+        ]
+        print("%-12s %10s %10s %12s %10s %14s" % ("method", "# ntuples", "time [s]", "entries/s", "MB/s", "peak mem [MB]"))
+        for name, func in methods:
+            results = [time_method(func, xml_filename) for _ in range(args.nRepeats)]
+            n, duration = min(results, key=lambda x: x[1])
+            peak = peak_memory(func, xml_filename)
+            print("%-12s %10d %10.3f %12.0f %10.1f %14.2f" % (name, n, duration,
+                                                              args.nEntries / duration,
+                                                              file_size / duration,
+                                                              peak / (1024. * 1024.)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Remove missing files from XML using *missing*.txt files from datasetInfo.py
+
+XML files listed in the missing_all file are deleted.
+For the other XML files, every line containing a missing ntuple is removed.
+Each XML file is read & rewritten once, regardless of how many ntuples are missing.
+"""
+
+
+from __future__ import print_function
+
+import os
+import re
+import argparse
+from collections import OrderedDict
+
+from fs_utils import atomic_output
+
+
+_FILENAME_PATTERN = re.compile(br'FileName\s*=\s*"([^"]*)"')
+
+# Max number of removed lines to show per XML file in a dry run
+DRY_RUN_MAX_LINES = 5
+
+
+def read_missing_file(missing_filename):
+    """Get missing ntuples for each XML file from a datasetInfo.py missing file
+
+    The file has blocks like:
+
+        ----------
+        path/to/file.xml
+        ----------
+        /pnfs/.../Ntuple_1.root
+        /pnfs/.../Ntuple_5.root
+
+    Returns
+    -------
+    OrderedDict{str: set[str]}
+        Normalised ntuple filenames for each XML path (relative to the dataset dir)
+    """
+    missing = OrderedDict()
+    xml_path = None
+    with open(missing_filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line == "-" * 10:
+                continue
+            if line.endswith(".xml"):
+                xml_path = line
+                missing.setdefault(xml_path, set())
+            elif xml_path is not None:
+                missing[xml_path].add(os.path.normpath(line))
+    return missing
+
+
+def read_missing_all_file(missing_all_filename):
+    """Get XML paths from a datasetInfo.py missing_all file, where every ntuple is missing
+
+    Returns
+    -------
+    list[str]
+    """
+    with open(missing_all_filename) as f:
+        return [line.strip() for line in f if line.strip().endswith(".xml")]
+
+
+def _is_missing_line(line, missing_filenames):
+    return any(os.path.normpath(name.decode("utf-8")) in missing_filenames
+               for name in _FILENAME_PATTERN.findall(line))
+
+
+def remove_missing_from_xml(xml_filename, missing_filenames, dry_run=False):
+    """Remove all lines that contain any of `missing_filenames` from an XML file,
+    rewriting it once via an atomic rename.
+
+    Parameters
+    ----------
+    xml_filename : str
+    missing_filenames : set[str]
+        Normalised ntuple filenames
+    dry_run : bool, optional
+        If True, don't change the file
+
+    Returns
+    -------
+    list[bytes]
+        Lines that were (or would be) removed
+    """
+    with open(xml_filename, "rb") as f:
+        removed = [line for line in f if _is_missing_line(line, missing_filenames)]
+    if removed and not dry_run:
+        with open(xml_filename, "rb") as inf, atomic_output(xml_filename) as outf:
+            for line in inf:
+                if not _is_missing_line(line, missing_filenames):
+                    outf.write(line)
+    return removed
+
+
+def cleanup_xmls(top_dir, missing, missing_all, dry_run=False):
+    """Delete XML files where all ntuples are missing, and remove missing ntuples from the rest
+
+    Parameters
+    ----------
+    top_dir : str
+        Dataset directory that XML paths are relative to
+    missing : dict{str: set[str]}
+        Missing ntuples for each XML path, from read_missing_file()
+    missing_all : list[str]
+        XML paths, from read_missing_all_file()
+    dry_run : bool, optional
+        If True, only print what would be done
+
+    Returns
+    -------
+    (int, int)
+        Number of XML files deleted, number of lines removed
+    """
+    action = "Would delete" if dry_run else "Deleting"
+    deleted = set()
+    for xml_path in missing_all:
+        xml_filename = os.path.join(top_dir, xml_path)
+        if not os.path.isfile(xml_filename):
+            print("Cannot find", xml_filename, "- skipping")
+            continue
+        print(action, xml_filename)
+        if not dry_run:
+            os.remove(xml_filename)
+        deleted.add(xml_path)
+
+    n_lines = 0
+    for xml_path, missing_filenames in missing.items():
+        xml_filename = os.path.join(top_dir, xml_path)
+        if xml_path in deleted or not os.path.isfile(xml_filename):
+            continue
+        removed = remove_missing_from_xml(xml_filename, missing_filenames, dry_run=dry_run)
+        n_lines += len(removed)
+        print("%s: %s %d lines (%d missing ntuples)"
+              % (xml_filename, "would remove" if dry_run else "removed", len(removed), len(missing_filenames)))
+        if dry_run:
+            for line in removed[:DRY_RUN_MAX_LINES]:
+                print("-", line.decode("utf-8").rstrip())
+            if len(removed) > DRY_RUN_MAX_LINES:
+                print("- ... and %d more" % (len(removed) - DRY_RUN_MAX_LINES))
+    return len(deleted), n_lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("topDir", help="Dataset directory with XML files")
+    parser.add_argument("missing", help="*_missing.txt file from datasetInfo.py")
+    parser.add_argument("missingAll", nargs="?", help="*_missing_all.txt file from datasetInfo.py")
+    parser.add_argument("--dryRun",
+                        action="store_true",
+                        help="Only print a summary of what would be changed")
+    args = parser.parse_args()
+
+    print("Looking for XML files in", args.topDir)
+    missing = read_missing_file(args.missing)
+    missing_all = read_missing_all_file(args.missingAll) if args.missingAll else []
+    n_deleted, n_lines = cleanup_xmls(args.topDir, missing, missing_all, dry_run=args.dryRun)
+    if args.dryRun:
+        print("Would delete %d XML files, and remove %d lines from the rest" % (n_deleted, n_lines))
+    else:
+        print("Deleted %d XML files, and removed %d lines from the rest" % (n_deleted, n_lines))
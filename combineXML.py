@@ -3,45 +3,165 @@
 """
 Combine XML files
 
-Doesn't keep event count, user must do it afterwards.
+Entries are streamed from each file in turn, so any number of files can be
+merged. If the same ntuple appears more than once (after normalising its path),
+only the first occurrence is kept. Commented-out entries (e.g. EMPTY/BAD) are kept,
+unless the same ntuple has already been seen; an active entry is always kept,
+even if an earlier file had it commented out.
+
+The NumberEntries totals at the end of each file are dropped, unless
+--mergeNumberEntries is used, in which case they are summed.
 """
 
 
 from __future__ import print_function
 
 import os
-import sys
+import re
 import argparse
-import xml.etree.ElementTree as ET
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gROOT.SetBatch(1)
 
-from readaMCatNloEntries import get_xml_tree
+from ntuple_xml import iter_xml_tokens, get_token_records, COMMENT
+
+
+_NUMBER_ENTRIES_PATTERN = re.compile(br'NumberEntries\s*=\s*"([^"]*)"\s+Method\s*=\s*"?(\w+)')
+
+
+def _parse_number(text):
+    """Parse number from bytes, as int if possible"""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class XMLMerger(object):
+    """Merge XML files into one, one token at a time"""
+
+    def __init__(self, output):
+        """
+        Parameters
+        ----------
+        output : file
+            File object opened in binary mode
+        """
+        self.output = output
+        # Kept separately, so an active entry isn't dropped because an earlier file had it commented out
+        self.active_filenames = set()
+        self.commented_filenames = set()
+        self.n_files = 0
+        self.n_written = 0
+        self.n_duplicates = 0
+        # Sum of NumberEntries, and for how many files
+        self.total_entries = 0
+        self.n_files_with_entries = 0
+        self.methods = set()
+        # Set to True if a file with a NumberEntries total also had duplicates
+        # removed, in which case the sum over files is wrong
+        self.total_invalid = False
+
+    def add_file(self, xml_filename):
+        """Add all entries from an XML file that haven't been seen already"""
+        self.n_files += 1
+        entries = None
+        n_duplicates_before = self.n_duplicates
+        for token in iter_xml_tokens(xml_filename):
+            records = get_token_records(token)
+            if not records:
+                if token.kind == COMMENT:
+                    match = _NUMBER_ENTRIES_PATTERN.search(token.text)
+                    if match:
+                        entries = _parse_number(match.group(1))
+                        self.methods.add(match.group(2))
+                # Anything else that isn't an ntuple (e.g. plain comments) is dropped
+                continue
+
+            new_records = []
+            for record in records:
+                filename = os.path.normpath(record.filename.strip())
+                if filename in self.active_filenames:
+                    self.n_duplicates += 1
+                elif record.commented:
+                    if filename in self.commented_filenames:
+                        self.n_duplicates += 1
+                    else:
+                        self.commented_filenames.add(filename)
+                        new_records.append(record)
+                else:
+                    self.active_filenames.add(filename)
+                    new_records.append(record)
+            if not new_records:
+                continue
+            if len(new_records) == len(records):
+                self.output.write(token.text + b"\n")
+            else:
+                self.output.write(self._make_comment(token, new_records) + b"\n")
+            self.n_written += len(new_records)
+
+        if entries is not None:
+            self.total_entries += entries
+            self.n_files_with_entries += 1
+            if self.n_duplicates > n_duplicates_before:
+                self.total_invalid = True
+
+    @staticmethod
+    def _make_comment(token, records):
+        """Make comment with only some of the entries in comment `token`, keeping its tag"""
+        parts = [b"<!--"]
+        if records[0].comment_tag:
+            parts.append(records[0].comment_tag.encode())
+        parts += [token.text[r.offset - token.offset:r.end - token.offset] for r in records]
+        parts.append(b"-->")
+        return b" ".join(parts)
+
+    def write_number_entries(self):
+        """Write NumberEntries total, if it can be correctly calculated from the inputs
+
+        Returns
+        -------
+        bool
+            True if the total was written
+        """
+        if self.n_files_with_entries != self.n_files:
+            print("Not all files have NumberEntries, cannot calculate total")
+            return False
+        if len(self.methods) != 1:
+            print("Files have NumberEntries calculated with different methods, cannot calculate total:",
+                  [m.decode() for m in self.methods])
+            return False
+        if self.total_invalid:
+            print("Duplicate entries were removed from files with NumberEntries, cannot calculate total")
+            return False
+        method = list(self.methods)[0]
+        self.output.write(b'<!-- < NumberEntries="' + str(self.total_entries).encode()
+                          + b'" Method=' + method + b' /> -->')
+        return True
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("xml", nargs='+', help="XML files to merge")
     parser.add_argument("output", help="Destination XML file")
+    parser.add_argument("--mergeNumberEntries",
+                        action="store_true",
+                        help="Add up NumberEntries from the input files")
     args = parser.parse_args()
 
-    trees = []
-    for filename in args.xml:
-        if not os.path.isfile(filename):
-            print("Missing", filename, " - skipping")
-        this_tree = get_xml_tree(filename)
-        trees.append(this_tree)
-
-    with open(args.output, 'w') as outputfile:
-        for tree in trees:
-            for child in tree:
-                if "function Comment" not in str(child.tag):
-                    outputfile.write(ET.tostring(child))
-                elif "FileName" in child.text:
-                    # is comment but keep empty/bad/commented out files
-                    # basically just ignore the count at the end
-                    outputfile.write(ET.tostring(child))
+    with open(args.output, 'wb') as outputfile:
+        merger = XMLMerger(outputfile)
+        for filename in args.xml:
+            if not os.path.isfile(filename):
+                print("Missing", filename, " - skipping")
+                continue
+            merger.add_file(filename)
+
+        print("Merged", merger.n_written, "entries from", merger.n_files, "files")
+        if merger.n_duplicates:
+            print("Skipped", merger.n_duplicates, "duplicate entries")
+
+        wrote_total = False
+        if args.mergeNumberEntries:
+            wrote_total = merger.write_number_entries()
 
     print("Output written to", args.output)
-    print("If necessary, run readaMCatNloEntries.py on the new file")
+    if not wrote_total:
+        print("If necessary, run readaMCatNloEntries.py on the new file")
@@ -2,6 +2,11 @@
 
 """
 Produce new XML file with filenames that appear in a text file commented out
+
+Can also do this for all XML files under a directory, in which case the
+XML files are updated in place.
+
+Only the lines with bad files are changed, everything else is kept byte-for-byte.
 """
 
 
@@ -9,57 +14,146 @@ from __future__ import print_function
 
 import os
 import argparse
-import xml.etree.ElementTree as ET
+import shutil
 import sys
-from CommentedTreeBuilder import CommentedTreeBuilder
-
-
-def get_xml_tree(xml_filename):
-    with open(xml_filename) as f:
-        # hack to trick XML parsing - put under a root node
-        xml_str = "<data>%s</data>" % f.read()
-    parser = ET.XMLParser(target=CommentedTreeBuilder())
-    root = ET.fromstring(xml_str, parser)
-    return root
+from ntuple_xml import iter_ntuple_records
+from fs_utils import atomic_output
 
 
 def get_filenames_from_plain_text(txt_filename):
+    """Get set of normalised filenames from text file, one per line"""
     with open(txt_filename) as f:
-        filenames = f.readlines()
-
-    # Convert // to /, remove \n, etc
-    filenames = [os.path.normpath(rf.strip()) for rf in filenames if rf.strip()]
+        # Convert // to /, remove \n, etc
+        filenames = set(os.path.normpath(rf.strip()) for rf in f if rf.strip())
     return filenames
 
 
-def comment_out_bad_xml(xml_filename, txt_filename, output_filename):
-    reference_filenames = get_filenames_from_plain_text(txt_filename)
+def find_bad_entries(xml_filename, bad_filenames):
+    """Get byte ranges of entries in XML that are in `bad_filenames` and not already commented out
+
+    Parameters
+    ----------
+    xml_filename : str
+    bad_filenames : set[str]
+        Normalised filenames
+
+    Returns
+    -------
+    list[NtupleRecord]
+    """
+    return [record for record in iter_ntuple_records(xml_filename, include_commented=False)
+            if ".root" in record.filename
+            and os.path.normpath(record.filename.strip()) in bad_filenames]
+
+
+def _copy_bytes(inf, outf, n_bytes, chunk_size=1 << 16):
+    while n_bytes > 0:
+        chunk = inf.read(min(chunk_size, n_bytes))
+        if not chunk:
+            break
+        outf.write(chunk)
+        n_bytes -= len(chunk)
+
 
-    with open(output_filename, 'w') as f:
-        root = get_xml_tree(xml_filename)
-        for child in root:
-            if child.tag != "In":
-                # this will print commented out lines
-                f.write(ET.tostring(child))
-            else:
-                filename = child.attrib['FileName']
-                if ".root" in filename:
-                    filename = os.path.normpath(filename.strip())
-                    if filename not in reference_filenames:
-                        # print out line as it was before
-                        f.write(ET.tostring(child))
-                    else:
-                        # comment it out
-                        f.write("<!-- BAD %s -->\n" % ET.tostring(child).strip())
+def write_commented_xml(xml_filename, bad_records, outf):
+    """Copy XML file to file object `outf`, wrapping the entries in `bad_records` in a BAD comment.
+    Everything else is copied unchanged.
+    """
+    with open(xml_filename, "rb") as inf:
+        pos = 0
+        for record in bad_records:
+            _copy_bytes(inf, outf, record.offset - pos)
+            element = inf.read(record.end - record.offset)
+            outf.write(b"<!-- BAD " + element + b" -->")
+            pos = record.end
+        shutil.copyfileobj(inf, outf)
+
+
+def comment_out_bad_xml(xml_filename, bad_filenames, output_filename):
+    """Write copy of XML file with ntuples in `bad_filenames` commented out.
+
+    If `output_filename` is the same as `xml_filename`, the file is updated
+    in place (atomically), and is only re-written if there are bad entries.
+
+    Parameters
+    ----------
+    xml_filename : str
+    bad_filenames : set[str]
+        Normalised filenames
+    output_filename : str
+
+    Returns
+    -------
+    list[NtupleRecord]
+        Entries that were commented out
+    """
+    bad_records = find_bad_entries(xml_filename, bad_filenames)
+    in_place = os.path.abspath(output_filename) == os.path.abspath(xml_filename)
+    if in_place and not bad_records:
+        return bad_records
+    if in_place:
+        # Write to temporary file then rename, so that the XML is never left half-written
+        with atomic_output(xml_filename) as outf:
+            write_commented_xml(xml_filename, bad_records, outf)
+    else:
+        with open(output_filename, "wb") as outf:
+            write_commented_xml(xml_filename, bad_records, outf)
+    return bad_records
+
+
+def comment_out_bad_xml_dir(top_dir, bad_filenames):
+    """Comment out ntuples in `bad_filenames` in all XML files under `top_dir`, in place.
+
+    Parameters
+    ----------
+    top_dir : str
+    bad_filenames : set[str]
+        Normalised filenames
+
+    Returns
+    -------
+    dict{str: int}
+        Number of entries commented out for each XML file that was changed
+    """
+    counts = {}
+    found_filenames = set()
+    for root, dirs, files in os.walk(top_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1] != ".xml":
+                continue
+            xml_filename = os.path.join(root, filename)
+            bad_records = comment_out_bad_xml(xml_filename, bad_filenames, xml_filename)
+            if bad_records:
+                counts[xml_filename] = len(bad_records)
+                found_filenames.update(os.path.normpath(r.filename.strip()) for r in bad_records)
+                print(xml_filename, ":", len(bad_records), "commented out")
+    print("Commented out", sum(counts.values()), "entries in", len(counts), "XML files")
+    n_not_found = len(bad_filenames - found_filenames)
+    if n_not_found:
+        print(n_not_found, "bad files were not found in any XML file")
+    return counts
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("xml", help="Input XML file")
-    parser.add_argument("txt", help="Output text file")
+    parser.add_argument("xml", help="Input XML file, or directory of XML files if --dir is used")
+    parser.add_argument("txt", help="Text file with bad ntuples, one per line")
+    parser.add_argument("--dir",
+                        action="store_true",
+                        help="Treat `xml` as a directory, and update all XML files underneath it in place")
     args = parser.parse_args()
 
-    stem, ext = os.path.splitext(args.xml)
-    output_filename = stem + "_nobad" + ext
-    comment_out_bad_xml(args.xml, args.txt, output_filename)
-    print("Written updated file", output_filename)
+    bad_filenames = get_filenames_from_plain_text(args.txt)
+    print("Loaded", len(bad_filenames), "bad filenames")
+
+    if args.dir:
+        if not os.path.isdir(args.xml):
+            raise IOError("Cannot find directory %s" % args.xml)
+        comment_out_bad_xml_dir(args.xml, bad_filenames)
+    else:
+        stem, ext = os.path.splitext(args.xml)
+        output_filename = stem + "_nobad" + ext
+        bad_records = comment_out_bad_xml(args.xml, bad_filenames, output_filename)
+        print("Commented out", len(bad_records), "entries")
+        print("Written updated file", output_filename)
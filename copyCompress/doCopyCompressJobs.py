@@ -18,6 +18,10 @@ except ImportError:
     # py2
     from itertools import izip_longest as zip_longest
 
+# ntuple_xml lives in the top-level directory of this repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ntuple_xml import get_ntuple_filenames
+
 
 SRM_PREFIX = "srm://dcache-se-cms.desy.de:8443"
 
@@ -148,14 +152,9 @@ def get_root_files_from_xml(xml_filename):
     only files stored on /nfs or /pnfs are considered
     """
     root_filenames = []
-    with open(xml_filename) as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith(("<!--", "-->")):
-                continue
-            root_filename = extract_root_filename(line)
-            if root_filename.startswith(("/nfs", "/pnfs")):
-                root_filenames.append(os.path.realpath(root_filename))
+    for root_filename in get_ntuple_filenames(xml_filename):
+        if root_filename.startswith(("/nfs", "/pnfs")):
+            root_filenames.append(os.path.realpath(root_filename))
     return root_filenames
 
 
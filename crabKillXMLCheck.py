@@ -7,6 +7,10 @@ This is necessary if you then use notFinishedLumis.json from crab report,
 since that will contain jobs that CRAB thought were transferring
 *even if* they look OK on T2.
 This therefore avoids duplicate events.
+
+Several CRAB tasks can be done in one go with --task, e.g.:
+
+    ./crabKillXMLCheck.py --jobs 8 --task crab_TTbar TTbar.xml TTbar_new.xml --task crab_WJets WJets.xml WJets_new.xml
 """
 
 
@@ -15,19 +19,56 @@ from __future__ import print_function
 import os
 import re
 import argparse
+from multiprocessing.pool import ThreadPool
+
+
+STATUS_MARKER = b"Got information from status cache file"
+
+# Job number of an ntuple filename, e.g. Ntuple_123.root -> 123
+NTUPLE_JOB_PATTERN = re.compile(r'Ntuple_(\d+)\.root')
+
+
+def iter_lines_reversed(filename, chunk_size=1 << 16):
+    """Iterate over lines in a file from the end backwards, without reading the whole file
+
+    Yields
+    ------
+    bytes
+        Each line, without the trailing newline
+    """
+    with open(filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        remainder = b""
+        while pos > 0:
+            read_size = min(chunk_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            lines = (f.read(read_size) + remainder).split(b"\n")
+            # first line may be incomplete, so keep it for the next chunk
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                yield line
+        yield remainder
+
+
+def get_last_status_text(crab_log):
+    """Get the text of the last status block in the log file, i.e. everything after the first {"""
+    for line in iter_lines_reversed(crab_log):
+        if STATUS_MARKER in line:
+            return line.split(b"{", 1)[1].decode("utf-8", "replace")  # divide at first {
+    return None
 
 
 def get_transferring_job_numbers(crab_log):
     """Get all job numbers that were transferring at the last status check"""
+    if os.path.isdir(crab_log):
+        crab_log = os.path.join(crab_log, "crab.log")
     if not os.path.isfile(crab_log):
         raise IOError("Cannot find crab log!")
 
     # First find the last status of all jobs in the log file
-    status_text = None
-    with open(crab_log) as cf:
-        for line in cf:
-            if "Got information from status cache file" in line:
-                status_text = line.split("{", 1)[1]  # divide at first {
+    status_text = get_last_status_text(crab_log)
 
     if status_text is None:
         raise RuntimeError("Cannot find status in crab log")
@@ -63,28 +104,122 @@ def job_numbers_to_filenames(job_nums):
 
 
 def create_good_xml(xml_filename, new_xml_filename, bad_ntuple_names):
-    """Copy lines from original XML to new XML if they don't contain bad ntuple"""
+    """Copy lines from original XML to new XML if they don't contain bad ntuple
+
+    Lines are matched on the job number of any Ntuple_<n>.root in them,
+    so the cost doesn't grow with the number of bad ntuples.
+
+    Returns
+    -------
+    int
+        Number of lines removed
+    """
     if not os.path.isfile(xml_filename):
         raise IOError("Cannot find xml_filename!")
 
+    bad_job_nums = set()
+    for name in bad_ntuple_names:
+        match = NTUPLE_JOB_PATTERN.search(name)
+        if match:
+            bad_job_nums.add(match.group(1))
+        # otherwise it can't match any line, so nothing to remove
+
+    n_removed = 0
     with open(xml_filename) as inf, open(new_xml_filename, "w") as of:
         for line in inf:
-            if not any([r in line for r in bad_ntuple_names]):
+            if any(num in bad_job_nums for num in NTUPLE_JOB_PATTERN.findall(line)):
+                n_removed += 1
+            else:
                 of.write(line)  # already has newline at end
+    return n_removed
+
+
+def process_task(crab_log, in_xml, out_xml):
+    """Do log check & XML cleaning for one CRAB task
+
+    Returns
+    -------
+    list[str]
+        Messages to print. These are returned rather than printed, so that
+        output from concurrent tasks doesn't get mixed up.
+    """
+    job_nums = get_transferring_job_numbers(crab_log)
+    messages = []
+    if None in job_nums:
+        messages.append("WARNING: job transferring before any job number in the crab log status, ignoring it")
+        job_nums = [j for j in job_nums if j is not None]
+    bad_ntuple_names = job_numbers_to_filenames(job_nums)
+    if len(bad_ntuple_names) > 0:
+        messages.append("%d 'bad' ntuple filenames: %s" % (len(bad_ntuple_names), bad_ntuple_names))
+        n_removed = create_good_xml(in_xml, out_xml, bad_ntuple_names)
+        messages.append("Written XML without %d bad ntuples to %s" % (n_removed, out_xml))
+    else:
+        messages.append("No bad filenames to replace, no updated XML will be produced")
+    return messages
+
+
+def _process_task_safe(task):
+    try:
+        return process_task(*task)
+    except (IOError, RuntimeError, ValueError) as e:
+        return ["ERROR: %s" % e]
+
+
+def process_tasks(tasks, jobs=4):
+    """Run process_task() for several (crab log, input XML, output XML) concurrently,
+    printing the results for each task in order
+
+    Returns
+    -------
+    int
+        Number of tasks that failed
+    """
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    n_failed = 0
+    try:
+        for task, messages in zip(tasks, pool.imap(_process_task_safe, tasks)):
+            print("---", task[0], ":", task[1])
+            for msg in messages:
+                print(msg)
+            if messages[0].startswith("ERROR"):
+                n_failed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return n_failed
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("crabLog", help="crab.log file for this set of crab jobs")
-    parser.add_argument("inXML", help="Input XML file to be cleaned up")
-    parser.add_argument("outXML", help="Output XML file to be written")
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("crabLog", nargs="?",
+                        help="crab.log file (or CRAB task directory) for this set of crab jobs")
+    parser.add_argument("inXML", nargs="?", help="Input XML file to be cleaned up")
+    parser.add_argument("outXML", nargs="?", help="Output XML file to be written")
+    parser.add_argument("--task",
+                        nargs=3,
+                        action="append",
+                        default=[],
+                        metavar=("CRABLOG", "INXML", "OUTXML"),
+                        help="Process this task as well. Can be used several times.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=4,
+                        help="Number of tasks to process at the same time")
     args = parser.parse_args()
 
-    job_nums = get_transferring_job_numbers(args.crabLog)
-    bad_ntuple_names = job_numbers_to_filenames(job_nums)
-    if len(bad_ntuple_names) > 0:
-        print(len(bad_ntuple_names), "'bad' ntuple filenames:", bad_ntuple_names)
-        create_good_xml(args.inXML, args.outXML, bad_ntuple_names)
-        print("Written XML without bad ntuples to", args.outXML)
+    tasks = [tuple(t) for t in args.task]
+    if args.crabLog:
+        if not (args.inXML and args.outXML):
+            parser.error("Need crabLog, inXML and outXML")
+        tasks.insert(0, (args.crabLog, args.inXML, args.outXML))
+    if not tasks:
+        parser.error("Need crabLog, inXML and outXML, or at least one --task")
+
+    if len(tasks) == 1:
+        for msg in process_task(*tasks[0]):
+            print(msg)
     else:
-        print("No bad filenames to replace, no updated XML will be produced")
+        n_failed = process_tasks(tasks, args.jobs)
+        if n_failed:
+            raise RuntimeError("%d of %d tasks failed" % (n_failed, len(tasks)))
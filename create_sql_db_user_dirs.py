@@ -10,50 +10,99 @@ Holds info about directory path, size, creation time, creator.
 from __future__ import print_function, division
 
 import os
+import re
+import glob
 import argparse
 import datetime
-import subprocess
 import create_sql_db_xml as creator
+from fs_utils import (iter_matching_dirs, ParallelDirWalker, RateLimiter, list_dir_summary,
+                      DEFAULT_IO_BUDGET, DEFAULT_SCAN_THREADS)
+from namespace_snapshot import NamespaceSnapshot
+from parquet_export import ParquetRowWriter, CATALOGUE_COLUMN_TYPES
 
 
 os.nice(10)
 
 
-def get_user_dir_sizes(username):
+# Top of users' & groups' Tier2 areas
+TIER2_USER_DIR = "/pnfs/desy.de/cms/tier2/store/user/"
+TIER2_GROUP_DIR = "/pnfs/desy.de/cms/tier2/store/group/"
+
+# CRAB job directory names, e.g. 170626_204933
+CRAB_DIR_PATTERN = re.compile(r"[0-9_]{5,}")
+
+# Columns of each row from get_user_dir_data(), for --parquet
+USER_DIR_COLUMNS = ["dirname", "size", "user", "creation_time"]
+
+
+def get_top_dirs(usernames, all_users=False):
+    """Get Tier2 directories to look in for usernames
+
+    Parameters
+    ----------
+    usernames : list[str]
+        Usernames, can have shell-style wildcards & subdirectories, e.g. aggleton/RunII*
+    all_users : bool, optional
+        If True, ignore `usernames` and use every user & group directory
+
+    Returns
+    -------
+    list[str]
+    """
+    if all_users:
+        patterns = [TIER2_USER_DIR + "*", TIER2_GROUP_DIR + "*"]
+    else:
+        patterns = [TIER2_USER_DIR + u for u in usernames]
+    # username can have shell-style wildcards, like it could with find
+    top_dirs = set()
+    for pattern in patterns:
+        top_dirs.update(d for d in glob.glob(pattern) if os.path.isdir(d))
+    return sorted(top_dirs)
+
+
+def get_user_dir_sizes(username, rate_limiter=None, jobs=1, all_users=False, snapshot=None):
     """Get Tier2 directories and their respective size
 
     This looks for CRAB job directories,
     e.g.  /pnfs/desy.de/cms/tier2/store/user/akaravdi/SingleElectron/crab_pickEvents/170626_204933
     ignoring any trailing 0000 etc
 
+    Each user's area is walked once, in this process. If a CRAB directory
+    is inside another one, its files are only counted for the inner one.
+
     # TODO check for actual ntuples. How to tell apart form non-UHH2 dir?
 
     Parameters
     ----------
-    username : str
-        Username to look for dirs. Can use more complex string to only search
+    username : str or list[str]
+        Username(s) to look for dirs. Can use more complex string to only search
         in certain directories, e.g. aggleton/RunII
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+    jobs : int, optional
+        Number of directories to walk at once. If > 1, the order of results is not fixed.
+    all_users : bool, optional
+        If True, look in all user & group directories
+    snapshot : NamespaceSnapshot, optional
+        Walk the directories in this snapshot instead of on disk
 
     Yields
     ------
     str, float
         Directory, Size (kB)
     """
-    cmd = (r"nice -n 10 find /pnfs/desy.de/cms/tier2/store/user/" + username +
-           " -type d -regextype posix-egrep -regex \".*/[0-9_]{5,}\" ! -path '*/log' "
-           "-exec du -sk {} \;")
-    # this is python2 & 3-friendly, and ensures that each line is piped out immediately
-    # this avoids a lower-level bug: https://www.turnkeylinux.org/blog/unix-buffering
-    # https://stackoverflow.com/questions/2715847/read-streaming-input-from-subprocess-communicate/17698359#17698359
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, bufsize=1)
-    with p.stdout:
-        for line in iter(p.stdout.readline, b''):
-            l = line.decode().strip()
-            size, dirname = l.split()
-            size = float(size.strip())
-            dirname = dirname.strip()
-            yield dirname, size
-    p.wait()  # wait for the subprocess to exit
+    usernames = [username] if isinstance(username, str) else username
+    top_dirs = get_top_dirs(usernames, all_users)
+    print("Looking in", len(top_dirs), "directories")
+    lister = snapshot.list_dir_summary if snapshot is not None else list_dir_summary
+    if jobs <= 1:
+        results = (r for top_dir in top_dirs
+                   for r in iter_matching_dirs(top_dir, CRAB_DIR_PATTERN, rate_limiter, lister=lister))
+    else:
+        walker = ParallelDirWalker(CRAB_DIR_PATTERN, jobs=jobs, rate_limiter=rate_limiter, lister=lister)
+        results = walker.walk(top_dirs)
+    for dirname, summary in results:
+        yield dirname, summary.size / 1024
 
 
 def get_dir_user(ntuple_dir):
@@ -95,16 +144,17 @@ def get_dir_user(ntuple_dir):
         return parts[ind+1]
 
 
-def get_creation_time(path):
+def get_creation_time(path, snapshot=None):
     """Get creation time of path, in ISO8601 format: YYYY-MM-DD HH:MM:SS.SSS
 
-    This format is necessary for SQLite
+    This format is necessary for SQLite.
+    If `snapshot` (NamespaceSnapshot) is given, the time is looked up in it.
     """
-    stat = os.lstat(path)
+    stat = snapshot.stat_or_none(path) if snapshot is not None else os.lstat(path)
     return datetime.datetime.fromtimestamp(stat.st_ctime).isoformat(' ')
 
 
-def get_user_dir_data(username):
+def get_user_dir_data(username, rate_limiter=None, jobs=1, all_users=False, snapshot=None):
     """Get data about each CRAB directory corresponding to user `username`,
     looking in /pnfs/desy.de/cms/tier2/store/user/"+username
 
@@ -116,15 +166,23 @@ def get_user_dir_data(username):
 
     Parameters
     ----------
-    username : str
-        Username (can also add subdirectory patterns, e.g. "aggleton/RunII*")
+    username : str or list[str]
+        Username(s) (can also add subdirectory patterns, e.g. "aggleton/RunII*")
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+    jobs : int, optional
+        Number of directories to walk at once
+    all_users : bool, optional
+        If True, look in all user & group directories
+    snapshot : NamespaceSnapshot, optional
+        Walk the directories in this snapshot instead of on disk
 
     Yields
     ------
     dict
         Data in a dict
     """
-    for dirname, size in get_user_dir_sizes(username):
+    for dirname, size in get_user_dir_sizes(username, rate_limiter, jobs, all_users, snapshot):
         user = get_dir_user(dirname)
         if user is None:
             user = ""
@@ -133,46 +191,63 @@ def get_user_dir_data(username):
             dirname=dirname,
             size=float(size),
             user=user,
-            creation_time=get_creation_time(dirname)
+            creation_time=get_creation_time(dirname, snapshot)
         )
         yield data
 
 
-def create_user_dir_table(username, output_filename, table_name='user_dir', append=True):
+def create_user_dir_table(username, output_filename, append=True,
+                          io_budget=DEFAULT_IO_BUDGET, jobs=1, all_users=False, snapshot=None, row_writer=None):
     """Main function to create table of user's directories
 
     Parameters
     ----------
-    username : str
-        Tier2 username to look for directories
+    username : str or list[str]
+        Tier2 username(s) to look for directories
     output_filename : str
         SQL output filename
-    table_name : str, optional
-        Name of table in SQL file
     append : bool, optional
-        If True, then append to any existing table with `table_name`.
-        Otherwise, delete existing before adding entries
+        If True, then add to the existing user_dir table, updating entries
+        for directories that are already in it.
+        Otherwise, delete existing entries before adding new ones
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, in total. 0 means no limit.
+    jobs : int, optional
+        Number of directories to walk at once
+    all_users : bool, optional
+        If True, look in all user & group directories
+    snapshot : NamespaceSnapshot, optional
+        Walk the directories in this snapshot instead of on disk
+    row_writer : ParquetRowWriter, optional
+        Also write rows to this as they are added, with USER_DIR_COLUMNS
     """
-    user_dir_table_maker = creator.SQLTable(table_name)
+    user_dir_table_maker = creator.SQLTable("user_dir")
     user_dir_table_maker.create_connection(path=output_filename)
+    creator.init_catalogue(user_dir_table_maker.connection)
     if not append:
-        user_dir_table_fields = [
-            "dirname TEXT NOT NULL",
-            "size FLOAT",
-            "user TEXT",
-            "creation_time TEXT"
-        ]
-        user_dir_table_maker.create_table(table_fields=user_dir_table_fields)
+        user_dir_table_maker.execute_query("DELETE FROM user_dir;")
 
     print("Filling user dir table...")
-    user_dir_table_maker.fill_table(get_user_dir_data(username))
+    user_dir_table_maker.pipelined_load(get_user_dir_data(username, RateLimiter(io_budget), jobs, all_users,
+                                                          snapshot),
+                                        key_columns=creator.USER_DIR_TABLE_KEY,
+                                        row_writer=row_writer)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("user",
-                        help="CERN username to test")
+                        nargs="*",
+                        help="CERN username(s) to test")
+    parser.add_argument("--allUsers",
+                        action="store_true",
+                        help="Look at all users & groups in store/user and store/group")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=DEFAULT_SCAN_THREADS,
+                        help="Maximum number of directories to walk at once. "
+                             "Large user areas are split up between them.")
     parser.add_argument("--output",
                         default="xml_table.sqlite",
                         help="Output SQL filename")
@@ -180,11 +255,42 @@ if __name__ == "__main__":
                         action='store_true',
                         help="If True, append data to existing table in --output, if one exists. "
                              "Otherwise, overwrites tables contents")
+    parser.add_argument("--ioBudget",
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help="Maximum number of filesystem operations per second, in total. 0 for no limit.")
+    parser.add_argument("--snapshot",
+                        help="SQLite file from namespace_snapshot.py to walk the user areas in, "
+                             "instead of on disk")
+    parser.add_argument("--parquet",
+                        help="Also write the directory rows found in this run to this Parquet file "
+                             "(needs pyarrow), as they are added")
     args = parser.parse_args()
+    if not args.user and not args.allUsers:
+        parser.error("Need at least one user, or --allUsers")
     if not os.path.isfile(args.output) and args.append:
         print("Output does not exist, setting --append False")
         args.append = False
 
-    create_user_dir_table(username=args.user,
-                          output_filename=args.output,
-                          append=args.append)
+    snapshot = NamespaceSnapshot(args.snapshot) if args.snapshot else None
+    row_writer = None
+    if args.parquet:
+        row_writer = ParquetRowWriter(args.parquet, USER_DIR_COLUMNS, column_types=CATALOGUE_COLUMN_TYPES)
+    try:
+        create_user_dir_table(username=args.user,
+                              output_filename=args.output,
+                              append=args.append,
+                              io_budget=args.ioBudget,
+                              jobs=args.jobs,
+                              all_users=args.allUsers,
+                              snapshot=snapshot,
+                              row_writer=row_writer)
+    except Exception:
+        if row_writer is not None:
+            row_writer.abort()
+        raise
+    if row_writer is not None:
+        row_writer.close()
+    if snapshot:
+        snapshot.close()
+        snapshot.print_stats()
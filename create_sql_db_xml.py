@@ -15,26 +15,110 @@ from __future__ import print_function, division
 
 import os
 import re
+import time
 import sqlite3
 import argparse
 import datetime
-from time import sleep
 import subprocess
+import threading
+import multiprocessing
+from itertools import islice
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import findAllNtupleDirs as finder
+from fs_utils import (RateLimiter, DirSizer, summarise_tree, summarise_nested_dirs, group_nested_dirs,
+                      DEFAULT_IO_BUDGET, DEFAULT_SCAN_THREADS)
+from xml_cache import XMLCache, cached_ntuple_filenames
+from git_objects import GitXMLRecords
+from namespace_snapshot import NamespaceSnapshot
+from parquet_export import ParquetRowWriter, CATALOGUE_COLUMN_TYPES
 
 
 os.nice(10)
 
 
+# Version of CATALOGUE_SCHEMA, stored in the database with PRAGMA user_version.
+# Version 1 was flat xml, xml_ntuple_dir & user_dir tables, without keys or indexes.
+SCHEMA_VERSION = 2
+
+CATALOGUE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS xml (
+        id INTEGER PRIMARY KEY,
+        filepath TEXT NOT NULL,
+        branch TEXT NOT NULL,
+        git_src TEXT NOT NULL,  -- the UHH2 git branch, or UHH2-datasets
+        year TEXT NOT NULL,
+        UNIQUE (git_src, filepath)
+    );
+    CREATE INDEX IF NOT EXISTS xml_branch ON xml (branch);
+    CREATE INDEX IF NOT EXISTS xml_year ON xml (year);
+
+    CREATE TABLE IF NOT EXISTS xml_ntuple_dir (
+        id INTEGER PRIMARY KEY,
+        xml_id INTEGER NOT NULL REFERENCES xml (id) ON DELETE CASCADE,
+        ntuple_dir TEXT NOT NULL,
+        size FLOAT,
+        user TEXT,
+        creation_time TEXT,
+        UNIQUE (xml_id, ntuple_dir)
+    );
+    CREATE INDEX IF NOT EXISTS xml_ntuple_dir_ntuple_dir ON xml_ntuple_dir (ntuple_dir);
+    CREATE INDEX IF NOT EXISTS xml_ntuple_dir_user ON xml_ntuple_dir (user);
+
+    CREATE TABLE IF NOT EXISTS user_dir (
+        id INTEGER PRIMARY KEY,
+        dirname TEXT NOT NULL UNIQUE,
+        size FLOAT,
+        user TEXT,
+        creation_time TEXT
+    );
+    CREATE INDEX IF NOT EXISTS user_dir_user ON user_dir (user);
+
+    -- Ntuple directories with their XML info, like the old flat xml_ntuple_dir table
+    CREATE VIEW IF NOT EXISTS xml_ntuple_dir_info AS
+        SELECT xml.git_src, xml.branch, xml.year, xml.filepath AS xml_filepath,
+               d.ntuple_dir, d.size, d.user, d.creation_time
+        FROM xml_ntuple_dir AS d JOIN xml ON d.xml_id = xml.id;
+"""
+
+# Columns of the xml_ntuple_dir_info view, also used for --parquet
+XML_NTUPLE_DIR_INFO_COLUMNS = ["git_src", "branch", "year", "xml_filepath",
+                               "ntuple_dir", "size", "user", "creation_time"]
+
+# Columns that identify a row in each table, for upserts
+XML_TABLE_KEY = ["git_src", "filepath"]
+XML_NTUPLE_DIR_TABLE_KEY = ["xml_id", "ntuple_dir"]
+USER_DIR_TABLE_KEY = ["dirname"]
+
+# Stores the last commit scanned for each git source, for incremental updates
+SCAN_STATE_TABLE_FIELDS = [
+    "git_src TEXT PRIMARY KEY",
+    "commit_sha TEXT NOT NULL",
+    "scan_time TEXT NOT NULL"
+]
+
+
+# Number of rows to insert per transaction in SQLTable.bulk_load()
+DEFAULT_BATCH_SIZE = 1000
+
+# Maximum number of batches waiting for the writer thread in SQLTable.pipelined_load()
+DEFAULT_QUEUE_SIZE = 16
+
+
 class SQLTable(object):
 
     def __init__(self, table_name):
         self.connection = None
+        self.path = None
         self.table_name = table_name
 
     def create_connection(self, path):
         self.connection = None
+        self.path = path
         try:
             self.connection = sqlite3.connect(path)
         except sqlite3.Error as e:
@@ -49,49 +133,359 @@ class SQLTable(object):
             print("Error", e, "occurred in execute_query")
             raise
 
-    def create_table(self, table_fields):
-        self.execute_query("DROP TABLE IF EXISTS %s;" % self.table_name)
+    def create_table(self, table_fields, drop_existing=True):
+        if drop_existing:
+            self.execute_query("DROP TABLE IF EXISTS %s;" % self.table_name)
         create_table_cmd = """
-            CREATE TABLE "{table_name}" ({table_field_str});
+            CREATE TABLE IF NOT EXISTS "{table_name}" ({table_field_str});
             """.format(table_name=self.table_name, table_field_str=",".join(table_fields))
         self.execute_query(create_table_cmd)
 
+    def make_insert_cmd(self, column_names, key_columns=None):
+        """Make INSERT command for `column_names`.
+
+        If `key_columns` is set, a row with the same values for them as an
+        existing row (i.e. a unique constraint) updates that row instead.
+        """
+        # Generate command, using sqlite ? placeholders, although this is only
+        # for values, not parameters like table name, column names
+        # So we have to generate that ourselves
+        return """
+            INSERT INTO "{table_name}" ({column_names})
+            VALUES ({values_pattern}){upsert};
+        """.format(table_name=self.table_name,
+                   column_names=", ".join(column_names),
+                   values_pattern=",".join(["?"] * len(column_names)),
+                   upsert=make_upsert_clause(column_names, key_columns) if key_columns else "")
+
     def insert_into_table(self, data):
         """Insert single row of data into table
 
+        Use bulk_load() for many rows.
+
         Parameters
         ----------
-        connection : sqlite3.Connection
-            Description
-        table_name : str
-            Name of table
         data : dict
             The keys and corresponding values are used as the columns names and values
         """
-        # Generate command, using sqlite ? placeholders, although this is only
-        # for values, not parameters like table name, column names
-        # So we have to generate that ourselves
-        insert_cmd = """
-            INSERT INTO "{table_name}" ({column_names})
-            VALUES ({values_pattern});
-        """.format(table_name=self.table_name,
-                   column_names=", ".join(data.keys()),  # order is same for .keys() and .values()
-                   values_pattern=",".join(["?"] * len(data)))
-        self.execute_query(insert_cmd, tuple(data.values()))
+        column_names = list(data.keys())
+        self.execute_query(self.make_insert_cmd(column_names), tuple(data[c] for c in column_names))
+
+    def set_fast_writes(self, connection=None):
+        """Use write-ahead logging, and only sync to disk at checkpoints, not every commit.
 
-    def fill_table(self, data_generator, verbose=True):
+        The database can't be corrupted by a crash, but the last transactions may be lost.
+        WAL mode is stored in the file, so it stays on for later connections.
+        """
+        connection = connection or self.connection
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA synchronous=NORMAL;")
+
+    def insert_batch(self, batch, key_columns=None, connection=None):
+        """Insert list of rows (dicts with the same keys) in one transaction"""
+        connection = connection or self.connection
+        column_names = list(batch[0].keys())
+        insert_cmd = self.make_insert_cmd(column_names, key_columns)
+        with connection:
+            connection.executemany(insert_cmd, (tuple(data[c] for c in column_names) for data in batch))
+
+    def bulk_load(self, data_generator, batch_size=DEFAULT_BATCH_SIZE, fast_writes=True, key_columns=None):
+        """Insert rows in batches, with one transaction per batch
+
+        Parameters
+        ----------
+        data_generator : iterable[dict]
+            Rows to insert. The keys and corresponding values are used as the
+            columns names and values, and must be the same for every row.
+        batch_size : int, optional
+            Number of rows per transaction
+        fast_writes : bool, optional
+            If True, use set_fast_writes() first
+        key_columns : list[str], optional
+            Columns of a unique constraint: rows that match an existing row
+            in these update it, instead of being added
+
+        Returns
+        -------
+        int
+            Number of rows added
+        """
+        if fast_writes:
+            self.set_fast_writes()
+        start = time.time()
+        rows = iter(data_generator)
+        counter = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            try:
+                self.insert_batch(batch, key_columns)
+            except sqlite3.Error as e:
+                print("Error", e, "occurred in bulk_load")
+                raise
+            counter += len(batch)
+        duration = time.time() - start
+        print("Added %d entries to table %s in %.1f s (%.0f rows/s)"
+              % (counter, self.table_name, duration, counter / duration if duration > 0 else 0))
+        return counter
+
+    def pipelined_load(self, data_generator, batch_size=DEFAULT_BATCH_SIZE, fast_writes=True, key_columns=None,
+                       queue_size=DEFAULT_QUEUE_SIZE, row_writer=None, row_func=None):
+        """Like bulk_load(), but the rows are inserted by a separate writer thread,
+        so that making rows (e.g. scanning directories) doesn't wait for the database.
+
+        Batches are passed to the writer through a queue of at most `queue_size`
+        batches. If the writer falls behind, adding a batch waits until there is
+        space. The queue depth & time spent waiting are printed as it goes.
+
+        Parameters are the same as for bulk_load(), plus:
+
+        queue_size : int, optional
+            Maximum number of batches waiting to be written
+        row_writer : ParquetRowWriter, optional
+            Also add each row to this, from the writer thread once its batch
+            is in the database, so row groups are written during the scan
+        row_func : callable, optional
+            Function to make the row for `row_writer` from each row
+
+        Returns
+        -------
+        int
+            Number of rows added
+        """
+        if fast_writes:
+            self.set_fast_writes()
+        batches = Queue(maxsize=queue_size)
+        errors = []
+        n_written = [0]
+
+        def _write_batches():
+            # sqlite connections can't be shared between threads, so it needs its own
+            connection = None
+            try:
+                connection = sqlite3.connect(self.path)
+                connection.execute("PRAGMA foreign_keys = ON;")
+                if fast_writes:
+                    self.set_fast_writes(connection)
+            except Exception as e:
+                # e.g. database is locked by another writer.
+                # Still drain the queue below, so the producer doesn't block.
+                errors.append(e)
+            try:
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if errors:
+                        continue  # keep taking batches, so the producer doesn't block
+                    try:
+                        self.insert_batch(batch, key_columns, connection)
+                        n_written[0] += len(batch)
+                        if row_writer is not None:
+                            for row in batch:
+                                row_writer.add(row_func(row) if row_func else row)
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+        writer = threading.Thread(target=_write_batches, name="writer-" + self.table_name)
+        writer.daemon = True
+        writer.start()
+
+        start = time.time()
+        rows = iter(data_generator)
         counter = 0
-        for data in data_generator:
-            self.insert_into_table(data)
-            counter += 1
-        print("Added", counter, "entries to table")
+        n_batches = 0
+        wait_time = 0.
+        try:
+            while not errors:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                put_start = time.time()
+                batches.put(batch)
+                wait_time += time.time() - put_start
+                counter += len(batch)
+                n_batches += 1
+                if n_batches % 10 == 0:
+                    print("Made %d rows for table %s, %d written, queue depth %d/%d, %.1f s waiting for writer"
+                          % (counter, self.table_name, n_written[0], batches.qsize(), queue_size, wait_time))
+        finally:
+            batches.put(None)
+            writer.join()
+        if errors:
+            print("Error", errors[0], "occurred in pipelined_load")
+            raise errors[0]
+        duration = time.time() - start
+        print("Added %d entries to table %s in %.1f s (%.0f rows/s), %.1f s waiting for writer"
+              % (n_written[0], self.table_name, duration, n_written[0] / duration if duration > 0 else 0,
+                 wait_time))
+        return n_written[0]
+
+    def fill_table(self, data_generator, verbose=True, batch_size=DEFAULT_BATCH_SIZE, key_columns=None):
+        return self.bulk_load(data_generator, batch_size=batch_size, key_columns=key_columns)
+
+
+def make_upsert_clause(column_names, key_columns):
+    """Make ON CONFLICT clause to update existing row with same `key_columns`.
+    Needs SQLite >= 3.24"""
+    update_columns = [c for c in column_names if c not in key_columns]
+    if not update_columns:
+        return " ON CONFLICT ({keys}) DO NOTHING".format(keys=", ".join(key_columns))
+    return " ON CONFLICT ({keys}) DO UPDATE SET {updates}".format(
+        keys=", ".join(key_columns),
+        updates=", ".join("{c} = excluded.{c}".format(c=c) for c in update_columns))
+
+
+def _table_exists(connection, table_name):
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table_name,)).fetchone() is not None
+
+
+def _migrate_v1_to_v2(connection):
+    """Move data from version 1 flat tables into the version 2 schema.
+
+    Duplicate rows (e.g. from re-running with --append) are merged, keeping the last one.
+    Version 1 didn't store which git source an ntuple dir came from, so it is
+    added for every XML with the same filepath.
+    """
+    old_tables = [t for t in ("xml", "xml_ntuple_dir", "user_dir") if _table_exists(connection, t)]
+    for table_name in old_tables:
+        connection.execute('ALTER TABLE "{t}" RENAME TO "{t}_v1"'.format(t=table_name))
+    _create_catalogue_tables(connection)
+    # WHERE 1 is needed to use ON CONFLICT with INSERT ... SELECT
+    if "xml" in old_tables:
+        connection.execute("INSERT INTO xml (filepath, branch, git_src, year) "
+                           "SELECT filepath, branch, COALESCE(git_src, ''), COALESCE(year, '') FROM xml_v1 WHERE 1"
+                           + make_upsert_clause(["filepath", "branch", "git_src", "year"], XML_TABLE_KEY))
+    if "xml_ntuple_dir" in old_tables:
+        connection.execute("INSERT INTO xml_ntuple_dir (xml_id, ntuple_dir, size, user, creation_time) "
+                           "SELECT xml.id, d.ntuple_dir, d.size, d.user, d.creation_time "
+                           "FROM xml_ntuple_dir_v1 AS d JOIN xml ON xml.filepath = d.xml_filepath WHERE 1"
+                           + make_upsert_clause(["xml_id", "ntuple_dir", "size", "user", "creation_time"],
+                                                XML_NTUPLE_DIR_TABLE_KEY))
+    if "user_dir" in old_tables:
+        connection.execute("INSERT INTO user_dir (dirname, size, user, creation_time) "
+                           "SELECT dirname, size, user, creation_time FROM user_dir_v1 WHERE 1"
+                           + make_upsert_clause(["dirname", "size", "user", "creation_time"], USER_DIR_TABLE_KEY))
+    for table_name in old_tables:
+        connection.execute('DROP TABLE "{t}_v1"'.format(t=table_name))
+
+
+def _create_catalogue_tables(connection):
+    # not executescript(), since that commits first
+    for statement in CATALOGUE_SCHEMA.split(";"):
+        if statement.strip():
+            connection.execute(statement)
+
+
+def init_catalogue(connection):
+    """Create the xml, xml_ntuple_dir & user_dir tables if they don't exist,
+    migrating databases with an older schema to SCHEMA_VERSION.
+
+    Also turns on foreign keys for `connection`, so that deleting an XML
+    deletes its ntuple dirs.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+
+    Raises
+    ------
+    RuntimeError
+        If the database has a newer schema than this script knows about
+    """
+    connection.execute("PRAGMA foreign_keys = ON;")
+    version = connection.execute("PRAGMA user_version;").fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database has schema version %d, but this script only knows up to %d"
+                           % (version, SCHEMA_VERSION))
+    # Manage the transaction ourselves, so the migration is all or nothing
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        connection.execute("BEGIN")
+        if any(_table_exists(connection, t) for t in ("xml", "xml_ntuple_dir", "user_dir")):
+            print("Migrating database to schema version", SCHEMA_VERSION)
+            _migrate_v1_to_v2(connection)
+        else:
+            _create_catalogue_tables(connection)
+        connection.execute("PRAGMA user_version = %d;" % SCHEMA_VERSION)
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.isolation_level = isolation_level
+
+
+def find_xml_filenames(top_dir):
+    """Yield XML filenames under `top_dir`, relative to `top_dir`, in sorted order
+
+    Parameters
+    ----------
+    top_dir : str
+
+    Yields
+    ------
+    str
+    """
+    for root, dirs, files in os.walk(top_dir):
+        # sort so that output order doesn't depend on filesystem
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1] != ".xml":
+                continue
+            full_filename = os.path.join(root, filename)
+            # only want relative to UHH2-datasets or whatever top_dir is
+            full_filename = os.path.relpath(full_filename, top_dir)
+            yield full_filename
+
+
+def get_ntuple_dirs(ntuple_filenames):
+    """Get sorted list of unique directories for ntuple filenames,
+    removing the last 0000 directory that CRAB makes
+
+    Parameters
+    ----------
+    ntuple_filenames : iterable[str]
+
+    Returns
+    -------
+    list[str]
+    """
+    dirs = set()
+    for ntuple_fname in ntuple_filenames:
+        dir_name = os.path.normpath(os.path.dirname(ntuple_fname))
+        parts = dir_name.split("/")
+        # remove last 0000 directory that CRAB makes
+        if re.match(r"^[0-9]{4}$", parts[-1]):
+            dir_name = "/".join(parts[:-1])
+        dirs.add(dir_name)
+    return sorted(dirs)
 
 
 class XMLFileDataGenerator(object):
 
-    def __init__(self, top_dir, git_source):
+    def __init__(self, top_dir, git_source, xml_filenames=None):
+        """
+        Parameters
+        ----------
+        top_dir : str
+            Top directory to start looking for XML files
+        git_source : str
+            Git remote/branch for `top_dir`
+        xml_filenames : list[str], optional
+            Only use these XML files (relative to `top_dir`), instead of all XMLs in `top_dir`
+        """
         self.top_dir = top_dir
         self.git_source = git_source
+        self.xml_filenames = xml_filenames
 
     def get_xml_filenames(self):
         """Summary
@@ -101,14 +495,12 @@ class XMLFileDataGenerator(object):
         TYPE
             Description
         """
-        for root, dirs, files in os.walk(self.top_dir):
-            for filename in files:
-                if os.path.splitext(filename)[1] != ".xml":
-                    continue
-                full_filename = os.path.join(root, filename)
-                # only want relative to UHH2-datasets or whatever top_dir is
-                full_filename = os.path.relpath(full_filename, self.top_dir)
+        if self.xml_filenames is not None:
+            for full_filename in sorted(self.xml_filenames):
                 yield full_filename
+            return
+        for full_filename in find_xml_filenames(self.top_dir):
+            yield full_filename
 
     @staticmethod
     def get_year_from_path(path):
@@ -206,8 +598,52 @@ class XMLFileDataGenerator(object):
 
 class XMLNtupleDirDataGenerator(object):
 
-    def __init__(self, top_dir):
+    def __init__(self, top_dir, xml_cache=None, jobs=1, io_budget=DEFAULT_IO_BUDGET, xml_filenames=None,
+                 xml_reader=None, scan_threads=DEFAULT_SCAN_THREADS, snapshot_filename=None):
+        """
+        Parameters
+        ----------
+        top_dir : str
+            Top directory to start looking for XML files
+        xml_filenames : list[str], optional
+            Only use these XML files (relative to `top_dir`), instead of all XMLs in `top_dir`
+        xml_reader : callable, optional
+            Function to get ntuple filenames for an XML file (including `top_dir`),
+            instead of reading it from disk, e.g. to read from git objects
+        xml_cache : XMLCache, optional
+            Cache of parsed XML files
+        jobs : int, optional
+            Number of worker processes to parse XMLs & get directory sizes.
+            Output order is the same for any number of jobs.
+        io_budget : float, optional
+            Maximum number of filesystem operations per second, per worker.
+            0 means no limit.
+        scan_threads : int, optional
+            Number of threads each worker uses to scan subdirectories of an ntuple directory
+        snapshot_filename : str, optional
+            SQLite file from namespace_snapshot.py to look up ntuple directories in,
+            instead of scanning them on disk
+        """
         self.top_dir = top_dir
+        self.xml_cache = xml_cache
+        self.jobs = jobs
+        self.io_budget = io_budget
+        self.scan_threads = scan_threads
+        self.rate_limiter = RateLimiter(io_budget)
+        self.snapshot_filename = snapshot_filename
+        self.snapshot = NamespaceSnapshot(snapshot_filename) if snapshot_filename else None
+        if self.snapshot is not None:
+            # lookups are local, so no need for threads
+            self.dir_sizer = DirSizer(jobs=1, rate_limiter=self.rate_limiter,
+                                      lister=self.snapshot.list_dir_summary)
+        else:
+            self.dir_sizer = DirSizer(jobs=scan_threads, rate_limiter=self.rate_limiter)
+        # Stats for the last iteration
+        self.n_rows = 0
+        self.n_unique_dirs = 0
+        self.n_rolled_up = 0
+        self.xml_filenames = xml_filenames
+        self.xml_reader = xml_reader
 
     def get_xml_filenames(self):
         """Summary
@@ -217,73 +653,25 @@ class XMLNtupleDirDataGenerator(object):
         TYPE
             Description
         """
-        for root, dirs, files in os.walk(self.top_dir):
-            for filename in files:
-                if os.path.splitext(filename)[1] != ".xml":
-                    continue
-                full_filename = os.path.join(root, filename)
-                # only want relative to UHH2-datasets or whatever top_dir is
-                full_filename = os.path.relpath(full_filename, self.top_dir)
+        if self.xml_filenames is not None:
+            for full_filename in sorted(self.xml_filenames):
                 yield full_filename
-
-    @staticmethod
-    def get_ntuple_filenames_from_xml(xml_filename):
-        """Yield ntuple filenames from XML file
-
-        Parameters
-        ----------
-        xml_filename : str
-            XML file to get ntuples from
-
-        Yields
-        ------
-        str
-            Ntuple filename
-        """
-        with open(xml_filename) as f:
-            is_comment = False
-            fname_pattern = r'< ?In FileName="(.+)" Lumi="0\.0" ?\/>'
-            for line in f:
-                line = line.strip()
-                if line.startswith("<!--"):
-                    is_comment = True
-                if line.endswith("-->"):
-                    is_comment = False
-                    continue
-                if is_comment:
-                    continue
-
-                match = re.search(fname_pattern, line.strip())
-                if match is None:
-                    continue
-                else:
-                    fname = match.group(1)
-                    yield fname
+            return
+        for full_filename in find_xml_filenames(self.top_dir):
+            yield full_filename
 
     def get_ntuple_dirs_from_xml(self, xml_filename):
-        dirs = set()
-        for ntuple_fname in self.get_ntuple_filenames_from_xml(xml_filename):
-            dir_name = os.path.normpath(os.path.dirname(ntuple_fname))
-            parts = dir_name.split("/")
-            # remove last 0000 directory that CRAB makes
-            if re.match(r"^[0-9]{4}$", parts[-1]):
-                dir_name = "/".join(parts[:-1])
-            dirs.add(dir_name)
-        return list(dirs)
+        if self.xml_reader is not None:
+            return get_ntuple_dirs(self.xml_reader(xml_filename))
+        return get_ntuple_dirs(cached_ntuple_filenames(xml_filename, self.xml_cache))
 
     @staticmethod
-    def get_size(path):
-        """Get size of directory/file path in kB"""
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                try:
-                    stat = os.lstat(fp)
-                except OSError:
-                    continue
-                total_size += stat.st_size
-        return total_size / 1024
+    def get_size(path, rate_limiter=None):
+        """Get size of directory/file path in kB
+
+        If `rate_limiter` is set, it is used to throttle filesystem operations
+        """
+        return summarise_tree(path, rate_limiter).size / 1024
 
     @staticmethod
     def get_dir_user(ntuple_dir):
@@ -324,22 +712,41 @@ class XMLNtupleDirDataGenerator(object):
                 return None
             return parts[ind+1]
 
-    @staticmethod
-    def get_creation_time(thing):
+    def get_creation_time(self, thing):
         """Get creation time of path, in ISO8601 format: YYYY-MM-DD HH:MM:SS.SSS
 
         This format is necessary for SQLite
         """
-        stat = os.lstat(thing)
+        stat = self.snapshot.stat_or_none(thing) if self.snapshot is not None else os.lstat(thing)
         return datetime.datetime.fromtimestamp(stat.st_ctime).isoformat(' ')
 
-    def get_ntuple_dir_data(self, ntuple_dir):
+    def isdir(self, path):
+        """os.path.isdir(), or looked up in the snapshot if there is one"""
+        if self.snapshot is not None:
+            return self.snapshot.isdir(path)
+        return os.path.isdir(path)
+
+    def get_ntuple_dir_data(self, ntuple_dir, summary=None):
+        """Get info about an ntuple directory
+
+        Parameters
+        ----------
+        ntuple_dir : str
+        summary : DirSummary, optional
+            Summary of files in `ntuple_dir`, if already known
+
+        Returns
+        -------
+        dict
+        """
         size = -1
         user = "None"
         creation_time = "-1"
         user = self.get_dir_user(ntuple_dir)  # doesn't rely on it actually existing
-        if os.path.isdir(ntuple_dir):
-            size = self.get_size(ntuple_dir)
+        if self.isdir(ntuple_dir):
+            if summary is None:
+                summary = self.dir_sizer.summarise(ntuple_dir)
+            size = summary.size / 1024
             creation_time = self.get_creation_time(ntuple_dir)
         data = dict(ntuple_dir=ntuple_dir,
                     size=size,
@@ -347,37 +754,176 @@ class XMLNtupleDirDataGenerator(object):
                     creation_time=creation_time)
         return data
 
+    def get_ntuple_dir_group_data(self, group):
+        """Get info for a group of nested ntuple directories, from group_nested_dirs().
+
+        The innermost directories are scanned first, so that their totals can be
+        reused for the directories that contain them.
+
+        Returns
+        -------
+        list[dict], int
+            Info for each directory in `group`, in the same order,
+            and the number of directory totals that were reused
+        """
+        existing = [d for d in group if self.isdir(d)]
+        summaries = summarise_nested_dirs(existing, sizer=self.dir_sizer)
+        # every existing dir apart from the outermost was used for its parent's total
+        n_reused = max(0, len(existing) - 1)
+        return [self.get_ntuple_dir_data(d, summaries.get(d)) for d in group], n_reused
+
+    def get_xml_ntuple_dir_pairs(self, pool=None):
+        """Get (XML path, ntuple directory) for all ntuple directories in all XML files
+
+        Parameters
+        ----------
+        pool : multiprocessing.Pool, optional
+            Used to read XML files in parallel
+
+        Returns
+        -------
+        list[(str, str)]
+        """
+        xml_paths = list(self.get_xml_filenames())
+        full_xml_paths = [os.path.join(self.top_dir, x) for x in xml_paths]
+        if pool is not None and self.xml_cache is None and self.xml_reader is None:
+            xml_dirs = pool.imap(_ntuple_dirs_worker, full_xml_paths, chunksize=4)
+        else:
+            # the cache/reader can't be shared between processes, but it's fast anyway
+            xml_dirs = (self.get_ntuple_dirs_from_xml(x) for x in full_xml_paths)
+        return [(x, d) for x, dirs in zip(xml_paths, xml_dirs) for d in dirs]
+
+    def make_pool(self):
+        """Make the worker process pool for iter_rows(), or None if there is only one job.
+
+        Must be called before starting any threads, e.g. the writer thread in
+        SQLTable.pipelined_load(), since forking a process that has other threads
+        running can deadlock if one of them holds a lock (e.g. in sqlite3).
+        """
+        if self.jobs <= 1:
+            return None
+        return multiprocessing.Pool(processes=self.jobs,
+                                    initializer=_init_ntuple_dir_worker,
+                                    initargs=(self.top_dir, self.io_budget, self.scan_threads,
+                                              self.snapshot_filename))
+
     def __iter__(self):
-        """Summary
+        return self.iter_rows(self.make_pool())
+
+    def iter_rows(self, pool=None):
+        """Yield info for each (XML file, ntuple directory).
+
+        Each unique ntuple directory is only scanned once, however many XML files
+        refer to it, and directories inside other ntuple directories are only
+        scanned once for both.
+
+        Rows are yielded as soon as their directory has been scanned, so they can
+        be written while other directories are scanned. They are in order of
+        ntuple directory, then XML file, for any number of jobs.
+
+        Parameters
+        ----------
+        pool : multiprocessing.Pool, optional
+            Worker pool from make_pool(), which is closed at the end. If None, everything
+            is done in this process.
 
         Yields
         ------
-        TYPE
-            Description
+        dict
         """
-        counter = 0
-        for xml_path in self.get_xml_filenames():
-            for ntuple_dir in self.get_ntuple_dirs_from_xml(os.path.join(self.top_dir, xml_path)):
-                counter += 1
-                # Sleep every so often to avoid too much stress on filesystem
-                if counter % 1000 == 0:
-                    print("Done", counter, ", sleeping for 5s...")
-                    sleep(5)
-
-                data = self.get_ntuple_dir_data(ntuple_dir)
-                data['xml_filepath'] = xml_path
-                yield data
+        # Parallel version: use imap so results come back in the same order as
+        # the serial version
+        self.n_rolled_up = 0
+        try:
+            pairs = self.get_xml_ntuple_dir_pairs(pool)
+            groups = group_nested_dirs(set(d for _, d in pairs))
+            self.n_rows = len(pairs)
+            self.n_unique_dirs = sum(len(g) for g in groups)
+            print("Getting info for", self.n_unique_dirs, "unique ntuple dirs, used by",
+                  self.n_rows, "XML entries, using", self.jobs, "workers")
+            if pool is None:
+                # snapshot lookups are counted by self.snapshot directly
+                results = (self.get_ntuple_dir_group_data(g) + ((0, 0),) for g in groups)
+            else:
+                results = pool.imap(_ntuple_dir_group_worker, groups)
+            dir_xmls = {}
+            for xml_path, ntuple_dir in pairs:
+                dir_xmls.setdefault(ntuple_dir, []).append(xml_path)
+            n_done = 0
+            for group_data, n_reused, (n_lookups, n_fallbacks) in results:
+                self.n_rolled_up += n_reused
+                if self.snapshot is not None:
+                    # add on the lookups done by worker processes
+                    self.snapshot.lookups += n_lookups
+                    self.snapshot.fallbacks += n_fallbacks
+                for data in group_data:
+                    for xml_path in dir_xmls[data['ntuple_dir']]:
+                        row = dict(data)
+                        row['xml_filepath'] = xml_path
+                        yield row
+                    n_done += 1
+                    if n_done % 1000 == 0:
+                        print("Done", n_done, "/", self.n_unique_dirs)
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            self.dir_sizer.close()
+        self.print_stats()
+
+    def print_stats(self):
+        n_reused = self.n_rows - self.n_unique_dirs
+        print("Ntuple dir info: scanned %d unique dirs for %d XML entries, %d reused (hit rate %.1f%%), "
+              "%d dir totals reused in parent dirs"
+              % (self.n_unique_dirs, self.n_rows, n_reused,
+                 100. * n_reused / self.n_rows if self.n_rows else 0, self.n_rolled_up))
+        if self.snapshot is not None:
+            self.snapshot.print_stats()
+
+
+# Each worker process has its own generator, and therefore its own I/O budget
+_worker_generator = None
+
+
+def _init_ntuple_dir_worker(top_dir, io_budget, scan_threads, snapshot_filename):
+    global _worker_generator
+    _worker_generator = XMLNtupleDirDataGenerator(top_dir=top_dir, io_budget=io_budget,
+                                                  scan_threads=scan_threads,
+                                                  snapshot_filename=snapshot_filename)
+
+
+def _ntuple_dirs_worker(xml_filename):
+    return _worker_generator.get_ntuple_dirs_from_xml(xml_filename)
+
+
+def _ntuple_dir_group_worker(group):
+    """get_ntuple_dir_group_data() in a worker, plus the number of snapshot
+    (lookups, fallbacks) it did, since they happen here rather than in the parent"""
+    snapshot = _worker_generator.snapshot
+    if snapshot is None:
+        return _worker_generator.get_ntuple_dir_group_data(group) + ((0, 0),)
+    lookups, fallbacks = snapshot.lookups, snapshot.fallbacks
+    group_data, n_reused = _worker_generator.get_ntuple_dir_group_data(group)
+    return group_data, n_reused, (snapshot.lookups - lookups, snapshot.fallbacks - fallbacks)
 
 
 def get_git_remote_info():
     """Get current git remote name and URL
 
+    If the repo has no remote (e.g. a local test repo),
+    the name is None and the repo directory name is used instead of the URL
+
     Returns
     -------
     str, str
         Name, URL
     """
     remote_str = subprocess.check_output("git remote -v".split())
+    if not remote_str.strip():
+        toplevel = subprocess.check_output("git rev-parse --show-toplevel".split())
+        return None, os.path.basename(toplevel.decode().strip())
     remote_name, remote_url, _ = remote_str.splitlines()[0].split()
     remote_name = remote_name.decode()
     remote_url = remote_url.decode()
@@ -403,7 +949,112 @@ def get_git_current_branch():
     return branch
 
 
-def create_xml_table(top_dir, output_filename, table_name="xml", append=True):
+def get_git_head_commit():
+    """Get SHA of current git HEAD commit
+
+    Returns
+    -------
+    str
+    """
+    commit = subprocess.check_output("git rev-parse HEAD".split())
+    return commit.decode().strip()
+
+
+def get_git_source(top_dir):
+    """Get "<repo name>/<branch>" string for the git repo containing `top_dir`
+
+    Parameters
+    ----------
+    top_dir : str
+
+    Returns
+    -------
+    str
+    """
+    pwd = os.getcwd()
+    os.chdir(top_dir)
+    try:
+        remote_name, remote_url = get_git_remote_info()
+        branch = get_git_current_branch()
+    finally:
+        os.chdir(pwd)
+    return "%s/%s" % (remote_url, branch)
+
+
+def get_changed_xml_files(top_dir, old_commit, new_commit="HEAD"):
+    """Get XML files that changed between 2 commits, using git diff
+
+    Parameters
+    ----------
+    top_dir : str
+        Directory in git repo. Only changes underneath this are considered.
+    old_commit : str
+    new_commit : str, optional
+
+    Returns
+    -------
+    list[str], list[str]
+        XML files (relative to `top_dir`) whose entries must be removed,
+        and XML files whose entries must be (re-)added.
+        Modified files appear in both.
+    """
+    # -z to avoid git quoting awkward filenames, --relative to make paths relative to top_dir
+    cmd = ["git", "diff", "--name-status", "-z", "--relative", "-M", old_commit, new_commit]
+    out = subprocess.check_output(cmd, cwd=top_dir).decode()
+    fields = out.split("\0")
+    to_remove, to_add = set(), set()
+    ind = 0
+    while ind < len(fields) and fields[ind]:
+        status = fields[ind][0]
+        if status in ("R", "C"):
+            # Renamed or copied: 2 paths, old & new
+            old_path, new_path = fields[ind+1], fields[ind+2]
+            if status == "R":
+                to_remove.add(old_path)
+            to_add.add(new_path)
+            ind += 3
+        else:
+            path = fields[ind+1]
+            if status != "A":
+                to_remove.add(path)
+            if status != "D":
+                to_add.add(path)
+            ind += 2
+
+    def _is_xml(path):
+        return os.path.splitext(path)[1] == ".xml"
+
+    return sorted(filter(_is_xml, to_remove)), sorted(filter(_is_xml, to_add))
+
+
+def get_last_scanned_commit(output_filename, git_source):
+    """Get the last commit of `git_source` that was scanned into `output_filename`
+
+    Returns
+    -------
+    str
+        Commit SHA, or None if it hasn't been scanned before
+    """
+    table_maker = SQLTable("scan_state")
+    table_maker.create_connection(path=output_filename)
+    table_maker.create_table(table_fields=SCAN_STATE_TABLE_FIELDS, drop_existing=False)
+    row = table_maker.connection.execute("SELECT commit_sha FROM scan_state WHERE git_src = ?",
+                                         (git_source,)).fetchone()
+    table_maker.connection.close()
+    return row[0] if row else None
+
+
+def set_last_scanned_commit(output_filename, git_source, commit):
+    """Store the last commit of `git_source` that was scanned into `output_filename`"""
+    table_maker = SQLTable("scan_state")
+    table_maker.create_connection(path=output_filename)
+    table_maker.create_table(table_fields=SCAN_STATE_TABLE_FIELDS, drop_existing=False)
+    table_maker.execute_query("INSERT OR REPLACE INTO scan_state VALUES (?, ?, ?);",
+                              (git_source, commit, datetime.datetime.now().isoformat(' ')))
+    table_maker.connection.close()
+
+
+def create_xml_table(top_dir, output_filename, append=True, xml_filenames=None, git_source=None):
     """Make and fill SQL table with XML file info
 
     Parameters
@@ -412,84 +1063,228 @@ def create_xml_table(top_dir, output_filename, table_name="xml", append=True):
         Top directory to start looking for XML files
     output_filename : str
         Output SQL filename
-    table_name : str, optional
-        Name of table in SQL file
+    append : bool, optional
+        If True, add to the existing table, updating entries for XML files
+        that are already in it. Otherwise empty the table first
+        (which also empties the xml_ntuple_dir table).
+    xml_filenames : list[str], optional
+        Only add these XML files (relative to `top_dir`), instead of all XMLs in `top_dir`
+    git_source : str, optional
+        Git repo/branch of the XML files. If None, it is determined from `top_dir`
 
     Raises
     ------
     IOError
         If `top_dir` doesn't exist
     """
-    if not os.path.isdir(top_dir):
+    if xml_filenames is None and not os.path.isdir(top_dir):
         raise IOError("%s does not exist" % top_dir)
-    xml_table_maker = SQLTable(table_name)
+    xml_table_maker = SQLTable("xml")
     xml_table_maker.create_connection(path=output_filename)
-
+    init_catalogue(xml_table_maker.connection)
     if not append:
-        # TODO put schema somewhere more central/connected with data dict
-        xml_table_fields = [
-            "filepath TEXT NOT NULL",
-            "branch TEXT NOT NULL",
-            "git_src TEXT",  # the UHH2 git branch, or UHH2-datasets
-            "year TEXT NOT NULL"
-        ]
-        xml_table_maker.create_table(table_fields=xml_table_fields)
-
-    pwd = os.getcwd()
-    os.chdir(top_dir)
-    remote_name, remote_url = get_git_remote_info()
-    branch = get_git_current_branch()
-    os.chdir(pwd)
+        xml_table_maker.execute_query("DELETE FROM xml;")
 
     xml_generator = XMLFileDataGenerator(top_dir=top_dir,
-                                         git_source="%s/%s" % (remote_url, branch))
+                                         git_source=git_source or get_git_source(top_dir),
+                                         xml_filenames=xml_filenames)
     print("Filling xml table...")
-    xml_table_maker.fill_table(xml_generator)
+    xml_table_maker.fill_table(xml_generator, key_columns=XML_TABLE_KEY)
 
 
-def create_xml_ntuple_dir_table(top_dir, output_filename, table_name="xml_ntuple_dir", append=True):
+def create_xml_ntuple_dir_table(top_dir, output_filename, append=True,
+                                xml_cache=None, jobs=1, io_budget=DEFAULT_IO_BUDGET, xml_filenames=None,
+                                xml_reader=None, snapshot_filename=None, git_source=None, row_writer=None):
     """Make and fill SQL table with Ntuple directory info from XML files
 
+    The XML files must already be in the xml table, see create_xml_table().
+
     Parameters
     ----------
     top_dir : str
         Top directory to start looking for XML files
     output_filename : str
         Output SQL filename
-    table_name : str, optional
-        Name of table in SQL file
+    append : bool, optional
+        If True, add to the existing table, updating entries for (XML, ntuple dir)
+        that are already in it. Otherwise empty the table first.
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of worker processes for parsing XMLs & getting directory sizes
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, per worker
+    xml_filenames : list[str], optional
+        Only add these XML files (relative to `top_dir`), instead of all XMLs in `top_dir`
+    xml_reader : callable, optional
+        Function to get ntuple filenames for an XML file, instead of reading it from disk
+    snapshot_filename : str, optional
+        SQLite file from namespace_snapshot.py to look up ntuple directories in
+    git_source : str, optional
+        Git repo/branch of the XML files. If None, it is determined from `top_dir`
+    row_writer : ParquetRowWriter, optional
+        Also write rows to this as they are added, with XML_NTUPLE_DIR_INFO_COLUMNS
 
     Raises
     ------
     IOError
         If `top_dir` doesn't exist
     """
-    if not os.path.isdir(top_dir):
+    if xml_filenames is None and not os.path.isdir(top_dir):
         raise IOError("%s does not exist" % top_dir)
-    xml_ntuple_dir_table_maker = SQLTable(table_name)
+    git_source = git_source or get_git_source(top_dir)
+    xml_ntuple_dir_table_maker = SQLTable("xml_ntuple_dir")
     xml_ntuple_dir_table_maker.create_connection(path=output_filename)
+    init_catalogue(xml_ntuple_dir_table_maker.connection)
     if not append:
-        xml_ntuple_dir_table_fields = [
-            "xml_filepath TEXT NOT NULL",
-            "ntuple_dir TEXT NOT NULL",
-            "size FLOAT",
-            "user TEXT",
-            "creation_time TEXT"
-        ]
-        xml_ntuple_dir_table_maker.create_table(table_fields=xml_ntuple_dir_table_fields)
-
-    xml_ntuple_dir_generator = XMLNtupleDirDataGenerator(top_dir=top_dir)
+        xml_ntuple_dir_table_maker.execute_query("DELETE FROM xml_ntuple_dir;")
+    xml_info = {row[0]: row[1:] for row in xml_ntuple_dir_table_maker.connection.execute(
+                "SELECT id, git_src, branch, year, filepath FROM xml WHERE git_src = ?", (git_source,))}
+    xml_ids = {info[-1]: xml_id for xml_id, info in xml_info.items()}
+
+    def _make_info_row(row):
+        # like a row of the xml_ntuple_dir_info view
+        info = dict(zip(["git_src", "branch", "year", "xml_filepath"], xml_info[row["xml_id"]]))
+        info.update((c, row[c]) for c in ["ntuple_dir", "size", "user", "creation_time"])
+        return info
+
+    xml_ntuple_dir_generator = XMLNtupleDirDataGenerator(top_dir=top_dir,
+                                                         xml_cache=xml_cache,
+                                                         jobs=jobs,
+                                                         io_budget=io_budget,
+                                                         xml_filenames=xml_filenames,
+                                                         xml_reader=xml_reader,
+                                                         snapshot_filename=snapshot_filename)
     print("Filling xml ntuple dir table...")
-    xml_ntuple_dir_table_maker.fill_table(xml_ntuple_dir_generator)
+    # Before pipelined_load() starts its writer thread
+    pool = xml_ntuple_dir_generator.make_pool()
+    try:
+        rows = with_xml_ids(xml_ntuple_dir_generator.iter_rows(pool), xml_ids)
+        xml_ntuple_dir_table_maker.pipelined_load(rows, key_columns=XML_NTUPLE_DIR_TABLE_KEY,
+                                                  row_writer=row_writer, row_func=_make_info_row)
+    finally:
+        # in case the rows weren't all used, e.g. if writing failed
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def with_xml_ids(xml_ntuple_dir_data, xml_ids):
+    """Replace xml_filepath in each row from XMLNtupleDirDataGenerator with the id of the XML in the xml table
 
+    Parameters
+    ----------
+    xml_ntuple_dir_data : iterable[dict]
+    xml_ids : dict[str, int]
+        XML filepath -> id
 
-def create_tables(top_dir, output_filename, append):
+    Yields
+    ------
+    dict
+
+    Raises
+    ------
+    KeyError
+        If an XML file isn't in `xml_ids`
+    """
+    for data in xml_ntuple_dir_data:
+        data = dict(data)
+        xml_filepath = data.pop('xml_filepath')
+        if xml_filepath not in xml_ids:
+            raise KeyError("%s is not in the xml table, need to add it first" % xml_filepath)
+        data['xml_id'] = xml_ids[xml_filepath]
+        yield data
+
+
+def create_tables(top_dir, output_filename, append, xml_cache=None, jobs=1, io_budget=DEFAULT_IO_BUDGET,
+                  snapshot_filename=None, row_writer=None):
     """Over-arching method to create all the tables"""
     create_xml_table(top_dir=top_dir, output_filename=output_filename, append=append)
-    create_xml_ntuple_dir_table(top_dir=top_dir, output_filename=output_filename, append=append)
+    create_xml_ntuple_dir_table(top_dir=top_dir, output_filename=output_filename, append=append,
+                                xml_cache=xml_cache, jobs=jobs, io_budget=io_budget,
+                                snapshot_filename=snapshot_filename, row_writer=row_writer)
+    # Store commit so that later we can do incremental updates
+    pwd = os.getcwd()
+    os.chdir(top_dir)
+    commit = get_git_head_commit()
+    os.chdir(pwd)
+    set_last_scanned_commit(output_filename, get_git_source(top_dir), commit)
 
 
-def make_tables_for_legacy_branches(output_filename, append=True):
+def update_tables(top_dir, output_filename, xml_cache=None, jobs=1, io_budget=DEFAULT_IO_BUDGET,
+                  snapshot_filename=None):
+    """Incrementally update tables, only re-scanning XML files that have changed
+    in git since the last scan of this git source (repo/branch).
+
+    If there is no record of a previous scan, then all entries for this
+    git source are replaced.
+
+    Note that only committed changes are considered.
+
+    Parameters
+    ----------
+    top_dir : str
+        Top directory to start looking for XML files, must be in a git repo
+    output_filename : str
+        Output SQL filename
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of worker processes for parsing XMLs & getting directory sizes
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, per worker
+    snapshot_filename : str, optional
+        SQLite file from namespace_snapshot.py to look up ntuple directories in
+    """
+    if not os.path.isdir(top_dir):
+        raise IOError("%s does not exist" % top_dir)
+    git_source = get_git_source(top_dir)
+    pwd = os.getcwd()
+    os.chdir(top_dir)
+    head_commit = get_git_head_commit()
+    os.chdir(pwd)
+
+    xml_table_maker = SQLTable("xml")
+    xml_table_maker.create_connection(path=output_filename)
+    init_catalogue(xml_table_maker.connection)
+
+    last_commit = get_last_scanned_commit(output_filename, git_source)
+    if last_commit is None:
+        print("No previous scan of", git_source, "in", output_filename, "- scanning all XML files")
+        to_remove = [r[0] for r in xml_table_maker.connection.execute(
+                     "SELECT filepath FROM xml WHERE git_src = ?", (git_source,))]
+        to_add = list(find_xml_filenames(top_dir))
+    elif last_commit == head_commit:
+        print("Already scanned", git_source, "at", head_commit, "- nothing to do")
+        return
+    else:
+        to_remove, to_add = get_changed_xml_files(top_dir, last_commit, head_commit)
+        print("Changes in", git_source, "between", last_commit, "and", head_commit, ":",
+              len(set(to_add) - set(to_remove)), "added,",
+              len(set(to_add) & set(to_remove)), "modified,",
+              len(set(to_remove) - set(to_add)), "removed XML files")
+
+    print("Removing entries for", len(to_remove), "XML files")
+    # their xml_ntuple_dir entries are deleted too, by the foreign key
+    with xml_table_maker.connection:
+        xml_table_maker.connection.executemany("DELETE FROM xml WHERE git_src = ? AND filepath = ?",
+                                               [(git_source, x) for x in to_remove])
+
+    # Only add files that still exist on disk, in case the working tree is
+    # behind HEAD or has uncommitted deletions
+    to_add = [x for x in to_add if os.path.isfile(os.path.join(top_dir, x))]
+    print("Adding entries for", len(to_add), "XML files")
+    create_xml_table(top_dir=top_dir, output_filename=output_filename,
+                     append=True, xml_filenames=to_add, git_source=git_source)
+    create_xml_ntuple_dir_table(top_dir=top_dir, output_filename=output_filename,
+                                append=True, xml_cache=xml_cache, jobs=jobs, io_budget=io_budget,
+                                xml_filenames=to_add, snapshot_filename=snapshot_filename,
+                                git_source=git_source)
+    set_last_scanned_commit(output_filename, git_source, head_commit)
+
+
+def make_tables_for_legacy_branches(output_filename, append=True, xml_cache=None,
+                                    jobs=1, io_budget=DEFAULT_IO_BUDGET, snapshot_filename=None, row_writer=None):
     """Main function to make tables for XML files in UHH2/common/datasets,
     iterating through all the relevant branches. For each, we checkout the code,
     then scan over the XMLs in common/datasets.
@@ -501,6 +1296,16 @@ def make_tables_for_legacy_branches(output_filename, append=True):
     append : bool, optional
         If True, and the table already exists in `output_filename`,
         then append entries. Otherwise empty table first.
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of worker processes for parsing XMLs & getting directory sizes
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, per worker
+    snapshot_filename : str, optional
+        SQLite file from namespace_snapshot.py to look up ntuple directories in
+    row_writer : ParquetRowWriter, optional
+        Also write xml_ntuple_dir rows to this as they are added
     """
     # Setup UHH2 in clean directory avoid any contamination
     output_filename = os.path.abspath(output_filename)
@@ -537,7 +1342,71 @@ def make_tables_for_legacy_branches(output_filename, append=True):
                          append=this_append)
         create_xml_ntuple_dir_table(top_dir="common/datasets",
                                     output_filename=output_filename,
-                                    append=this_append)
+                                    append=this_append,
+                                    xml_cache=xml_cache,
+                                    jobs=jobs,
+                                    io_budget=io_budget,
+                                    snapshot_filename=snapshot_filename,
+                                    row_writer=row_writer)
+
+
+def make_tables_for_legacy_branches_from_git_objects(output_filename, append=True,
+                                                     jobs=1, io_budget=DEFAULT_IO_BUDGET, snapshot_filename=None,
+                                                     row_writer=None):
+    """Same as make_tables_for_legacy_branches(), but reads XML files in
+    common/datasets straight from git objects in a bare mirror of UHH2,
+    instead of checking out each branch. XMLs that are the same in several
+    branches are only parsed once.
+
+    Parameters
+    ----------
+    output_filename : str
+        Name of output SQL file
+    append : bool, optional
+        If True, and the table already exists in `output_filename`,
+        then append entries. Otherwise empty table first.
+    jobs : int, optional
+        Number of worker processes for getting directory sizes
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, per worker
+    snapshot_filename : str, optional
+        SQLite file from namespace_snapshot.py to look up ntuple directories in
+    row_writer : ParquetRowWriter, optional
+        Also write xml_ntuple_dir rows to this as they are added
+    """
+    output_filename = os.path.abspath(output_filename)
+    if not append and os.path.isfile(output_filename):
+        os.remove(output_filename)
+
+    branches, blobs_per_branch = finder.get_legacy_branch_xml_blobs()
+    repo_name = os.path.basename(finder.UHH2_REPO_URL).replace(".git", "")
+    top_dir = "common/datasets"
+    with GitXMLRecords(finder.MIRROR_DIRNAME) as xml_records:
+        for ind, (branch, blobs) in enumerate(zip(branches, blobs_per_branch)):
+            this_append = ((ind == 0) and append) or (ind != 0)
+            blob_shas = dict(blobs)  # XML path in repo -> SHA
+            xml_paths = [os.path.relpath(xml_path, top_dir) for xml_path, sha in blobs]
+
+            def _reader(xml_filename):
+                return xml_records.get_ntuple_filenames(blob_shas[xml_filename])
+
+            git_source = "%s/%s" % (repo_name, branch)
+            create_xml_table(top_dir=top_dir,
+                             output_filename=output_filename,
+                             append=this_append,
+                             xml_filenames=xml_paths,
+                             git_source=git_source)
+            create_xml_ntuple_dir_table(top_dir=top_dir,
+                                        output_filename=output_filename,
+                                        append=this_append,
+                                        jobs=jobs,
+                                        io_budget=io_budget,
+                                        xml_filenames=xml_paths,
+                                        xml_reader=_reader,
+                                        snapshot_filename=snapshot_filename,
+                                        git_source=git_source,
+                                        row_writer=row_writer)
+        xml_records.print_stats()
 
 
 if __name__ == "__main__":
@@ -560,15 +1429,91 @@ if __name__ == "__main__":
                         action='store_true',
                         help="If True, append data to existing table in --output, if one exists. "
                              "Otherwise, overwrites tables contents")
+    parser.add_argument("--xmlCache",
+                        help="SQLite file to cache parsed XML files in, "
+                             "so only changed XMLs are re-parsed on the next run")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes to parse XMLs & get directory sizes")
+    parser.add_argument("--incremental",
+                        action='store_true',
+                        help="Only update entries for XML files that changed in git since the last "
+                             "scan stored in --output. Only works with --uhh2datasetsDir.")
+    parser.add_argument("--gitObjects",
+                        action='store_true',
+                        help="With --legacy, read XMLs straight from git objects in a bare mirror "
+                             "of UHH2 instead of checking out each branch")
+    parser.add_argument("--ioBudget",
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help="Maximum number of filesystem operations per second, per worker. "
+                             "0 for no limit")
+    parser.add_argument("--snapshot",
+                        help="SQLite file from namespace_snapshot.py to look up ntuple directories in, "
+                             "instead of scanning them on disk")
+    parser.add_argument("--parquet",
+                        help="Also write the ntuple directory rows found in this run to this Parquet file "
+                             "(needs pyarrow), as they are added. Same columns as "
+                             "parquet_export.py's xml_ntuple_dir.parquet.")
     args = parser.parse_args()
     if not os.path.isfile(args.output) and args.append:
         print("Output does not exist, setting --append False")
         args.append = False
 
-    if args.uhh2datasetsDir:
-        create_tables(top_dir=args.uhh2datasetsDir,
-                      output_filename=args.output,
-                      append=args.append)
-    elif args.legacy:
-        make_tables_for_legacy_branches(output_filename=args.output,
-                                        append=args.append)
+    xml_cache = XMLCache(os.path.abspath(args.xmlCache)) if args.xmlCache else None
+    # the legacy modes change directory
+    snapshot_filename = os.path.abspath(args.snapshot) if args.snapshot else None
+
+    if args.incremental and args.legacy:
+        parser.error("--incremental only works with --uhh2datasetsDir")
+    if args.incremental and args.parquet:
+        parser.error("--parquet would only have the changed entries with --incremental, "
+                     "use parquet_export.py afterwards instead")
+    row_writer = None
+    if args.parquet:
+        row_writer = ParquetRowWriter(os.path.abspath(args.parquet), XML_NTUPLE_DIR_INFO_COLUMNS,
+                                      column_types=CATALOGUE_COLUMN_TYPES)
+
+    try:
+        if args.uhh2datasetsDir and args.incremental:
+            update_tables(top_dir=args.uhh2datasetsDir,
+                          output_filename=args.output,
+                          xml_cache=xml_cache,
+                          jobs=args.jobs,
+                          io_budget=args.ioBudget,
+                          snapshot_filename=snapshot_filename)
+        elif args.uhh2datasetsDir:
+            create_tables(top_dir=args.uhh2datasetsDir,
+                          output_filename=args.output,
+                          append=args.append,
+                          xml_cache=xml_cache,
+                          jobs=args.jobs,
+                          io_budget=args.ioBudget,
+                          snapshot_filename=snapshot_filename,
+                          row_writer=row_writer)
+        elif args.legacy and args.gitObjects:
+            make_tables_for_legacy_branches_from_git_objects(output_filename=args.output,
+                                                             append=args.append,
+                                                             jobs=args.jobs,
+                                                             io_budget=args.ioBudget,
+                                                             snapshot_filename=snapshot_filename,
+                                                             row_writer=row_writer)
+        elif args.legacy:
+            make_tables_for_legacy_branches(output_filename=args.output,
+                                            append=args.append,
+                                            xml_cache=xml_cache,
+                                            jobs=args.jobs,
+                                            io_budget=args.ioBudget,
+                                            snapshot_filename=snapshot_filename,
+                                            row_writer=row_writer)
+    except Exception:
+        if row_writer is not None:
+            row_writer.abort()
+        raise
+    if row_writer is not None:
+        row_writer.close()
+
+    if xml_cache:
+        xml_cache.close()
+        xml_cache.print_stats()
@@ -11,54 +11,68 @@ from __future__ import print_function
 
 import os
 import sys
+import csv
+import time
 import argparse
+import threading
 import pandas as pd
 import numpy as np
-from time import sleep
-import re
+from stat import S_ISREG, S_ISDIR, S_IFREG
+from operator import itemgetter
+from collections import namedtuple
 
+from xml_cache import XMLCache, cached_ntuple_filenames
+from fs_utils import StatEngine, RateLimiter, atomic_output, stat_or_none, DEFAULT_STAT_JOBS, DEFAULT_IO_BUDGET
+from namespace_snapshot import NamespaceSnapshot, MIN_AGE
+from parquet_export import ParquetRowWriter, load_parquet, get_parquet_columns
 
-def get_ntuple_filenames_from_xml(full_filename):
-    """Yield ntuple filenames from XML file
 
-    Parameters
-    ----------
-    full_filename : str
-        XML file to get ntuples from
+# Columns in the output CSV/Parquet file
+NTUPLE_COLUMNS = ["xmldir", "ntuple", "size", "user", "year"]
 
-    Yields
-    ------
-    generator
-        To iterate over filenames
+# Columns with few distinct values, stored as integer codes
+CATEGORICAL_COLUMNS = ["xmldir", "user", "year"]
+
+# Types of non-string columns, for ParquetRowWriter
+NTUPLE_COLUMN_TYPES = {"size": "float64"}
+
+# Number of ntuples per chunk in NtupleAccumulator
+DEFAULT_CHUNK_SIZE = 100000
+
+MB = 1024.0 * 1024.0
+
+# Histogram bins per factor of 10 in size, for approximate quantiles in SummaryAccumulator.
+# Quantiles are then within ~2.5% of the true value.
+HISTOGRAM_BINS_PER_DECADE = 50
+
+
+class Baseline(namedtuple("Baseline", ["sizes", "missing", "dir_mtimes"])):
+    """Results of a previous run, from load_baseline()
+
+    sizes : dict[str, float]
+        Ntuple filename -> size (MB)
+    missing : set[str]
+        Ntuple filenames that were missing
+    dir_mtimes : dict[str, float]
+        Ntuple directory -> mtime when it was checked
     """
-    with open(filename) as f:
-        is_comment = False
-        fname_pattern = r'< ?In FileName="(.+)" Lumi="0\.0" ?\/>'
-        for line in f:
-            line = line.strip()
-            if line.startswith("<!--"):
-                is_comment = True
-            if line.endswith("-->"):
-                is_comment = False
-                continue
-            if is_comment:
-                continue
+    __slots__ = ()
 
-            match = re.search(fname_pattern, line.strip())
-            if match is None:
-                continue
-            else:
-                fname = match.group(1)
-                yield fname
+
+class BaselineStat(namedtuple("BaselineStat", ["st_mode", "st_size"])):
+    """Stat info for an ntuple from a previous run, with the same attribute names as os.stat_result"""
+    __slots__ = ()
 
 
-def get_ntuples_from_xml_files(top_directory):
+def get_ntuples_from_xml_files(top_directory, xml_cache=None):
     """Get iterator over ntuples in XML files in a directory.
     Looks recursively through directories for XML files.
 
     Parameters
     ----------
     top_directory : str
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
 
     Yields
     ------
@@ -67,10 +81,11 @@ def get_ntuples_from_xml_files(top_directory):
     """
     for (dirpath, dirnames, filenames) in os.walk(top_directory):
         print("Looking in", dirpath)
-        for filename in filenames:
+        dirnames.sort()  # so the order is always the same
+        for filename in sorted(filenames):
             full_filename = os.path.join(dirpath, filename)
             rel_path = os.path.relpath(full_filename, top_directory)
-            ntuple_iter = get_ntuple_filenames_from_xml(full_filename)
+            ntuple_iter = cached_ntuple_filenames(full_filename, xml_cache)
             yield rel_path, ntuple_iter
 
 
@@ -130,7 +145,461 @@ def get_year_from_dir(dirname):
         return parts[0]
 
 
-def get_all_data(top_dir, missing_filename):
+def iter_ntuples_with_xml(top_dir, xml_cache=None):
+    """Flatten get_ntuples_from_xml_files() into (XML relative path, ntuple filename) pairs"""
+    for xml_rel_path, ntuple_iter in get_ntuples_from_xml_files(top_dir, xml_cache):
+        for ntuple_filename in ntuple_iter:
+            yield xml_rel_path, ntuple_filename
+
+
+class NtupleAccumulator(object):
+    """Collect ntuple info in fixed-size chunks of typed arrays, instead of a dict per ntuple.
+
+    Sizes are stored in a float64 array, and xmldir, user & year as int32
+    codes into a list of the distinct values, so each distinct string is
+    only stored once. When a chunk is full, it is turned into a DataFrame
+    (with categorical columns) and passed to each of `sinks`, e.g. to append
+    it to a CSV file. Memory use therefore doesn't grow with the number of
+    ntuples, apart from the distinct values.
+
+    If there are no sinks, the chunks are kept, and can be combined with to_dataframe().
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, sinks=None):
+        """
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Number of ntuples per chunk
+        sinks : list[callable], optional
+            Functions to call with each chunk (a pandas DataFrame)
+        """
+        self.chunk_size = chunk_size
+        self.sinks = sinks or []
+        self.chunks = []  # only used if there are no sinks
+        self.categories = {c: [] for c in CATEGORICAL_COLUMNS}
+        self._category_codes = {c: {} for c in CATEGORICAL_COLUMNS}
+        self.n_rows = 0
+        self.n_chunks = 0
+        self.first_chunk = None
+        self.last_chunk = None
+        # running totals of sizes, for summary()
+        self.total_size = 0.
+        self.total_size_sq = 0.
+        self.min_size = None
+        self.max_size = None
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._n = 0
+        self._sizes = np.empty(self.chunk_size, dtype=np.float64)
+        self._codes = {c: np.empty(self.chunk_size, dtype=np.int32) for c in CATEGORICAL_COLUMNS}
+        self._ntuples = []
+
+    def _get_code(self, column, value):
+        if value is None:
+            return -1  # NaN in a pandas Categorical
+        codes = self._category_codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = len(self.categories[column])
+            codes[value] = code
+            self.categories[column].append(value)
+        return code
+
+    def add(self, xmldir, ntuple, size, user, year):
+        """Add info for one ntuple. `size` is in MB."""
+        n = self._n
+        self._sizes[n] = size
+        self._codes["xmldir"][n] = self._get_code("xmldir", xmldir)
+        self._codes["user"][n] = self._get_code("user", user)
+        self._codes["year"][n] = self._get_code("year", year)
+        self._ntuples.append(ntuple)
+        self._n += 1
+        if self._n == self.chunk_size:
+            self.flush()
+
+    def add_missing(self, xmldir, ntuple, user, year):
+        """Missing ntuples are only saved in the missing file"""
+        pass
+
+    def flush(self):
+        """Pass the current chunk to the sinks & start a new one"""
+        if self._n == 0:
+            return
+        n = self._n
+        columns = {
+            "ntuple": self._ntuples,
+            "size": self._sizes[:n],
+        }
+        for c in CATEGORICAL_COLUMNS:
+            columns[c] = pd.Categorical.from_codes(self._codes[c][:n], categories=list(self.categories[c]))
+        chunk = pd.DataFrame(columns, columns=NTUPLE_COLUMNS,
+                             index=pd.RangeIndex(self.n_rows, self.n_rows + n))
+        sizes = self._sizes[:n]
+        self.total_size += sizes.sum()
+        self.total_size_sq += np.square(sizes).sum()
+        self.min_size = sizes.min() if self.min_size is None else min(self.min_size, sizes.min())
+        self.max_size = sizes.max() if self.max_size is None else max(self.max_size, sizes.max())
+        self.n_rows += n
+        self.n_chunks += 1
+        if self.first_chunk is None:
+            self.first_chunk = chunk.head()
+        self.last_chunk = chunk
+        for sink in self.sinks:
+            sink(chunk)
+        if not self.sinks:
+            self.chunks.append(chunk)
+        self._new_chunk()
+
+    def size_summary(self):
+        """Summary of ntuple sizes (MB), like DataFrame.describe() but without quantiles
+
+        Returns
+        -------
+        pandas.Series
+        """
+        n = self.n_rows
+        mean = self.total_size / n if n else np.nan
+        std = np.sqrt(max(0., (self.total_size_sq - n * mean * mean) / (n - 1))) if n > 1 else np.nan
+        return pd.Series([n, mean, std, self.min_size, self.max_size, self.total_size],
+                         index=["count", "mean", "std", "min", "max", "total"], name="size")
+
+    def to_dataframe(self):
+        """Combine all chunks into one DataFrame (only if there are no sinks)"""
+        self.flush()
+        if not self.chunks:
+            return pd.DataFrame(columns=NTUPLE_COLUMNS)
+        df = pd.concat(self.chunks)
+        for c in CATEGORICAL_COLUMNS:
+            # chunks have different categories, since new values are added as they are found
+            df[c] = pd.Categorical(df[c].astype(object), categories=self.categories[c])
+        return df
+
+
+class SizeAggregate(object):
+    """Running count, total, min & max of ntuple sizes, and optionally
+    a histogram of log(size) for approximate quantiles.
+
+    The histogram only has entries for bins that have been filled,
+    so its size depends on the range of sizes, not the number of ntuples.
+    """
+
+    __slots__ = ["count", "missing", "total", "min", "max", "histogram", "n_zero"]
+
+    def __init__(self, histogram=False):
+        self.count = 0
+        self.missing = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+        self.histogram = {} if histogram else None  # bin -> count
+        self.n_zero = 0  # sizes that can't go in the log histogram
+
+    def add(self, size):
+        self.count += 1
+        self.total += size
+        if self.min is None or size < self.min:
+            self.min = size
+        if self.max is None or size > self.max:
+            self.max = size
+        if self.histogram is not None:
+            if size > 0:
+                b = int(np.floor(np.log10(size) * HISTOGRAM_BINS_PER_DECADE))
+                self.histogram[b] = self.histogram.get(b, 0) + 1
+            else:
+                self.n_zero += 1
+
+    def quantile(self, q):
+        """Approximate `q` quantile of sizes, from the histogram
+
+        Returns the middle of the bin that it falls in, which is within half
+        a bin width of the true value.
+        """
+        if self.histogram is None:
+            raise ValueError("No histogram, so can't get quantiles")
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)  # position in sorted sizes, as for numpy.quantile()
+        if rank < self.n_zero:
+            return 0.
+        cumulative = self.n_zero
+        for b in sorted(self.histogram):
+            cumulative += self.histogram[b]
+            if rank < cumulative:
+                value = 10 ** ((b + 0.5) / HISTOGRAM_BINS_PER_DECADE)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class SummaryAccumulator(object):
+    """Collect totals of ntuple sizes for each user, year & xmldir, instead of info for each ntuple.
+
+    Has the same add() & flush() as NtupleAccumulator, so it can be passed to get_all_data().
+    Memory use depends only on the number of users, years & xmldirs.
+    """
+
+    def __init__(self, group_columns=CATEGORICAL_COLUMNS, quantiles=None):
+        """
+        Parameters
+        ----------
+        group_columns : list[str], optional
+            Columns to make totals for each value of
+        quantiles : list[float], optional
+            Approximate quantiles of size to calculate, e.g. [0.5, 0.9]
+        """
+        self.group_columns = list(group_columns)
+        self.quantiles = list(quantiles or [])
+        self.overall = self._new_aggregate()
+        self.groups = {c: {} for c in self.group_columns}
+        self.n_rows = 0
+
+    def _new_aggregate(self):
+        return SizeAggregate(histogram=bool(self.quantiles))
+
+    def _get_aggregates(self, values):
+        yield self.overall
+        for column in self.group_columns:
+            groups = self.groups[column]
+            value = values[column]
+            aggregate = groups.get(value)
+            if aggregate is None:
+                aggregate = groups[value] = self._new_aggregate()
+            yield aggregate
+
+    def add(self, xmldir, ntuple, size, user, year):
+        """Add info for one ntuple. `size` is in MB."""
+        for aggregate in self._get_aggregates({"xmldir": xmldir, "user": user, "year": year}):
+            aggregate.add(size)
+        self.n_rows += 1
+
+    def add_missing(self, xmldir, ntuple, user, year):
+        for aggregate in self._get_aggregates({"xmldir": xmldir, "user": user, "year": year}):
+            aggregate.missing += 1
+
+    def flush(self):
+        pass
+
+    def to_dataframe(self):
+        """Make table of totals, with a row for all ntuples, then one for each group
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns are group_by, group, count, missing, total, mean, min, max,
+            and p<N> for each quantile, with sizes in MB
+        """
+        rows = [("all", None, self.overall)]
+        for column in self.group_columns:
+            groups = self.groups[column]
+            # None (e.g. user not found) goes last
+            for value in sorted(groups, key=lambda v: (v is None, v)):
+                rows.append((column, value, groups[value]))
+        quantile_columns = ["p%g" % (100 * q) for q in self.quantiles]
+        columns = ["group_by", "group", "count", "missing", "total", "mean", "min", "max"] + quantile_columns
+        data = []
+        for group_by, group, aggregate in rows:
+            n = aggregate.count
+            row = [group_by, group, n, aggregate.missing, aggregate.total,
+                   aggregate.total / n if n else np.nan,
+                   aggregate.min if n else np.nan,
+                   aggregate.max if n else np.nan]
+            row += [aggregate.quantile(q) for q in self.quantiles]
+            data.append(row)
+        return pd.DataFrame(data, columns=columns)
+
+
+def get_summary_filename(csv_filename):
+    """Get name of the table of totals from dataset_summary(), so it doesn't replace the CSV file"""
+    stem, ext = os.path.splitext(csv_filename)
+    return stem + "_summary" + (ext or ".csv")
+
+
+def get_output_filenames(csv_filename):
+    """Get names of the files saved alongside the CSV file
+
+    Returns
+    -------
+    (str, str)
+        Missing ntuples file, directory mtimes file
+    """
+    stem = os.path.splitext(csv_filename)[0]
+    return stem + "_missing.txt", stem + "_dirs.csv"
+
+
+def read_missing_file(missing_filename):
+    """Get ntuple filenames from a missing ntuple file written by get_all_data()
+
+    Returns
+    -------
+    set[str]
+    """
+    missing = set()
+    separator = "-"*10
+    in_header = False
+    with open(missing_filename) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == separator:
+                # separators go either side of each XML name
+                in_header = not in_header
+            elif line and not in_header:
+                missing.add(line)
+    return missing
+
+
+def load_baseline(filename):
+    """Load results of a previous run, to use with get_all_data(baseline=...)
+
+    Parameters
+    ----------
+    filename : str
+        CSV file, or Parquet file (from --parquet). The missing ntuples & directory
+        mtimes files are found from its name, like for the CSV file.
+
+    Returns
+    -------
+    Baseline
+    """
+    if not os.path.isfile(filename):
+        raise IOError("%s does not exist" % filename)
+    print("Loading baseline from", filename)
+    is_parquet = os.path.splitext(filename)[1] == ".parquet"
+    columns = get_parquet_columns(filename) if is_parquet else list(pd.read_csv(filename, nrows=0).columns)
+    if "group_by" in columns:
+        raise ValueError("%s is a table of totals from --summaryOnly, not info for each ntuple, "
+                         "so can't be used as a baseline" % filename)
+    if "ntuple" not in columns or "size" not in columns:
+        raise ValueError("%s doesn't have ntuple & size columns, so can't be used as a baseline" % filename)
+    if is_parquet:
+        df = load_parquet(filename, columns=["ntuple", "size"]).to_pandas()
+    else:
+        df = pd.read_csv(filename, usecols=["ntuple", "size"])
+    sizes = dict(zip(df["ntuple"], df["size"]))
+    del df
+
+    missing_filename, dirs_filename = get_output_filenames(filename)
+    missing = set()
+    if os.path.isfile(missing_filename):
+        missing = read_missing_file(missing_filename)
+    else:
+        print("No", missing_filename, "- missing ntuples will be checked again")
+
+    dir_mtimes = {}
+    if os.path.isfile(dirs_filename):
+        with open(dirs_filename) as f:
+            dir_mtimes = {dirname: float(mtime) for dirname, mtime in csv.reader(f)}
+    else:
+        print("No", dirs_filename, "- no results can be reused (make it with --saveDirMtimes)")
+    print("Baseline has %d ntuples, %d missing ntuples, %d directories" % (len(sizes), len(missing), len(dir_mtimes)))
+    return Baseline(sizes, missing, dir_mtimes)
+
+
+class IncrementalStat(object):
+    """Stat ntuples, reusing results from a previous run for ntuples whose directory hasn't changed.
+
+    A directory's mtime changes whenever an entry is added, removed or renamed
+    in it. So if an ntuple directory has the same mtime as in the previous run,
+    ntuples that were there still are (ntuples aren't rewritten in place, so
+    with the same size), and ntuples that were missing are still missing.
+    Only the directory needs to be stat-ed, not each ntuple in it.
+
+    The mtime of each ntuple directory is recorded (see save_dir_mtimes()), so
+    that this run can be the baseline for the next one. This costs one extra
+    stat per ntuple directory, so is only done if asked for.
+
+    Thread-safe, so can be used as the `stat_func` of a StatEngine.
+    """
+
+    def __init__(self, baseline=None, stat_func=None, io_budget=DEFAULT_IO_BUDGET):
+        """
+        Parameters
+        ----------
+        baseline : Baseline, optional
+            Results of a previous run, from load_baseline()
+        stat_func : callable, optional
+            Function to get stat result for a path, or None if it doesn't exist.
+            Defaults to os.stat().
+        io_budget : float, optional
+            Maximum number of stat calls per second, in total
+        """
+        self.baseline = baseline or Baseline({}, set(), {})
+        self.stat_func = stat_func or stat_or_none
+        self.limiter = RateLimiter(io_budget)
+        self.dir_mtimes = {}  # None if directory doesn't exist
+        self._untrusted_dirs = set()  # modified too recently to rely on mtime next time
+        self._dir_events = {}  # set once the directory's mtime is in dir_mtimes
+        self._lock = threading.Lock()  # only held briefly, never while doing IO
+        self.n_reused = 0
+        self.n_dir_stats = 0
+        self.n_file_stats = 0
+
+    def _stat(self, path):
+        self.limiter.acquire()
+        return self.stat_func(path)
+
+    def _get_dir_mtime(self, dirname):
+        # The first thread to need a directory stats it. Any others wait for it,
+        # so the mtime is always from before any ntuple in the directory was checked,
+        # but threads working on other directories carry on.
+        with self._lock:
+            event = self._dir_events.get(dirname)
+            is_first = event is None
+            if is_first:
+                event = self._dir_events[dirname] = threading.Event()
+        if not is_first:
+            event.wait()
+            return self.dir_mtimes.get(dirname)
+        try:
+            stat = self._stat(dirname)
+            mtime = stat.st_mtime if stat is not None and S_ISDIR(stat.st_mode) else None
+            with self._lock:
+                self.n_dir_stats += 1
+                if mtime is not None and time.time() - mtime <= MIN_AGE:
+                    self._untrusted_dirs.add(dirname)
+                self.dir_mtimes[dirname] = mtime
+        finally:
+            event.set()
+        return mtime
+
+    def __call__(self, path):
+        """Like os.stat(), but returns None if `path` doesn't exist
+
+        Returns
+        -------
+        os.stat_result or BaselineStat
+        """
+        dirname = os.path.dirname(path)
+        dir_mtime = self._get_dir_mtime(dirname)
+        if dir_mtime is None:
+            # no directory, so no ntuple
+            return None
+        if dir_mtime == self.baseline.dir_mtimes.get(dirname):
+            size = self.baseline.sizes.get(path)
+            if size is not None or path in self.baseline.missing:
+                with self._lock:
+                    self.n_reused += 1
+                return BaselineStat(S_IFREG, int(round(size * MB))) if size is not None else None
+        with self._lock:
+            self.n_file_stats += 1
+        return self._stat(path)
+
+    def save_dir_mtimes(self, filename):
+        """Save mtime of each ntuple directory, for load_baseline()"""
+        with atomic_output(filename, "w") as f:
+            writer = csv.writer(f)
+            for dirname in sorted(self.dir_mtimes):
+                mtime = self.dir_mtimes[dirname]
+                if mtime is not None and dirname not in self._untrusted_dirs:
+                    writer.writerow([dirname, repr(mtime)])
+
+    def print_stats(self):
+        print("Reused %d ntuple results from baseline, stat-ed %d ntuples & %d directories"
+              % (self.n_reused, self.n_file_stats, self.n_dir_stats))
+
+
+def get_all_data(top_dir, missing_filename, xml_cache=None, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET,
+                 snapshot=None, accumulator=None, baseline=None, dirs_filename=None):
     """Get all Ntuple data
 
     Parameters
@@ -138,105 +607,256 @@ def get_all_data(top_dir, missing_filename):
     top_dir : str
         Parent directory to look for XML files
     missing_filename : str
-        Name for output missing ntuple file
+        Name for output missing ntuple file. If None, missing ntuples are
+        only passed to the accumulator, not saved.
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of threads to stat ntuples with
+    io_budget : float, optional
+        Maximum number of stat calls per second, in total
+    snapshot : NamespaceSnapshot, optional
+        Look up ntuple files in this snapshot instead of stat-ing them
+    accumulator : NtupleAccumulator or SummaryAccumulator, optional
+        Collects ntuple info. If None, a new NtupleAccumulator is used, that keeps all the info.
+    baseline : Baseline, optional
+        Results of a previous run, from load_baseline(). Ntuples in directories
+        that haven't changed since are not stat-ed again.
+    dirs_filename : str, optional
+        Save mtime of each ntuple directory to this file, so that this run can be used as a baseline.
+        Costs an extra stat per ntuple directory.
 
     Returns
     -------
-    list[dict]
-        List of ntuple info, each entry is a dict
+    NtupleAccumulator
+        Ntuple info
     """
-    data = []
-    # Save missing file info to separate file
-    print("Saving missing file info to", missing_filename)
-    missing_filename_all = os.path.splitext(missing_filename)[0]+"_all"+os.path.splitext(missing_filename)[1]
-    print("Saving completelmy missing file info to", missing_filename_all)
-    with open(missing_filename, "w") as f_missing, open(missing_filename_all, "w") as f_missing_all:
+    if accumulator is None:
+        accumulator = NtupleAccumulator()
+    if missing_filename:
+        # Save missing file info to separate file
+        print("Saving missing file info to", missing_filename)
+        missing_filename_all = os.path.splitext(missing_filename)[0]+"_all"+os.path.splitext(missing_filename)[1]
+        print("Saving completelmy missing file info to", missing_filename_all)
+    else:
+        missing_filename = missing_filename_all = os.devnull
+    if snapshot is not None:
+        # lookups are local, so no need for threads or rate limit
+        jobs = 1
+        io_budget = 0
+    stat_func = snapshot.stat_or_none if snapshot else None
+    if baseline is not None or dirs_filename:
+        # IncrementalStat does the rate limiting, since results from the baseline don't need any IO
+        incremental_stat = IncrementalStat(baseline, stat_func=stat_func, io_budget=io_budget)
+        stat_engine = StatEngine(jobs=jobs, io_budget=0, stat_func=incremental_stat)
+    else:
+        incremental_stat = None
+        stat_engine = StatEngine(jobs=jobs, io_budget=io_budget, stat_func=stat_func)
+    with open(missing_filename, "w") as f_missing, open(missing_filename_all, "w") as f_missing_all, \
+            stat_engine:
         top_dir = os.path.abspath(top_dir)
         counter = 0  # count global num files
-        for ind, (xml_rel_path, ntuple_iter) in enumerate(get_ntuples_from_xml_files(top_dir)):
-            first_time = True
-
-            this_counter = 0  # count files in this xml
-            missing_counter = 0  # count missing files in this xml
-            for ntuple_filename in ntuple_iter:
-
-                this_counter += 1
-                counter += 1 
-
-                if not os.path.isfile(ntuple_filename):
-                    if first_time:
-                        # If it's the first time we encounter this file,
-                        # print it's filename so easier to track down
-                        f_missing.write("-"*10 + "\n")
-                        f_missing.write("%s\n" % xml_rel_path)
-                        f_missing.write("-"*10 + "\n")
-                        first_time = False
-                    f_missing.write(ntuple_filename)
-                    f_missing.write("\n")
-                    missing_counter += 1
-                    continue
-
-                # size = np.random.random() * 100  # dummy data for testing
-                user = get_user_from_filename(ntuple_filename)
-                size = os.path.getsize(ntuple_filename) / (1024.0 * 1024.0)  # to MBytes
-                year = get_year_from_dir(xml_rel_path)
-                data.append({
-                    "xmldir": os.path.dirname(xml_rel_path),
-                    "ntuple": ntuple_filename,
-                    "size": size,
-                    "user": user,
-                    "year": year,
-                })
-
-                # Sleep every so often to avoid too much stress on filesystem
-                if counter % 5000 == 0:
-                    print("Done", counter, ", sleeping for 5s...")
-                    sleep(5)
-            
+
+        def finish_xml(xml_rel_path, this_counter, missing_counter):
             if missing_counter > 0:
                 if missing_counter == this_counter:
                     f_missing_all.write(xml_rel_path+"\n")
                     print("All ntuples in", xml_rel_path, "are missing")
                 else:
                     print("Some but not all ntuples in", xml_rel_path, "are missing")
-    return data
 
+        # Results come back in the same order as the XMLs & their entries,
+        # so we can handle each XML in turn as before
+        current_xml = None
+        this_counter = 0  # count files in this xml
+        missing_counter = 0  # count missing files in this xml
+        ntuple_stats = stat_engine.imap(iter_ntuples_with_xml(top_dir, xml_cache), key=itemgetter(1))
+        for (xml_rel_path, ntuple_filename), stat in ntuple_stats:
+            if xml_rel_path != current_xml:
+                if current_xml is not None:
+                    finish_xml(current_xml, this_counter, missing_counter)
+                current_xml = xml_rel_path
+                first_time = True
+                this_counter = 0
+                missing_counter = 0
+
+            this_counter += 1
+            counter += 1
+
+            user = get_user_from_filename(ntuple_filename)
+            year = get_year_from_dir(xml_rel_path)
+            if stat is None or not S_ISREG(stat.st_mode):
+                accumulator.add_missing(xmldir=os.path.dirname(xml_rel_path),
+                                        ntuple=ntuple_filename,
+                                        user=user,
+                                        year=year)
+                if first_time:
+                    # If it's the first time we encounter this file,
+                    # print it's filename so easier to track down
+                    f_missing.write("-"*10 + "\n")
+                    f_missing.write("%s\n" % xml_rel_path)
+                    f_missing.write("-"*10 + "\n")
+                    first_time = False
+                f_missing.write(ntuple_filename)
+                f_missing.write("\n")
+                missing_counter += 1
+                continue
 
-def dataset_info(top_dir, csv_filename):
+            # size = np.random.random() * 100  # dummy data for testing
+            size = stat.st_size / MB  # to MBytes
+            accumulator.add(xmldir=os.path.dirname(xml_rel_path),
+                            ntuple=ntuple_filename,
+                            size=size,
+                            user=user,
+                            year=year)
+
+            if counter % 5000 == 0:
+                print("Done", counter)
+
+        if current_xml is not None:
+            finish_xml(current_xml, this_counter, missing_counter)
+    accumulator.flush()
+    if dirs_filename:
+        print("Saving ntuple directory mtimes to", dirs_filename)
+        incremental_stat.save_dir_mtimes(dirs_filename)
+    stat_engine.print_stats()
+    if incremental_stat is not None:
+        incremental_stat.print_stats()
+    return accumulator
+
+
+def dataset_info(top_dir, csv_filename, xml_cache=None, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET,
+                 snapshot=None, parquet_filename=None, chunk_size=DEFAULT_CHUNK_SIZE, baseline_filename=None,
+                 save_dir_mtimes=False):
     """Go through all XML files recursively from top_dir, get file info, save to CSV.
 
+    Results are saved in chunks as they are found, so memory use doesn't
+    depend on the number of ntuples.
+
     Parameters
     ----------
     top_dir : str
         Parent directory to look for XML files
     csv_filename : str
         Output CSV filename to use. Also used as template for missing filename.
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of threads to stat ntuples with
+    io_budget : float, optional
+        Maximum number of stat calls per second, in total
+    snapshot : NamespaceSnapshot, optional
+        Look up ntuple files in this snapshot instead of stat-ing them
+    parquet_filename : str, optional
+        Also save to this Parquet file, written in chunks during the scan.
+        Load it with parquet_export.load_parquet().
+    chunk_size : int, optional
+        Number of ntuples to collect before saving them
+    baseline_filename : str, optional
+        CSV or Parquet file from a previous run. Only ntuples that are new, or whose
+        directory has changed since, are stat-ed; the rest are carried forward.
+    save_dir_mtimes : bool, optional
+        Save mtime of each ntuple directory, so that this run can be used as a baseline.
+        Always done if `baseline_filename` is used.
     """
+    # Load before opening the outputs, since they may be the same files
+    baseline = load_baseline(baseline_filename) if baseline_filename else None
     # To save missing file info to separate file
-    missing_file = os.path.splitext(csv_filename)[0]
-    missing_file = missing_file + "_missing.txt"
-    data = get_all_data(top_dir=top_dir, missing_filename=missing_file)
-    print("Saving to dataframe & CSV...")
-
-    # Convert to pandas dataframe, makes life easier
-    df = pd.DataFrame(data)
-    df['user'] = df['user'].astype('category')
-    df['xmldir'] = df['xmldir'].astype('category')
-    df['year'] = df['year'].astype('category')
+    missing_file, dirs_file = get_output_filenames(csv_filename)
+    print("Saving to CSV in chunks of", chunk_size, "ntuples")
+    row_writer = None
+    if parquet_filename:
+        row_writer = ParquetRowWriter(parquet_filename, NTUPLE_COLUMNS, column_types=NTUPLE_COLUMN_TYPES)
+    try:
+        with open(csv_filename, "w") as f_csv:
+
+            def _write_csv(chunk):
+                chunk.to_csv(f_csv, header=(f_csv.tell() == 0))
+
+            sinks = [_write_csv]
+            if row_writer is not None:
+                sinks.append(lambda chunk: row_writer.add_columns(chunk))
+            accumulator = NtupleAccumulator(chunk_size=chunk_size, sinks=sinks)
+            get_all_data(top_dir=top_dir, missing_filename=missing_file, xml_cache=xml_cache,
+                         jobs=jobs, io_budget=io_budget, snapshot=snapshot, accumulator=accumulator,
+                         baseline=baseline,
+                         dirs_filename=dirs_file if (baseline is not None or save_dir_mtimes) else None)
+            if accumulator.n_rows == 0:
+                _write_csv(pd.DataFrame(columns=NTUPLE_COLUMNS))
+    except Exception:
+        if row_writer is not None:
+            row_writer.abort()
+        raise
+    if row_writer is not None:
+        row_writer.close()
 
     # Print out bits of dataframe to check sane
-    print(df.head())
-    print(df.tail())
-    print("Dataframe column dtypes:")
-    print(df.dtypes)
-    print("Dataframe describe():")
-    print(df.describe())
-    print("Memory usage:")
-    print(df.memory_usage(deep=True))
-    print(len(df.index), "entries in dataframe")
+    if accumulator.n_rows > 0:
+        print(accumulator.first_chunk)
+        print(accumulator.last_chunk.tail())
+        print("Dataframe column dtypes:")
+        print(accumulator.last_chunk.dtypes)
+        print("Size (MB) summary:")
+        print(accumulator.size_summary())
+        print("Memory usage of last chunk:")
+        print(accumulator.last_chunk.memory_usage(deep=True))
+    print(accumulator.n_rows, "entries in", accumulator.n_chunks, "chunks")
+
+
+def dataset_summary(top_dir, summary_filename, xml_cache=None, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET,
+                    snapshot=None, parquet_filename=None, quantiles=None, baseline_filename=None):
+    """Like dataset_info(), but only save total size, count, etc of ntuples
+    for each user, year & xmldir, not info for every ntuple.
+
+    Totals are kept up to date during the scan, so memory use only
+    depends on the number of users, years & xmldirs.
+
+    Parameters
+    ----------
+    top_dir : str
+        Parent directory to look for XML files
+    summary_filename : str
+        Output CSV filename for the table of totals, see get_summary_filename()
+    xml_cache : XMLCache, optional
+        Cache of parsed XML files
+    jobs : int, optional
+        Number of threads to stat ntuples with
+    io_budget : float, optional
+        Maximum number of stat calls per second, in total
+    snapshot : NamespaceSnapshot, optional
+        Look up ntuple files in this snapshot instead of stat-ing them
+    parquet_filename : str, optional
+        Also save table to this Parquet file
+    quantiles : list[float], optional
+        Also calculate these approximate quantiles of size, e.g. [0.5, 0.9]
+    baseline_filename : str, optional
+        CSV or Parquet file from a previous dataset_info() run, see dataset_info()
 
-    # Save it to CSV
-    df.to_csv(csv_filename)
+    Returns
+    -------
+    pandas.DataFrame
+        Table of totals, see SummaryAccumulator.to_dataframe()
+    """
+    baseline = load_baseline(baseline_filename) if baseline_filename else None
+    # Missing ntuples are counted in the table, and there are no directory mtimes,
+    # since the output can't be used as a baseline. So the files from dataset_info() are left alone.
+    accumulator = SummaryAccumulator(quantiles=quantiles)
+    get_all_data(top_dir=top_dir, missing_filename=None, xml_cache=xml_cache,
+                 jobs=jobs, io_budget=io_budget, snapshot=snapshot, accumulator=accumulator,
+                 baseline=baseline)
+    df = accumulator.to_dataframe()
+    print("Saving summary to", summary_filename)
+    with atomic_output(summary_filename, "w") as f:
+        df.to_csv(f, index=False)
+    if parquet_filename:
+        column_types = {c: ("int64" if c in ["count", "missing"] else "float64")
+                        for c in df.columns if c not in ["group_by", "group"]}
+        with ParquetRowWriter(parquet_filename, list(df.columns), column_types=column_types) as row_writer:
+            row_writer.add_columns(df)
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(df)
+    print(accumulator.n_rows, "entries")
+    return df
 
 
 if __name__ == "__main__":
@@ -247,8 +867,52 @@ if __name__ == "__main__":
     parser.add_argument("--csv",
                         default="datasetinfo.csv",
                         help="Input/output CSV file.")
+    parser.add_argument("--xmlCache",
+                        help="SQLite file to cache parsed XML files in, "
+                        "so only changed XMLs are re-parsed on the next run.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=DEFAULT_STAT_JOBS,
+                        help="Number of threads to check ntuple files with")
+    parser.add_argument("--ioBudget",
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help="Maximum number of filesystem operations per second, in total. "
+                        "0 for no limit.")
+    parser.add_argument("--snapshot",
+                        help="SQLite file from namespace_snapshot.py to look up ntuple files in, "
+                        "instead of checking them on disk.")
+    parser.add_argument("--parquet",
+                        help="Also save to this Parquet file (needs pyarrow), "
+                        "which is much quicker to load than the CSV.")
+    parser.add_argument("--chunkSize",
+                        type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help="Number of ntuples to collect in memory before saving them")
+    parser.add_argument("--baseline",
+                        help="CSV (or Parquet) file from a previous run. "
+                        "Ntuples in directories that haven't changed since are not checked again.")
+    parser.add_argument("--saveDirMtimes",
+                        action="store_true",
+                        help="Save mtime of each ntuple directory to <csv>_dirs.csv, so that this run "
+                        "can be used as a --baseline. Costs one extra stat per ntuple directory. "
+                        "Always done with --baseline.")
+    parser.add_argument("--summaryOnly",
+                        action="store_true",
+                        help="Only save total size, count, etc of ntuples for each user, year & xmldir "
+                        "to <csv>_summary.csv, not info for every ntuple. Uses much less memory.")
+    parser.add_argument("--quantiles",
+                        type=float,
+                        nargs="+",
+                        help="With --summaryOnly, also calculate these approximate quantiles "
+                        "of ntuple size, e.g. 0.5 0.9 0.99")
     args = parser.parse_args()
 
+    if args.quantiles and not args.summaryOnly:
+        parser.error("--quantiles needs --summaryOnly")
+    if any(not 0 <= q <= 1 for q in args.quantiles or []):
+        parser.error("--quantiles must be between 0 and 1")
+
     if not os.path.isdir(args.topDir):
         raise IOError("%s does not exist" % args.topDir)
 
@@ -256,5 +920,21 @@ if __name__ == "__main__":
     if not os.path.isdir(csv_dir):
         os.path.makedirs(csv_dir)
 
-    dataset_info(top_dir=args.topDir, csv_filename=args.csv)
+    xml_cache = XMLCache(args.xmlCache) if args.xmlCache else None
+    snapshot = NamespaceSnapshot(args.snapshot) if args.snapshot else None
+    if args.summaryOnly:
+        dataset_summary(top_dir=args.topDir, summary_filename=get_summary_filename(args.csv), xml_cache=xml_cache,
+                        jobs=args.jobs, io_budget=args.ioBudget, snapshot=snapshot,
+                        parquet_filename=args.parquet, quantiles=args.quantiles, baseline_filename=args.baseline)
+    else:
+        dataset_info(top_dir=args.topDir, csv_filename=args.csv, xml_cache=xml_cache,
+                     jobs=args.jobs, io_budget=args.ioBudget, snapshot=snapshot, parquet_filename=args.parquet,
+                     chunk_size=args.chunkSize, baseline_filename=args.baseline,
+                     save_dir_mtimes=args.saveDirMtimes)
+    if xml_cache:
+        xml_cache.close()
+        xml_cache.print_stats()
+    if snapshot:
+        snapshot.close()
+        snapshot.print_stats()
     sys.exit(0)
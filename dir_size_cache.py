@@ -0,0 +1,123 @@
+"""Persistent on-disk cache of directory listings, for sizing directories quickly.
+
+For each directory, stores its modification time, the summary (size, number of
+files, newest mtime) of the files directly inside it, and its subdirectories.
+A directory's mtime changes whenever an entry is added, removed or renamed in it,
+so if it is unchanged, the cached listing is reused and only the directory
+itself needs to be stat-ed, not every file in it.
+
+Files that are modified in place (without changing their directory) are not
+noticed, which is fine for ntuples since they are written once.
+
+Usage:
+
+    from fs_utils import summarise_tree
+    from dir_size_cache import DirSizeCache
+
+    with DirSizeCache("dir_size_cache.sqlite") as cache:
+        summary = summarise_tree("/pnfs/.../crab_TTbar", lister=cache.list_dir_summary)
+    cache.print_stats()
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from fs_utils import DirSummary, list_dir_summary
+
+
+# Don't cache directories modified more recently than this many seconds ago,
+# since another change in the same mtime tick wouldn't be noticed
+MIN_AGE = 2
+
+
+class DirSizeCache(object):
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite file to store cache in. Created if it doesn't exist.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._updated = {}
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS dir_cache (
+                path TEXT PRIMARY KEY,
+                mtime FLOAT NOT NULL,
+                size INTEGER NOT NULL,
+                nfiles INTEGER NOT NULL,
+                newest_mtime FLOAT,
+                subdirs TEXT NOT NULL
+            );
+            """)
+        self.connection.commit()
+        # Load everything up front, so lookups from many threads don't need the database
+        self._entries = {row[0]: (row[1], DirSummary(*row[2:5]), row[5])
+                         for row in self.connection.execute("SELECT * FROM dir_cache")}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def list_dir_summary(self, path, rate_limiter=None):
+        """Like fs_utils.list_dir_summary(), but using the cached listing if the directory is unchanged.
+
+        Thread-safe.
+
+        Returns
+        -------
+        list[str], DirSummary
+            Subdirectory paths, summary of files directly in `path`
+
+        Raises
+        ------
+        OSError
+            If `path` can't be listed
+        """
+        if rate_limiter:
+            rate_limiter.acquire()
+        mtime = os.stat(path).st_mtime
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            with self._lock:
+                self.hits += 1
+            return json.loads(entry[2]), entry[1]
+
+        subdirs, files_summary = list_dir_summary(path, rate_limiter)
+        with self._lock:
+            self.misses += 1
+            if time.time() - mtime > MIN_AGE:
+                entry = (mtime, files_summary, json.dumps(subdirs))
+                self._entries[path] = entry
+                self._updated[path] = entry
+        return subdirs, files_summary
+
+    def close(self):
+        """Save new entries & close the cache"""
+        if self.connection is None:
+            return
+        self.connection.executemany("INSERT OR REPLACE INTO dir_cache VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(path, mtime, summary.size, summary.nfiles, summary.newest_mtime, subdirs)
+                                     for path, (mtime, summary, subdirs) in self._updated.items()])
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+        self._updated = {}
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print("Directory cache %s: %d directories unchanged, %d re-listed, hit rate %.1f%%"
+              % (self.path, self.hits, self.misses, 100. * self.hits / total if total else 0))
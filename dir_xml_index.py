@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+
+"""Persistent index of which XML files use each ntuple directory, for each branch/release.
+
+Filled by findAllNtupleDirs.py --dirIndex, so that "which XMLs still use this
+directory?" can be answered without re-scanning all the branches.
+
+Usage, to query:
+
+    ./dir_xml_index.py dir_xml_index.sqlite /pnfs/desy.de/cms/tier2/store/user/robin/RunII_102X_v1/crab_TTbar
+
+or from python:
+
+    from dir_xml_index import DirXMLIndex
+
+    with DirXMLIndex("dir_xml_index.sqlite") as index:
+        for source, ntuple_dir, xml in index.get_xmls("/pnfs/.../crab_TTbar", recursive=True):
+            ...
+"""
+
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import argparse
+
+
+def build_dir_xml_map(xml_files, root_files_lists, dir_func=os.path.dirname):
+    """Make map of ntuple directory -> XML files that use it, in one pass over the ntuples
+
+    Parameters
+    ----------
+    xml_files : list[str]
+        XML filenames
+    root_files_lists : list[list[str]]
+        Ntuple filenames for each entry in `xml_files`
+    dir_func : callable, optional
+        Function to get directory from ntuple filename
+
+    Returns
+    -------
+    dict[str, set[str]]
+    """
+    dir_map = {}
+    for xml_file, root_files in zip(xml_files, root_files_lists):
+        for dirname in set(dir_func(f) for f in root_files):
+            dir_map.setdefault(dirname, set()).add(xml_file)
+    return dir_map
+
+
+class DirXMLIndex(object):
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite file to store index in. Created if it doesn't exist.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS dir_xml (
+                source TEXT NOT NULL,
+                ntuple_dir TEXT NOT NULL,
+                xml TEXT NOT NULL,
+                PRIMARY KEY (ntuple_dir, source, xml)
+            );
+            CREATE INDEX IF NOT EXISTS dir_xml_source ON dir_xml (source);
+            """)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def replace_source(self, source, dir_map):
+        """Replace all entries for a branch/release
+
+        Parameters
+        ----------
+        source : str
+            Name of branch or release
+        dir_map : dict[str, set[str]]
+            Map of ntuple directory -> XML files, from build_dir_xml_map()
+        """
+        # Store normalised paths, so e.g. .../tier2//store/... and a trailing / are found by get_xmls()
+        rows = set((source, os.path.normpath(d), x) for d, xmls in dir_map.items() for x in xmls)
+        with self.connection:
+            self.connection.execute("DELETE FROM dir_xml WHERE source = ?", (source,))
+            self.connection.executemany("INSERT INTO dir_xml VALUES (?, ?, ?)", rows)
+
+    def get_xmls(self, ntuple_dir, recursive=False, source=None):
+        """Get XML files that use ntuple directory `ntuple_dir`
+
+        Parameters
+        ----------
+        ntuple_dir : str
+        recursive : bool, optional
+            Also include directories inside `ntuple_dir`
+        source : str, optional
+            Only look in this branch/release
+
+        Returns
+        -------
+        list[(str, str, str)]
+            (branch/release, ntuple directory, XML file), sorted
+        """
+        ntuple_dir = os.path.normpath(ntuple_dir)
+        query = "SELECT source, ntuple_dir, xml FROM dir_xml WHERE (ntuple_dir = ?"
+        args = [ntuple_dir]
+        if recursive:
+            # Range query rather than LIKE, since paths often contain _
+            query += " OR (ntuple_dir >= ? AND ntuple_dir < ?)"
+            args += [ntuple_dir + "/", ntuple_dir + "0"]
+        query += ")"
+        if source is not None:
+            query += " AND source = ?"
+            args.append(source)
+        query += " ORDER BY source, ntuple_dir, xml"
+        return self.connection.execute(query, args).fetchall()
+
+    def get_sources(self):
+        return [r[0] for r in self.connection.execute("SELECT DISTINCT source FROM dir_xml ORDER BY source")]
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("index", help="SQLite index file from findAllNtupleDirs.py --dirIndex")
+    parser.add_argument("ntupleDir", nargs="+", help="Ntuple directories to look up")
+    parser.add_argument("--recursive",
+                        action="store_true",
+                        help="Also include directories inside each ntupleDir")
+    parser.add_argument("--source", help="Only look in this branch/release")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.index):
+        raise IOError("%s does not exist" % args.index)
+
+    with DirXMLIndex(args.index) as index:
+        for ntuple_dir in args.ntupleDir:
+            results = index.get_xmls(ntuple_dir, recursive=args.recursive, source=args.source)
+            print(ntuple_dir + "::")
+            if not results:
+                print("\tNot used by any XML")
+            for source, this_dir, xml in results:
+                if this_dir != os.path.normpath(ntuple_dir):
+                    print("\t%s: %s (%s)" % (source, xml, this_dir))
+                else:
+                    print("\t%s: %s" % (source, xml))
@@ -20,9 +20,17 @@ from __future__ import print_function
 import os
 import re
 import sys
+import argparse
 import subprocess
 import uuid
 import shutil
+from stat import S_ISREG
+
+from xml_cache import XMLCache, cached_ntuple_filenames
+from git_objects import init_mirror, get_branches, list_xml_blobs_for_refs, GitXMLRecords
+from namespace_snapshot import NamespaceSnapshot
+from dir_xml_index import DirXMLIndex, build_dir_xml_map
+from fs_utils import StatEngine, DEFAULT_STAT_JOBS, DEFAULT_IO_BUDGET
 
 if not hasattr(subprocess, 'check_output'):
     raise ImportError("subprocess module missing check_output(): you need python 2.7 or newer")
@@ -46,6 +54,11 @@ LEGACY_BRANCHES = [
 # Set this to the remote name that will be used for the central UHH2 repo
 REMOTE_NAME = "UHH"
 
+UHH2_REPO_URL = "https://github.com/UHH2/UHH2.git"
+
+# Bare mirror of UHH2 repo, used when reading XMLs from git objects
+MIRROR_DIRNAME = "UHHCounting.git"
+
 
 def init_repo(repo_url, clone_dir):
     if os.path.isdir(clone_dir):
@@ -97,27 +110,8 @@ def find_xml_files(start='common/datasets'):
     return xml_filenames
 
 
-def get_root_files_from_xml(xml_filename):
-    root_filenames = []
-    with open(filename) as f:
-        is_comment = False
-        fname_pattern = r'< ?In FileName="(.+)" Lumi="0\.0" ?\/>'
-        for line in f:
-            line = line.strip()
-            if line.startswith("<!--"):
-                is_comment = True
-            if line.endswith("-->"):
-                is_comment = False
-                continue
-            if is_comment:
-                continue
-
-            match = re.search(fname_pattern, line.strip())
-            if match is None:
-                continue
-            else:
-                root_filenames.append(match.group(1))
-    return root_filenames
+def get_root_files_from_xml(xml_filename, xml_cache=None):
+    return cached_ntuple_filenames(xml_filename, xml_cache)
 
 
 def remove_crab_dir(dirname):
@@ -130,18 +124,169 @@ def remove_crab_dir(dirname):
         return dirname
 
 
+def strip_datasets_dir(xml_filename):
+    """Remove leading common/datasets/ from XML filename, if it has one"""
+    prefix = "common/datasets/"
+    return xml_filename[len(prefix):] if xml_filename.startswith(prefix) else xml_filename
+
+
 def save_list_to_file(this_list, output_filename):
     with open(output_filename, "w") as f:
         f.write("\n".join(this_list))
 
 
-def do_legacy_branches(check_missing):
+class NtupleExistenceCache(object):
+    """Remembers whether ntuples exist & their size, so that ntuples used in
+    several branches/releases are only checked once per run.
+
+    New ntuples are stat-ed concurrently with a StatEngine.
+    """
+
+    def __init__(self, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET, snapshot=None):
+        """
+        Parameters
+        ----------
+        jobs : int, optional
+            Number of threads to stat ntuples with
+        io_budget : float, optional
+            Maximum number of stat calls per second, in total
+        snapshot : NamespaceSnapshot, optional
+            Look up ntuples in this snapshot instead of stat-ing them
+        """
+        if snapshot is not None:
+            # lookups are local, so no need for threads or rate limit
+            self.stat_engine = StatEngine(jobs=1, io_budget=0, stat_func=snapshot.stat_or_none)
+        else:
+            self.stat_engine = StatEngine(jobs=jobs, io_budget=io_budget)
+        self._sizes = {}  # filename -> size in bytes, or None if missing
+        self.hits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def check(self, filenames):
+        """Make sure all of `filenames` are known, stat-ing any new ones concurrently"""
+        new_filenames = []
+        for f in filenames:
+            if f in self._sizes:
+                self.hits += 1
+            else:
+                self._sizes[f] = None  # placeholder, so duplicates are only stat-ed once
+                new_filenames.append(f)
+        for f, stat in self.stat_engine.imap(new_filenames):
+            self._sizes[f] = stat.st_size if stat is not None and S_ISREG(stat.st_mode) else None
+
+    def exists(self, filename):
+        if filename not in self._sizes:
+            self.check([filename])
+        return self._sizes[filename] is not None
+
+    def size(self, filename):
+        """Size in bytes, or None if `filename` doesn't exist"""
+        if filename not in self._sizes:
+            self.check([filename])
+        return self._sizes[filename]
+
+    def close(self):
+        self.stat_engine.close()
+
+    def print_stats(self):
+        total = self.hits + len(self._sizes)
+        print("Ntuple existence cache: %d ntuples checked, %d lookups reused (hit rate %.1f%%)"
+              % (len(self._sizes), self.hits, 100. * self.hits / total if total else 0))
+        self.stat_engine.print_stats()
+
+
+def write_ntuple_lists(name, xml_files, these_root_files_lists, check_missing, output_dir="..",
+                       existence_cache=None, dir_index=None):
+    """Write missing files, list of all ntuples, list of all ntuple directories,
+    and map of directory -> XMLs, for a set of XML files
+
+    Parameters
+    ----------
+    name : str
+        Name of branch or release, used in output filenames
+    xml_files : list[str]
+        XML filenames
+    these_root_files_lists : list[list[str]]
+        Ntuple filenames for each entry in `xml_files`
+    check_missing : bool
+        If True, check which ntuples no longer exist
+    output_dir : str, optional
+        Directory to put output files in
+    existence_cache : NtupleExistenceCache, optional
+        Used to check which ntuples exist, shared between calls so ntuples
+        are only checked once. If None, a new one is used.
+    dir_index : DirXMLIndex, optional
+        If set, also store the map of directory -> XMLs in it
+    """
+    all_root_files = []
+    for l in these_root_files_lists:
+        all_root_files.extend(l)
+
+    # Write missing files to file
+    if check_missing:
+        print("Doing missing files")
+        own_cache = existence_cache is None
+        if own_cache:
+            existence_cache = NtupleExistenceCache()
+        existence_cache.check(all_root_files)
+        missing_counter = 0
+        with open(os.path.join(output_dir, "%s_missing.txt" % name), "w") as f:
+            for xf, these_root_files in zip(xml_files, these_root_files_lists):
+                first_time = True
+                for rf in these_root_files:
+                    if not existence_cache.exists(rf):
+                        missing_counter += 1
+                        if first_time:
+                            f.write(xf + "::\n")
+                            first_time = False
+                        f.write(rf + "\n")
+        print("# Missing files:", missing_counter)
+        total_size = sum(existence_cache.size(rf) or 0 for rf in set(all_root_files))
+        print("Total size of existing ntuples: %.1f GB" % (total_size / 1024.**3))
+        if own_cache:
+            existence_cache.close()
+
+    # Write list of all filenames
+    all_root_files = sorted(list(set(all_root_files)))
+    file_log_filename = "ntuple_filenames_"+name+".txt"
+    save_list_to_file(all_root_files, os.path.join(output_dir, file_log_filename))
+    print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
+
+    # Map of dirname -> XMLs, in one pass
+    dir_map = build_dir_xml_map([strip_datasets_dir(x) for x in xml_files], these_root_files_lists,
+                                dir_func=lambda f: remove_crab_dir(os.path.dirname(f)))
+
+    # Write list of all directory names
+    all_root_files_dirs = sorted(dir_map)
+    dir_log_filename = "ntuple_dirnames_"+name+".txt"
+    save_list_to_file(all_root_files_dirs, os.path.join(output_dir, dir_log_filename))
+    print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
+
+    # Write map of dirname -> XMLs
+    print("Doing dir map")
+    xml_order = {strip_datasets_dir(x): ind for ind, x in enumerate(xml_files)}
+    with open(os.path.join(output_dir, "%s_dir_map.txt" % name), "w") as f:
+        for rd in all_root_files_dirs:
+            f.write(rd + "::\n")
+            # same order as xml_files
+            for xml in sorted(dir_map[rd], key=xml_order.get):
+                f.write("\t" + xml + "\n")
+    if dir_index is not None:
+        dir_index.replace_source(name, dir_map)
+
+
+def do_legacy_branches(check_missing, xml_cache=None, existence_cache=None, dir_index=None):
     """Handle the UHH2/common/datasets directories for legacy branches"""
     # Setup UHH2 in clean directory avoid any contamination
     deploy_dirname = "UHHCounting"
     if not os.path.isdir(deploy_dirname):
         print("Cloning repo since I can't find an existing clone under", deploy_dirname)
-        init_repo("https://github.com/UHH2/UHH2.git", deploy_dirname)
+        init_repo(UHH2_REPO_URL, deploy_dirname)
     else:
         os.chdir(deploy_dirname)
 
@@ -156,63 +301,56 @@ def do_legacy_branches(check_missing):
     print("Only looking in branches:", important_branches)
 
     for remote_branch in important_branches[:]:
-        all_root_files = []
         remote_branch = remote_branch.lstrip(REMOTE_NAME+"/")
         local_branch_name = remote_branch
         checkout_branch(remote_branch, local_branch_name)
         pull_branch()
         xml_files = find_xml_files()
-        these_root_files_lists = [get_root_files_from_xml(x) for x in xml_files]
-        for l in these_root_files_lists:
-            all_root_files.extend(l)
-
-        # Write missing files to file
-        if check_missing:
-            print("Doing missing files")
-            missing_counter = 0
-            with open("../%s_missing.txt" % remote_branch, "w") as f:
-                for xf in xml_files:
-                    first_time = True
-                    these_root_files = get_root_files_from_xml(xf)
-                    for rf in these_root_files:
-                        if not os.path.isfile(rf):
-                            missing_counter += 1
-                            if first_time:
-                                f.write(xf + "::\n")
-                                first_time = False
-                            f.write(rf + "\n")
-            print("# Missing files:", missing_counter)
-
-        # Write list of all filenames
-        all_root_files = sorted(list(set(all_root_files)))
-        file_log_filename = "ntuple_filenames_"+remote_branch+".txt"
+        these_root_files_lists = [get_root_files_from_xml(x, xml_cache) for x in xml_files]
         # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files, "../"+file_log_filename)
-        print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
-
-        # Write list of all directory names
-        all_root_files_dirs = sorted(list(set([remove_crab_dir(os.path.dirname(f))
-                                               for f in all_root_files])))
-        dir_log_filename = "ntuple_dirnames_"+remote_branch+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files_dirs, "../"+dir_log_filename)
-        print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
-
-        # Write map of dirname -> XMLs
-        print("Doing dir map")
-        these_root_dirs_lists = [sorted(list(set([remove_crab_dir(os.path.dirname(r))
-                                                  for r in rfl])))
-                                 for rfl in these_root_files_lists]
-        with open("../%s_dir_map.txt" % remote_branch, "w") as f:
-            for rd in all_root_files_dirs:
-                f.write(rd + "::\n")
-                for ind, rdl in enumerate(these_root_dirs_lists):
-                    if rd in rdl:
-                        f.write("\t" + xml_files[ind].lstrip("common/datasets/") + "\n")
+        write_ntuple_lists(remote_branch, xml_files, these_root_files_lists, check_missing, output_dir="..",
+                           existence_cache=existence_cache, dir_index=dir_index)
     os.chdir("..")
 
 
-def do_new_branches(check_missing):
+def get_legacy_branch_xml_blobs(mirror_dirname=MIRROR_DIRNAME):
+    """Get XML files in common/datasets for all legacy branches, straight from
+    git objects in a bare mirror of the UHH2 repo (created/updated as necessary)
+
+    Parameters
+    ----------
+    mirror_dirname : str, optional
+        Directory of bare mirror
+
+    Returns
+    -------
+    list[str], list[list[(str, str)]]
+        Branch names, and for each branch a list of (XML path, blob SHA)
+    """
+    init_mirror(UHH2_REPO_URL, mirror_dirname)
+    important_branches = sorted(set(LEGACY_BRANCHES) & set(get_branches(mirror_dirname)))
+    print("Only looking in branches:", important_branches)
+    # List all branches at once
+    blobs_per_branch = list_xml_blobs_for_refs(mirror_dirname, important_branches,
+                                               path="common/datasets",
+                                               jobs=len(important_branches))
+    return important_branches, blobs_per_branch
+
+
+def do_legacy_branches_from_git_objects(check_missing, existence_cache=None, dir_index=None):
+    """Handle the UHH2/common/datasets directories for legacy branches,
+    reading the XML files from git objects instead of checking out each branch"""
+    branches, blobs_per_branch = get_legacy_branch_xml_blobs()
+    with GitXMLRecords(MIRROR_DIRNAME) as xml_records:
+        for branch, blobs in zip(branches, blobs_per_branch):
+            xml_files = [xml_path for xml_path, sha in blobs]
+            these_root_files_lists = [xml_records.get_ntuple_filenames(sha) for xml_path, sha in blobs]
+            write_ntuple_lists(branch, xml_files, these_root_files_lists, check_missing, output_dir=".",
+                               existence_cache=existence_cache, dir_index=dir_index)
+        xml_records.print_stats()
+
+
+def do_new_branches(check_missing, xml_cache=None, existence_cache=None, dir_index=None):
     """Handle the 102X and 106X branches: these use UHH2-datasets repo"""
     # Clone UHH2-datasets repo if necessary
     datasets_dirname = 'UHH2-datasets'
@@ -232,67 +370,59 @@ def do_new_branches(check_missing):
     for release in releases:
         # Do usual finding of XML files, check missing, save to txt files
         xml_files = find_xml_files(start=release)
-        these_root_files_lists = [get_root_files_from_xml(x) for x in xml_files]
-        all_root_files = []
-        for l in these_root_files_lists:
-            all_root_files.extend(l)
-
-        # Write missing files to file
-        if check_missing:
-            print("Doing missing files")
-            missing_counter = 0
-            # use .. as we're in the UHH repo
-            with open("../%s_missing.txt" % release, "w") as f:
-                for xf in xml_files:
-                    first_time = True
-                    these_root_files = get_root_files_from_xml(xf)
-                    for rf in these_root_files:
-                        if not os.path.isfile(rf):
-                            missing_counter += 1
-                            if first_time:
-                                f.write(xf + "::\n")
-                                first_time = False
-                            f.write(rf + "\n")
-            print("# Missing files:", missing_counter)
-
-        # Write list of all filenames
-        all_root_files = sorted(list(set(all_root_files)))
-        file_log_filename = "ntuple_filenames_"+release+".txt"
+        these_root_files_lists = [get_root_files_from_xml(x, xml_cache) for x in xml_files]
         # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files, "../"+file_log_filename)
-        print("Found", len(all_root_files), "ntuples, list saved to", file_log_filename)
-
-        # Write list of all directory names
-        all_root_files_dirs = sorted(list(set([remove_crab_dir(os.path.dirname(f))
-                                               for f in all_root_files])))
-        dir_log_filename = "ntuple_dirnames_"+release+".txt"
-        # use .. as we're in the UHH repo
-        save_list_to_file(all_root_files_dirs, "../"+dir_log_filename)
-        print("Found", len(all_root_files_dirs), "ntuple dirs, list saved to", dir_log_filename)
-
-        # Write map of dirname -> XMLs
-        print("Doing dir map")
-        these_root_dirs_lists = [sorted(list(set([remove_crab_dir(os.path.dirname(r))
-                                                  for r in rfl])))
-                                 for rfl in these_root_files_lists]
-        with open("../%s_dir_map.txt" % release, "w") as f:
-            for rd in all_root_files_dirs:
-                f.write(rd + "::\n")
-                for ind, rdl in enumerate(these_root_dirs_lists):
-                    if rd in rdl:
-                        f.write("\t" + xml_files[ind].lstrip("common/datasets/") + "\n")
+        write_ntuple_lists(release, xml_files, these_root_files_lists, check_missing, output_dir="..",
+                           existence_cache=existence_cache, dir_index=dir_index)
 
     os.chdir("..")
 
 
-def main(check_missing=True):
+def main(check_missing=True, xml_cache_filename=None, from_git_objects=False, snapshot_filename=None,
+         jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET, dir_index_filename=None):
     t2_example_dir = '/pnfs/desy.de/cms/tier2/'
-    if check_missing and not os.path.isdir(t2_example_dir):
+    # don't need access to the T2 if we have a snapshot of it
+    if check_missing and not snapshot_filename and not os.path.isdir(t2_example_dir):
         print("Cannot find", t2_example_dir, " - skipping missing file check")
         check_missing = False
 
-    do_legacy_branches(check_missing)
-    do_new_branches(check_missing)
+    xml_cache = None
+    if xml_cache_filename:
+        # abspath since we change directory a lot
+        xml_cache = XMLCache(os.path.abspath(xml_cache_filename))
+
+    snapshot = None
+    if snapshot_filename:
+        snapshot = NamespaceSnapshot(os.path.abspath(snapshot_filename))
+
+    # Shared by all branches & releases, since many use the same ntuples
+    existence_cache = None
+    if check_missing:
+        existence_cache = NtupleExistenceCache(jobs=jobs, io_budget=io_budget, snapshot=snapshot)
+
+    dir_index = None
+    if dir_index_filename:
+        dir_index = DirXMLIndex(os.path.abspath(dir_index_filename))
+
+    if from_git_objects:
+        do_legacy_branches_from_git_objects(check_missing, existence_cache, dir_index)
+    else:
+        do_legacy_branches(check_missing, xml_cache, existence_cache, dir_index)
+    do_new_branches(check_missing, xml_cache, existence_cache, dir_index)
+
+    if existence_cache:
+        existence_cache.close()
+        existence_cache.print_stats()
+
+    if xml_cache:
+        xml_cache.close()
+        xml_cache.print_stats()
+    if snapshot:
+        snapshot.close()
+        snapshot.print_stats()
+    if dir_index:
+        dir_index.close()
+        print("Saved directory -> XML map to", dir_index_filename, "- query it with dir_xml_index.py")
 
     return 0
 
@@ -302,5 +432,32 @@ if __name__ == "__main__":
     parser.add_argument('--checkMissing',
                         help='Compile lists of ntuples in XMLs that no longer exist on disk (slow)',
                         action='store_true')
+    parser.add_argument('--xmlCache',
+                        help='SQLite file to cache parsed XML files in, '
+                             'so only changed XMLs are re-parsed on the next run')
+    parser.add_argument('--gitObjects',
+                        help='For legacy branches, read XMLs straight from git objects in a bare '
+                             'mirror (' + MIRROR_DIRNAME + ') instead of checking out each branch',
+                        action='store_true')
+    parser.add_argument('--snapshot',
+                        help='SQLite file from namespace_snapshot.py to check for missing ntuples in, '
+                             'instead of checking on disk')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=DEFAULT_STAT_JOBS,
+                        help='Number of threads to check for missing ntuples with')
+    parser.add_argument('--ioBudget',
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help='Maximum number of filesystem operations per second, in total. 0 for no limit.')
+    parser.add_argument('--dirIndex',
+                        help='SQLite file to also store the map of directory -> XMLs in, '
+                             'to query later with dir_xml_index.py')
     args = parser.parse_args()
-    sys.exit(main(check_missing=args.checkMissing))
+    sys.exit(main(check_missing=args.checkMissing,
+                  xml_cache_filename=args.xmlCache,
+                  from_git_objects=args.gitObjects,
+                  snapshot_filename=args.snapshot,
+                  jobs=args.jobs,
+                  io_budget=args.ioBudget,
+                  dir_index_filename=args.dirIndex))
@@ -0,0 +1,682 @@
+"""Helpers for working with (slow, shared) filesystems like dCache.
+
+Usage:
+
+    from fs_utils import RateLimiter, StatEngine, DirSizer, atomic_output
+
+    limiter = RateLimiter(ops_per_sec=1000)
+    for f in filenames:
+        limiter.acquire()
+        os.stat(f)
+
+    with StatEngine(jobs=16, io_budget=1000) as engine:
+        for f, stat in engine.imap(filenames):
+            ...
+
+    with DirSizer(jobs=4) as sizer:
+        summary = sizer.summarise("/pnfs/.../crab_TTbar/190101_123456")
+        print(summary.size, summary.nfiles, summary.newest_mtime)
+
+    with atomic_output("MC_TTbar.xml") as f:
+        f.write(new_contents)
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+from itertools import islice
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2: use the backport if available, otherwise fall back to listdir + lstat
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# Default maximum number of filesystem operations per second, per worker
+DEFAULT_IO_BUDGET = 2000
+
+
+_now = getattr(time, "monotonic", time.time)
+
+
+class RateLimiter(object):
+    """Token-bucket limit on the rate of operations, e.g. stat calls, to avoid
+    hammering the filesystem. Thread-safe.
+
+    Up to `burst` operations can be done back-to-back, after which callers are
+    made to sleep so that the average rate stays at `ops_per_sec`.
+    """
+
+    def __init__(self, ops_per_sec=DEFAULT_IO_BUDGET, burst=None):
+        """
+        Parameters
+        ----------
+        ops_per_sec : float
+            Maximum average rate. If 0 or None, there is no limit.
+        burst : float, optional
+            Size of bucket, defaults to `ops_per_sec`
+        """
+        self.rate = ops_per_sec
+        self.capacity = burst or ops_per_sec
+        self.tokens = self.capacity
+        self.last = _now()
+        self.total_wait = 0  # seconds spent sleeping, for monitoring
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """Take `n` tokens from the bucket, sleeping if there aren't enough"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = _now()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Allow going into debt, so concurrent callers queue up fairly
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.total_wait += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+@contextmanager
+def atomic_output(filename, mode="wb"):
+    """Open a temporary file to write a replacement for `filename`.
+
+    On success, the temporary file is renamed to `filename`, keeping the
+    original file's permissions, so readers never see a half-written file.
+    If an exception is raised, the original file is left untouched.
+
+    Yields
+    ------
+    file
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                        suffix=os.path.splitext(filename)[1] + ".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_filename)
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+# Default number of threads for StatEngine. stat calls on dCache/NFS are
+# dominated by latency, so many more threads than CPUs is fine.
+DEFAULT_STAT_JOBS = 16
+
+
+def stat_or_none(path):
+    """os.stat(), but returns None if the path doesn't exist (or can't be accessed)"""
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+class StatEngine(object):
+    """Stat many files concurrently with a thread pool, limited to a maximum
+    rate of stat calls across all threads.
+
+    Each path is only stat-ed once: the stat result gives both whether the
+    file exists and its size, etc, so there is no need for separate
+    os.path.isfile() and os.path.getsize() calls.
+
+    Usage:
+
+        with StatEngine(jobs=16, io_budget=1000) as engine:
+            for filename, stat in engine.imap(filenames):
+                if stat is None:
+                    # missing
+    """
+
+    def __init__(self, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET, window=None, stat_func=None):
+        """
+        Parameters
+        ----------
+        jobs : int, optional
+            Number of threads
+        io_budget : float, optional
+            Maximum number of stat calls per second, in total. If 0 or None, no limit.
+        window : int, optional
+            Maximum number of paths to have in flight at once, defaults to 256 per thread.
+            Keeps memory use bounded however many paths there are.
+        stat_func : callable, optional
+            Function to get stat result for a path, or None if it doesn't exist,
+            e.g. NamespaceSnapshot.stat_or_none. Defaults to os.stat().
+        """
+        self.stat_func = stat_func or stat_or_none
+        self.jobs = max(1, jobs)
+        self.window = window or 256 * self.jobs
+        self.limiter = RateLimiter(io_budget)
+        self.n_stats = 0
+        self.n_missing = 0
+        self.pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _stat(self, path):
+        self.limiter.acquire()
+        return self.stat_func(path)
+
+    def imap(self, items, key=None):
+        """Stat paths for all `items`, yielding results in the same order as `items`.
+
+        Parameters
+        ----------
+        items : iterable
+            Paths, or objects that contain a path (see `key`)
+        key : callable, optional
+            Function to get path from each item
+
+        Yields
+        ------
+        (object, os.stat_result)
+            Item, and its stat result (None if the path does not exist)
+        """
+        items = iter(items)
+        while True:
+            batch = list(islice(items, self.window))
+            if not batch:
+                break
+            paths = [key(item) for item in batch] if key else batch
+            if self.pool is None:
+                stats = [self._stat(p) for p in paths]
+            else:
+                stats = self.pool.map(self._stat, paths, chunksize=max(1, len(paths) // (4 * self.jobs)))
+            self.n_stats += len(stats)
+            for item, stat in zip(batch, stats):
+                if stat is None:
+                    self.n_missing += 1
+                yield item, stat
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def print_stats(self):
+        print("Did %d stat calls (%d missing) with %d threads, %.1fs spent waiting for the rate limit"
+              % (self.n_stats, self.n_missing, self.jobs, self.limiter.total_wait))
+
+
+# Default number of threads for DirSizer
+DEFAULT_SCAN_THREADS = 4
+
+# How many levels below the top directory DirSizer will split into separate tasks
+MAX_FANOUT_DEPTH = 3
+
+
+class DirSummary(namedtuple("DirSummary", ["size", "nfiles", "newest_mtime"])):
+    """Summary of all files under a directory, recursively
+
+    size : int
+        Total size of files in bytes
+    nfiles : int
+        Number of files (i.e. anything that isn't a directory)
+    newest_mtime : float
+        Latest modification time of any file, or None if there are no files
+    """
+    __slots__ = ()
+
+
+EMPTY_DIR_SUMMARY = DirSummary(0, 0, None)
+
+
+def _merge_summaries(summaries):
+    size, nfiles, newest_mtime = 0, 0, None
+    for s in summaries:
+        size += s.size
+        nfiles += s.nfiles
+        if s.newest_mtime is not None and (newest_mtime is None or s.newest_mtime > newest_mtime):
+            newest_mtime = s.newest_mtime
+    return DirSummary(size, nfiles, newest_mtime)
+
+
+def _summarise_stats(stats):
+    if not stats:
+        return EMPTY_DIR_SUMMARY
+    return DirSummary(sum(st.st_size for st in stats), len(stats), max(st.st_mtime for st in stats))
+
+
+def list_dir(path, rate_limiter=None):
+    """List a single directory, with the (l)stat info for each file.
+
+    With scandir, whether an entry is a directory usually comes for free
+    from the directory listing, and no paths need to be built or looked up again.
+
+    Parameters
+    ----------
+    path : str
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+
+    Returns
+    -------
+    list[str], list[os.stat_result]
+        Subdirectory paths, stat results for files (symlinks are not followed)
+
+    Raises
+    ------
+    OSError
+        If `path` can't be listed
+    """
+    if rate_limiter:
+        rate_limiter.acquire()
+    subdirs, file_entries = [], []
+    if scandir is not None:
+        for entry in list(scandir(path)):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    file_entries.append(entry)
+            except OSError:
+                continue
+        stat = lambda entry: entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                subdirs.append(full_path)
+            else:
+                file_entries.append(full_path)
+        stat = os.lstat
+    if rate_limiter and file_entries:
+        rate_limiter.acquire(len(file_entries))
+    stats = []
+    for entry in file_entries:
+        try:
+            stats.append(stat(entry))
+        except OSError:
+            # e.g. deleted in the meantime
+            continue
+    return subdirs, stats
+
+
+def list_dir_summary(path, rate_limiter=None):
+    """Like list_dir(), but with the files already summarised
+
+    Returns
+    -------
+    list[str], DirSummary
+        Subdirectory paths, summary of files directly in `path`
+    """
+    subdirs, stats = list_dir(path, rate_limiter)
+    return subdirs, _summarise_stats(stats)
+
+
+def summarise_tree(path, rate_limiter=None, known=None, lister=list_dir_summary):
+    """Get DirSummary for everything under `path`, in this thread.
+
+    Directories that can't be listed (including `path` itself) are ignored, like os.walk()
+
+    Parameters
+    ----------
+    path : str
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+    known : dict{str: DirSummary}, optional
+        Already-known summaries of subdirectories (keyed by normalised path),
+        which are used instead of scanning those subdirectories again
+    lister : callable, optional
+        Function to list each directory, with the same arguments & return
+        values as list_dir_summary(), e.g. DirSizeCache.list_dir_summary
+
+    Returns
+    -------
+    DirSummary
+    """
+    summaries = []
+    to_visit = [path]
+    while to_visit:
+        try:
+            subdirs, files_summary = lister(to_visit.pop(), rate_limiter)
+        except OSError:
+            continue
+        summaries.append(files_summary)
+        for subdir in subdirs:
+            if known and subdir in known:
+                summaries.append(known[subdir])
+            else:
+                to_visit.append(subdir)
+    return _merge_summaries(summaries)
+
+
+def group_nested_dirs(dirs):
+    """Group directories so that directories inside another one in `dirs`
+    are in the same group as it.
+
+    e.g. ["/a/b", "/a/b/c", "/a/bc", "/d"] -> [["/a/b", "/a/b/c"], ["/a/bc"], ["/d"]]
+
+    Parameters
+    ----------
+    dirs : iterable[str]
+        Normalised directory paths
+
+    Returns
+    -------
+    list[list[str]]
+        Groups in sorted order, each with the outermost directory first
+    """
+    groups = []
+    # Sorting on path components (rather than the whole string) puts
+    # subdirectories straight after their parent, e.g. /a/b/c before /a/bc
+    for d in sorted(set(dirs), key=lambda d: d.split("/")):
+        if groups and d.startswith(groups[-1][0].rstrip("/") + "/"):
+            groups[-1].append(d)
+        else:
+            groups.append([d])
+    return groups
+
+
+def summarise_nested_dirs(group, rate_limiter=None, lister=list_dir_summary, sizer=None):
+    """Get summaries for a group of nested directories from group_nested_dirs().
+
+    The innermost directories are done first, so that their totals can be
+    reused for the directories that contain them.
+
+    Parameters
+    ----------
+    group : list[str]
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+    lister : callable, optional
+        See summarise_tree()
+    sizer : DirSizer, optional
+        Use this to scan each directory, instead of summarise_tree() in this thread
+
+    Returns
+    -------
+    dict{str: DirSummary}
+        Summary for each directory in `group`
+    """
+    known = {}
+    for d in sorted(group, key=lambda d: d.count("/"), reverse=True):
+        if sizer is not None:
+            known[d] = sizer.summarise(d, known)
+        else:
+            known[d] = summarise_tree(d, rate_limiter, known, lister)
+    return known
+
+
+class DirSizer(object):
+    """Get size, number of files & newest modification time under directories,
+    splitting each directory into subtrees that are scanned concurrently.
+
+    This suits CRAB output directories, where files are spread over many
+    0000, 0001, ... subdirectories.
+    """
+
+    def __init__(self, jobs=DEFAULT_SCAN_THREADS, rate_limiter=None, lister=list_dir_summary):
+        """
+        Parameters
+        ----------
+        jobs : int, optional
+            Number of threads
+        rate_limiter : RateLimiter, optional
+            Used to throttle filesystem operations across all threads
+        lister : callable, optional
+            Function to list each directory, see summarise_tree()
+        """
+        self.jobs = max(1, jobs)
+        self.rate_limiter = rate_limiter
+        self.lister = lister
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def pool(self):
+        # Created on first use, so this object can be made before forking worker processes
+        if self._pool is None:
+            self._pool = ThreadPool(self.jobs)
+        return self._pool
+
+    def summarise(self, path, known=None):
+        """Get DirSummary for everything under `path`
+
+        Parameters
+        ----------
+        path : str
+        known : dict{str: DirSummary}, optional
+            Already-known summaries of subdirectories, see summarise_tree()
+
+        Returns
+        -------
+        DirSummary
+        """
+        if self.jobs == 1:
+            return summarise_tree(path, self.rate_limiter, known, self.lister)
+
+        # List the top few levels here until there are enough subtrees
+        # to keep all threads busy, then hand those out
+        summaries = []
+        frontier = [path]
+        for _ in range(MAX_FANOUT_DEPTH):
+            if len(frontier) >= self.jobs:
+                break
+            next_frontier = []
+            for dirname in frontier:
+                try:
+                    subdirs, files_summary = self.lister(dirname, self.rate_limiter)
+                except OSError:
+                    continue
+                summaries.append(files_summary)
+                for subdir in subdirs:
+                    if known and subdir in known:
+                        summaries.append(known[subdir])
+                    else:
+                        next_frontier.append(subdir)
+            frontier = next_frontier
+            if not frontier:
+                break
+        if frontier:
+            summaries.extend(self.pool.map(lambda d: summarise_tree(d, self.rate_limiter, known, self.lister),
+                                           frontier, chunksize=1))
+        return _merge_summaries(summaries)
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+
+def _full_match(pattern, text):
+    match = pattern.match(text)
+    return match is not None and match.end() == len(text)
+
+
+def iter_matching_dirs(top_dir, name_pattern, rate_limiter=None, hand_off=None, lister=list_dir_summary):
+    """Walk `top_dir` once, yielding every directory whose name matches `name_pattern`,
+    with a summary of the files under it.
+
+    Sizes are added up from the bottom, as each directory is finished (post-order),
+    so nothing is walked twice. Files inside a matching directory that is itself
+    inside another matching directory are only counted for the innermost one,
+    so the sizes can be summed without double counting.
+
+    Directories are visited in sorted order. Directories that can't be listed are ignored.
+
+    Parameters
+    ----------
+    top_dir : str
+    name_pattern : re.Pattern
+        Pattern that must match the whole directory name (not path)
+    rate_limiter : RateLimiter, optional
+        Used to throttle filesystem operations
+    hand_off : callable, optional
+        Called with a subdirectory that isn't inside a matching directory.
+        If it returns True, the subdirectory is skipped here, on the
+        understanding that the caller will walk it separately.
+        Used by ParallelDirWalker to share out work.
+    lister : callable, optional
+        Function to list each directory, see summarise_tree()
+
+    Yields
+    ------
+    str, DirSummary
+        Directory path, summary of files under it
+    """
+    def visit(path):
+        try:
+            subdirs, files_summary = lister(path, rate_limiter)
+        except OSError:
+            subdirs, files_summary = [], EMPTY_DIR_SUMMARY
+        matched = _full_match(name_pattern, os.path.basename(path))
+        # reversed so pop() gives them in sorted order
+        return [path, sorted(subdirs, reverse=True), files_summary, matched]
+
+    stack = [visit(top_dir)]
+    n_matched = 1 if stack[0][3] else 0  # number of matching dirs in stack
+    while stack:
+        frame = stack[-1]
+        if frame[1]:
+            subdir = frame[1].pop()
+            # Results for subdirectories of non-matching dirs don't depend on
+            # anything else, so they can be walked elsewhere
+            if n_matched == 0 and hand_off is not None and hand_off(subdir):
+                continue
+            stack.append(visit(subdir))
+            n_matched += stack[-1][3]
+            continue
+        stack.pop()
+        path, _, summary, matched = frame
+        if matched:
+            n_matched -= 1
+            yield path, summary
+            # already accounted for, so don't add to the parent as well
+            summary = EMPTY_DIR_SUMMARY
+        if stack:
+            stack[-1][2] = _merge_summaries([stack[-1][2], summary])
+
+
+class ParallelDirWalker(object):
+    """Run iter_matching_dirs() over several top directories with a pool of threads.
+
+    Work is shared out dynamically: whenever a thread is idle, the busy threads
+    hand over subdirectories they haven't started yet, so that one huge directory
+    is split across all threads instead of holding up the whole scan.
+
+    Results are yielded as they are found, so their order is not fixed.
+    """
+
+    def __init__(self, name_pattern, jobs=DEFAULT_SCAN_THREADS, rate_limiter=None, lister=list_dir_summary):
+        """
+        Parameters
+        ----------
+        name_pattern : re.Pattern
+            See iter_matching_dirs()
+        jobs : int, optional
+            Number of threads, i.e. the maximum number of directories being walked at once
+        rate_limiter : RateLimiter, optional
+            Used to throttle filesystem operations across all threads
+        lister : callable, optional
+            Function to list each directory, see summarise_tree()
+        """
+        self.name_pattern = name_pattern
+        self.lister = lister
+        self.jobs = max(1, jobs)
+        self.rate_limiter = rate_limiter
+        self.n_handed_off = 0
+
+    def walk(self, top_dirs):
+        """Walk all `top_dirs`
+
+        Yields
+        ------
+        str, DirSummary
+            See iter_matching_dirs()
+        """
+        tasks = Queue()
+        results = Queue()
+        lock = threading.Lock()
+        state = {"pending": 0, "idle": 0}  # tasks not finished yet, threads waiting for a task
+        done = object()
+
+        for top_dir in top_dirs:
+            state["pending"] += 1
+            tasks.put(top_dir)
+        if not state["pending"]:
+            return
+
+        def hand_off(subdir):
+            with lock:
+                if state["idle"] == 0 or tasks.qsize() >= state["idle"]:
+                    return False
+                state["pending"] += 1
+                self.n_handed_off += 1
+            tasks.put(subdir)
+            return True
+
+        def worker():
+            while True:
+                with lock:
+                    state["idle"] += 1
+                task = tasks.get()
+                with lock:
+                    state["idle"] -= 1
+                if task is done:
+                    break
+                try:
+                    for result in iter_matching_dirs(task, self.name_pattern, self.rate_limiter, hand_off,
+                                                     self.lister):
+                        results.put(result)
+                except Exception as e:
+                    results.put(e)
+                with lock:
+                    state["pending"] -= 1
+                    finished = state["pending"] == 0
+                if finished:
+                    for _ in range(self.jobs):
+                        tasks.put(done)
+            results.put(done)
+
+        threads = [threading.Thread(target=worker) for _ in range(self.jobs)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        n_running = len(threads)
+        while n_running:
+            result = results.get()
+            if result is done:
+                n_running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+        for t in threads:
+            t.join()
@@ -6,28 +6,80 @@ This script takes a file with list of directories, and produces a file with
 each directory name and its size in kBytes.
 
 If the directory does not exist, it has size 0
+
+Sizes are the total (apparent) size of files under each directory.
+The output has the same order as the input.
 """
 
 
-from __future__ import print_function
+from __future__ import print_function, division
 import os
 import argparse
-import subprocess
-
-if not hasattr(subprocess, 'check_output'):
-    raise ImportError("subprocess module missing check_output(): you need python 2.7 or newer")
-
-
-def get_dir_size(dirname):
-    """Get size of directory using du, returned in kB"""
-    cmd = 'du -s %s' % dirname
-    size = int(subprocess.check_output(cmd, shell=True).split()[0])
-    return size
+from multiprocessing.pool import ThreadPool
+
+from fs_utils import (RateLimiter, group_nested_dirs, summarise_nested_dirs, list_dir_summary,
+                      DEFAULT_IO_BUDGET, DEFAULT_STAT_JOBS)
+from dir_size_cache import DirSizeCache
+
+
+def get_dir_sizes(dirnames, jobs=DEFAULT_STAT_JOBS, io_budget=DEFAULT_IO_BUDGET, cache=None):
+    """Get sizes of directories in kB, without running du.
+
+    Repeated directories are only done once, and directories inside other
+    directories in the list are only scanned once for both.
+
+    Parameters
+    ----------
+    dirnames : iterable[str]
+    jobs : int, optional
+        Number of threads
+    io_budget : float, optional
+        Maximum number of filesystem operations per second, in total. 0 means no limit.
+    cache : DirSizeCache, optional
+        Cache of directory listings
+
+    Returns
+    -------
+    dict{str: int}, int
+        Size for each normalised directory name (0 if it doesn't exist),
+        and total size without counting nested directories twice
+    """
+    groups = group_nested_dirs(os.path.normpath(d) for d in dirnames)
+    rate_limiter = RateLimiter(io_budget)
+    lister = cache.list_dir_summary if cache else list_dir_summary
+
+    def do_group(group):
+        return summarise_nested_dirs(group, rate_limiter, lister)
+
+    sizes = {}
+    total_size = 0
+    pool = ThreadPool(max(1, jobs))
+    try:
+        for group, summaries in zip(groups, pool.imap(do_group, groups)):
+            for d, summary in summaries.items():
+                sizes[d] = int(round(summary.size / 1024))
+            # outermost dir includes all the others
+            total_size += sizes[group[0]]
+    finally:
+        pool.close()
+        pool.join()
+    return sizes, total_size
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('input', help='File with list of directories, one per line')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=DEFAULT_STAT_JOBS,
+                        help='Number of threads')
+    parser.add_argument('--ioBudget',
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help='Maximum number of filesystem operations per second, in total. 0 for no limit.')
+    parser.add_argument('--cache',
+                        help='SQLite file to cache directory listings in, '
+                             'so unchanged directories are not re-scanned on the next run.')
     args = parser.parse_args()
 
     if not os.path.isfile(args.input):
@@ -37,14 +89,19 @@ if __name__ == "__main__":
     output_filename = stem + "_sizes" + ext
     print("Writing to", output_filename)
 
-    total_size = 0
-    with open(args.input) as inf, open(output_filename, 'w') as outf:
-        for line in inf:
-            size = 0
-            if os.path.isdir(line.strip()):
-                size = get_dir_size(line.strip())
-                total_size += size
-            outf.write(line.strip() + ",%d\n" % size)
+    with open(args.input) as inf:
+        dirnames = [line.strip() for line in inf]
+
+    cache = DirSizeCache(args.cache) if args.cache else None
+    sizes, total_size = get_dir_sizes([d for d in dirnames if d], args.jobs, args.ioBudget, cache)
+    if cache:
+        cache.close()
+        cache.print_stats()
+
+    with open(output_filename, 'w') as outf:
+        for dirname in dirnames:
+            size = sizes.get(os.path.normpath(dirname), 0) if dirname else 0
+            outf.write(dirname + ",%d\n" % size)
 
     total_size_natural = total_size
     natural_unit = "kB"
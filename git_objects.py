@@ -0,0 +1,189 @@
+"""Read XML files directly from git objects, without checking out branches.
+
+Branches are listed with `git ls-tree`, and file contents are streamed through
+one long-lived `git cat-file --batch` process. Since blobs are identified by
+their SHA, an XML that is identical in several branches is only parsed once.
+
+Works on normal clones and bare mirrors (e.g. `git clone --mirror`).
+
+Usage:
+
+    from git_objects import list_xml_blobs_for_refs, GitXMLRecords
+
+    blobs_per_ref = list_xml_blobs_for_refs("UHH2.git", ["RunII_94X_v3", "RunII_80X_v3"])
+    with GitXMLRecords("UHH2.git") as xml_records:
+        for ref, blobs in zip(refs, blobs_per_ref):
+            for xml_path, sha in blobs:
+                ntuples = xml_records.get_ntuple_filenames(sha)
+"""
+
+
+from __future__ import print_function
+
+import io
+import os
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from ntuple_xml import iter_ntuple_records
+
+
+def init_mirror(repo_url, mirror_dir):
+    """Create a bare mirror of `repo_url` in `mirror_dir`, or update it if it already exists"""
+    if os.path.isdir(mirror_dir):
+        print("Updating mirror", mirror_dir)
+        subprocess.check_call(["git", "remote", "update", "--prune"], cwd=mirror_dir)
+    else:
+        print("Creating mirror of", repo_url, "in", mirror_dir)
+        subprocess.check_call(["git", "clone", "--mirror", repo_url, mirror_dir])
+
+
+def get_branches(repo_dir):
+    """Get names of all local branches (for a mirror, this is all branches)
+
+    Returns
+    -------
+    list[str]
+    """
+    out = subprocess.check_output(["git", "for-each-ref", "--format=%(refname:short)", "refs/heads"],
+                                  cwd=repo_dir)
+    return out.decode().split()
+
+
+def list_xml_blobs(repo_dir, ref, path="common/datasets"):
+    """List all XML files under `path` in `ref`, without checking it out
+
+    Parameters
+    ----------
+    repo_dir : str
+        Git repo (bare or not)
+    ref : str
+        Branch, tag, or commit
+    path : str, optional
+        Only look under this path in the repo
+
+    Returns
+    -------
+    list[(str, str)]
+        (path in repo, blob SHA) for each XML file, sorted by path
+    """
+    out = subprocess.check_output(["git", "ls-tree", "-r", "-z", ref, "--", path], cwd=repo_dir)
+    blobs = []
+    for entry in out.split(b"\0"):
+        if not entry:
+            continue
+        meta, filepath = entry.split(b"\t", 1)
+        mode, obj_type, sha = meta.split()
+        if obj_type == b"blob" and filepath.endswith(b".xml"):
+            blobs.append((filepath.decode(), sha.decode()))
+    return sorted(blobs)
+
+
+def list_xml_blobs_for_refs(repo_dir, refs, path="common/datasets", jobs=4):
+    """Run list_xml_blobs() concurrently for several refs
+
+    Returns
+    -------
+    list[list[(str, str)]]
+        Blobs for each ref, in the same order as `refs`
+    """
+    pool = ThreadPool(max(1, min(jobs, len(refs))))
+    try:
+        return pool.map(lambda ref: list_xml_blobs(repo_dir, ref, path), refs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class GitBlobReader(object):
+    """Read blob contents through a single `git cat-file --batch` process. Thread-safe."""
+
+    def __init__(self, repo_dir):
+        self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=repo_dir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, sha):
+        """Get contents of blob with SHA `sha`
+
+        Returns
+        -------
+        bytes
+
+        Raises
+        ------
+        KeyError
+            If there is no object with that SHA
+        """
+        with self._lock:
+            self.process.stdin.write(sha.encode() + b"\n")
+            self.process.stdin.flush()
+            # header is "<sha> <type> <size>", or "<sha> missing"
+            header = self.process.stdout.readline().split()
+            if len(header) != 3:
+                raise KeyError("No git object %s" % sha)
+            size = int(header[2])
+            contents = self.process.stdout.read(size)
+            self.process.stdout.read(1)  # trailing newline
+        return contents
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+
+class GitXMLRecords(object):
+    """Parse XML blobs into NtupleRecords, parsing each unique blob only once"""
+
+    def __init__(self, repo_dir):
+        self.reader = GitBlobReader(repo_dir)
+        self._records = {}
+        self.parsed = 0
+        self.reused = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_records(self, sha):
+        """Get all NtupleRecords for XML blob with SHA `sha`
+
+        Returns
+        -------
+        list[NtupleRecord]
+        """
+        if sha in self._records:
+            self.reused += 1
+            return self._records[sha]
+        self.parsed += 1
+        records = list(iter_ntuple_records(io.BytesIO(self.reader.read(sha))))
+        self._records[sha] = records
+        return records
+
+    def get_ntuple_filenames(self, sha):
+        """Get filenames of ntuples that are not commented out in XML blob with SHA `sha`
+
+        Returns
+        -------
+        list[str]
+        """
+        return [r.filename for r in self.get_records(sha) if not r.commented and r.filename]
+
+    def close(self):
+        self.reader.close()
+
+    def print_stats(self):
+        print("Parsed", self.parsed, "unique XML blobs, reused", self.reused, "shared between branches")
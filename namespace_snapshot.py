@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+
+"""Snapshot of (part of) the filesystem namespace, e.g. the Tier2 store, in a SQLite file.
+
+Records path, size, mtime, ctime & inode of every file & directory under
+one or more top directories, so that tools can look them up instead of doing
+their own stat calls on dCache.
+
+Refreshing is incremental: every directory is stat-ed, but only directories
+whose mtime has changed (i.e. an entry was added, removed or renamed in them)
+are listed again, and only their entries are re-stat-ed.
+Files that are modified in place aren't noticed, which is fine for ntuples
+since they are written once.
+
+Usage, to create/refresh:
+
+    ./namespace_snapshot.py tier2_snapshot.sqlite /pnfs/desy.de/cms/tier2/store/user /pnfs/desy.de/cms/tier2/store/group
+
+and then in the tools:
+
+    from namespace_snapshot import NamespaceSnapshot
+
+    with NamespaceSnapshot("tier2_snapshot.sqlite") as snapshot:
+        if snapshot.isfile("/pnfs/.../Ntuple_1.root"):
+            ...
+
+`datasetInfo.py`, `findAllNtupleDirs.py`, `create_sql_db_xml.py` and
+`create_sql_db_user_dirs.py` take a `--snapshot` option to use it.
+Paths outside the snapshot's top directories fall back to normal stat calls.
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from stat import S_ISDIR, S_ISREG
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from fs_utils import (scandir, RateLimiter, DirSummary, list_dir_summary, summarise_tree,
+                      DEFAULT_IO_BUDGET, DEFAULT_STAT_JOBS)
+
+
+# Don't trust the mtime of directories modified more recently than this many seconds ago,
+# since another change in the same mtime tick wouldn't be noticed
+MIN_AGE = 2
+
+
+class SnapshotStat(namedtuple("SnapshotStat", ["st_mode", "st_ino", "st_size", "st_mtime", "st_ctime"])):
+    """Stat info from a snapshot, with the same attribute names as os.stat_result"""
+    __slots__ = ()
+
+
+# What to do with each directory when refreshing
+_CHECK = 0  # stat it, and list it if it has changed
+_LIST = 1  # list it, known to have changed
+_REUSE = 2  # known to be unchanged, so just look at its subdirectories
+
+
+def _lstat_or_none(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _scan_dir(path, rate_limiter=None):
+    """Get (path, lstat result) for everything in a directory, or None if it can't be listed"""
+    if rate_limiter:
+        rate_limiter.acquire()
+    try:
+        if scandir is not None:
+            entries = [(entry.path, entry) for entry in scandir(path)]
+            stat = lambda entry: entry.stat(follow_symlinks=False)
+        else:
+            entries = [(os.path.join(path, name), os.path.join(path, name)) for name in os.listdir(path)]
+            stat = os.lstat
+    except OSError:
+        return None
+    if rate_limiter and entries:
+        rate_limiter.acquire(len(entries))
+    results = []
+    for child_path, entry in entries:
+        try:
+            results.append((child_path, stat(entry)))
+        except OSError:
+            # e.g. deleted in the meantime
+            continue
+    return results
+
+
+class NamespaceSnapshot(object):
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite file for the snapshot. Created if it doesn't exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Stats for the last refresh
+        self.dirs_unchanged = 0
+        self.dirs_listed = 0
+        # Stats for queries
+        self.lookups = 0
+        self.fallbacks = 0  # paths not in the snapshot, which had to be stat-ed
+        # can be used from several threads, so protected by self._lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY,
+                parent TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                mode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime FLOAT NOT NULL,
+                ctime FLOAT NOT NULL,
+                inode INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent, is_dir);
+            CREATE TABLE IF NOT EXISTS roots (
+                path TEXT PRIMARY KEY,
+                refresh_time FLOAT NOT NULL
+            );
+            """)
+        self.connection.commit()
+        self.roots = [r[0] for r in self.connection.execute("SELECT path FROM roots")]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    # ------------------------------------------------------------------------
+    # Refreshing
+    # ------------------------------------------------------------------------
+
+    @staticmethod
+    def _make_row(path, stat):
+        return (path, os.path.dirname(path), int(S_ISDIR(stat.st_mode)), stat.st_mode,
+                stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino)
+
+    def _upsert(self, rows):
+        self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _delete_subtree(self, path, include_self=True):
+        # Range query rather than LIKE, since paths often contain _
+        self.connection.execute("DELETE FROM entries WHERE path >= ? AND path < ?", (path + "/", path + "0"))
+        if include_self:
+            self.connection.execute("DELETE FROM entries WHERE path = ?", (path,))
+
+    def _get_row(self, path):
+        return self.connection.execute("SELECT is_dir, mtime FROM entries WHERE path = ?", (path,)).fetchone()
+
+    def _child_dirs(self, path):
+        return [r[0] for r in self.connection.execute("SELECT path FROM entries WHERE parent = ? AND is_dir = 1",
+                                                      (path,))]
+
+    @staticmethod
+    def _is_unchanged(row, stat, now):
+        return (row is not None and row[0] == 1 and row[1] == stat.st_mtime
+                and now - stat.st_mtime > MIN_AGE)
+
+    def refresh(self, top_dir, jobs=DEFAULT_STAT_JOBS, rate_limiter=None):
+        """Update the snapshot for everything under `top_dir`
+
+        Directories are done a level at a time, with the stat & listing
+        calls for each level done concurrently.
+
+        Parameters
+        ----------
+        top_dir : str
+        jobs : int, optional
+            Number of threads
+        rate_limiter : RateLimiter, optional
+            Used to throttle filesystem operations
+        """
+        top_dir = os.path.normpath(os.path.abspath(top_dir))
+        self.dirs_unchanged = 0
+        self.dirs_listed = 0
+        pool = ThreadPool(max(1, jobs))
+        try:
+            level = [(top_dir, _CHECK)]
+            while level:
+                now = time.time()
+                next_level = []
+                to_list = [path for path, action in level if action == _LIST]
+                for path, action in level:
+                    if action == _REUSE:
+                        self.dirs_unchanged += 1
+                        next_level.extend((d, _CHECK) for d in self._child_dirs(path))
+
+                to_check = [path for path, action in level if action == _CHECK]
+                if rate_limiter:
+                    rate_limiter.acquire(len(to_check))
+                for path, stat in zip(to_check, pool.map(_lstat_or_none, to_check)):
+                    row = self._get_row(path)
+                    if stat is None or not S_ISDIR(stat.st_mode):
+                        self._delete_subtree(path)
+                        if stat is not None:
+                            self._upsert([self._make_row(path, stat)])
+                        continue
+                    self._upsert([self._make_row(path, stat)])
+                    if self._is_unchanged(row, stat, now):
+                        self.dirs_unchanged += 1
+                        next_level.extend((d, _CHECK) for d in self._child_dirs(path))
+                    else:
+                        to_list.append(path)
+
+                listings = pool.map(lambda p: _scan_dir(p, rate_limiter), to_list)
+                for path, children in zip(to_list, listings):
+                    self.dirs_listed += 1
+                    if children is None:
+                        # can't list it (anymore), so forget what was in it
+                        self._delete_subtree(path, include_self=False)
+                        continue
+                    old_rows = {r[0]: r[1:] for r in self.connection.execute(
+                        "SELECT path, is_dir, mtime FROM entries WHERE parent = ?", (path,))}
+                    new_paths = set()
+                    for child_path, stat in children:
+                        new_paths.add(child_path)
+                        if S_ISDIR(stat.st_mode):
+                            unchanged = self._is_unchanged(old_rows.get(child_path), stat, now)
+                            next_level.append((child_path, _REUSE if unchanged else _LIST))
+                        elif old_rows.get(child_path, (0,))[0] == 1:
+                            # was a directory, now isn't
+                            self._delete_subtree(child_path, include_self=False)
+                    for removed in set(old_rows) - new_paths:
+                        self._delete_subtree(removed)
+                    self._upsert([self._make_row(p, s) for p, s in children])
+                self.connection.commit()
+                level = next_level
+        finally:
+            pool.close()
+            pool.join()
+
+        self.connection.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (top_dir, time.time()))
+        self.connection.commit()
+        if top_dir not in self.roots:
+            self.roots.append(top_dir)
+
+    def print_refresh_stats(self):
+        total = self.dirs_unchanged + self.dirs_listed
+        print("Snapshot %s: %d directories unchanged, %d re-listed (%.1f%% unchanged)"
+              % (self.path, self.dirs_unchanged, self.dirs_listed,
+                 100. * self.dirs_unchanged / total if total else 0))
+
+    # ------------------------------------------------------------------------
+    # Queries. All thread-safe.
+    # ------------------------------------------------------------------------
+
+    def covers(self, path):
+        """Whether `path` is under one of the top directories of the snapshot"""
+        path = os.path.normpath(path)
+        return any(path == r or path.startswith(r.rstrip("/") + "/") for r in self.roots)
+
+    def stat_or_none(self, path):
+        """Like os.stat() (without following symlinks), but from the snapshot.
+
+        Paths outside the snapshot are stat-ed directly.
+
+        Returns
+        -------
+        SnapshotStat or os.stat_result
+            None if `path` does not exist
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        if not self.covers(path):
+            with self._lock:
+                self.fallbacks += 1
+            return _lstat_or_none(path)
+        with self._lock:
+            self.lookups += 1
+            row = self.connection.execute("SELECT mode, inode, size, mtime, ctime FROM entries WHERE path = ?",
+                                          (path,)).fetchone()
+        return SnapshotStat(*row) if row else None
+
+    def exists(self, path):
+        return self.stat_or_none(path) is not None
+
+    def isfile(self, path):
+        stat = self.stat_or_none(path)
+        return stat is not None and S_ISREG(stat.st_mode)
+
+    def isdir(self, path):
+        stat = self.stat_or_none(path)
+        return stat is not None and S_ISDIR(stat.st_mode)
+
+    def list_dir_summary(self, path, rate_limiter=None):
+        """Like fs_utils.list_dir_summary(), but from the snapshot, so it can be used
+        as the `lister` for fs_utils.summarise_tree(), DirSizer, etc.
+
+        Paths outside the snapshot are listed directly.
+
+        Returns
+        -------
+        list[str], DirSummary
+            Subdirectory paths, summary of files directly in `path`
+
+        Raises
+        ------
+        OSError
+            If `path` isn't a directory
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        if not self.covers(path):
+            with self._lock:
+                self.fallbacks += 1
+            return list_dir_summary(path, rate_limiter)
+        with self._lock:
+            self.lookups += 1
+            row = self._get_row(path)
+            if row is None or row[0] != 1:
+                raise OSError("Not a directory in snapshot: %s" % path)
+            subdirs = self._child_dirs(path)
+            size, nfiles, newest_mtime = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*), MAX(mtime) FROM entries WHERE parent = ? AND is_dir = 0",
+                (path,)).fetchone()
+        return subdirs, DirSummary(size, nfiles, newest_mtime)
+
+    def summarise(self, path):
+        """Get DirSummary for everything under directory `path`, in one query
+
+        Returns
+        -------
+        DirSummary
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        if not self.covers(path):
+            with self._lock:
+                self.fallbacks += 1
+            return summarise_tree(path)
+        with self._lock:
+            self.lookups += 1
+            size, nfiles, newest_mtime = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*), MAX(mtime) FROM entries "
+                "WHERE path >= ? AND path < ? AND is_dir = 0",
+                (path + "/", path + "0")).fetchone()
+        return DirSummary(size, nfiles, newest_mtime)
+
+    def print_stats(self):
+        print("Snapshot %s: %d lookups, %d paths outside snapshot stat-ed directly"
+              % (self.path, self.lookups, self.fallbacks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("snapshot", help="SQLite snapshot file")
+    parser.add_argument("topDir", nargs="*",
+                        help="Directories to create/refresh the snapshot for. "
+                        "If none are given, all directories already in the snapshot are refreshed.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=DEFAULT_STAT_JOBS,
+                        help="Number of threads")
+    parser.add_argument("--ioBudget",
+                        type=float,
+                        default=DEFAULT_IO_BUDGET,
+                        help="Maximum number of filesystem operations per second, in total. 0 for no limit.")
+    args = parser.parse_args()
+
+    with NamespaceSnapshot(args.snapshot) as snapshot:
+        rate_limiter = RateLimiter(args.ioBudget)
+        for top_dir in (args.topDir or list(snapshot.roots)):
+            print("Refreshing", top_dir)
+            start = time.time()
+            snapshot.refresh(top_dir, jobs=args.jobs, rate_limiter=rate_limiter)
+            snapshot.print_refresh_stats()
+            print("Took %.1f s" % (time.time() - start))
@@ -0,0 +1,258 @@
+"""Streaming reader for UHH2 ntuple XML files.
+
+UHH2 "XML" files are not well-formed documents: they are a flat list of
+<In FileName="..." Lumi="0.0"/> elements with no root node, interspersed with
+comments, e.g.:
+
+    <In FileName="/pnfs/.../Ntuple_1.root" Lumi="0.0"/>
+    <!--EMPTY <In FileName="/pnfs/.../Ntuple_2.root" Lumi="0.0"/> -->
+    <!--
+    <In FileName="/pnfs/.../Ntuple_3.root" Lumi="0.0"/>
+    -->
+    <!-- < NumberEntries="12345" Method=weights /> -->
+
+This module tokenizes them incrementally in fixed-size chunks, so memory use
+does not depend on the size of the file, and keeps track of the byte offset
+of every token so that callers can rewrite files in place.
+
+Usage:
+
+    from ntuple_xml import get_ntuple_filenames, iter_ntuple_records
+
+    for fname in get_ntuple_filenames("MC_TTbar.xml"):
+        ...
+
+    for record in iter_ntuple_records("MC_TTbar.xml"):
+        if record.commented and record.comment_tag == "EMPTY":
+            ...
+"""
+
+
+from __future__ import print_function
+
+import io
+import re
+from collections import namedtuple
+
+
+# Read size for each chunk of the file
+CHUNK_SIZE = 1 << 16
+
+COMMENT = "comment"
+ELEMENT = "element"
+
+
+class XMLToken(namedtuple("XMLToken", ["kind", "text", "offset", "end"])):
+    """A single comment or element from an XML file
+
+    kind : str
+        COMMENT or ELEMENT
+    text : bytes
+        Raw text of the token, including the <...> delimiters
+    offset, end : int
+        Byte offsets of the start and (exclusive) end of the token in the file
+    """
+    __slots__ = ()
+
+
+class NtupleRecord(namedtuple("NtupleRecord", ["filename", "lumi", "commented", "comment_tag", "offset", "end"])):
+    """An <In FileName=... /> entry in an XML file
+
+    filename : str
+        Value of the FileName attribute
+    lumi : float
+        Value of the Lumi attribute, or None if it is missing
+    commented : bool
+        True if the entry is inside a comment
+    comment_tag : str
+        Tag at the start of the enclosing comment, e.g. EMPTY or BAD,
+        or None if there is no tag (or the entry is not commented out)
+    offset, end : int
+        Byte offsets of the start and (exclusive) end of the <In .../> element
+    """
+    __slots__ = ()
+
+
+# An unterminated comment matches just "<!--", so we know to read more of the file
+_TOKEN_PATTERN = re.compile(br'<!--.*?-->|<!--|<[^>]*>', re.DOTALL)
+_IN_PATTERN = re.compile(br'<\s*In\s[^>]*>')
+# Most entries are written exactly like this, so avoid the general attribute parsing
+_IN_FAST_PATTERN = re.compile(br'<\s*In\s+FileName="([^"]*)"\s+Lumi="([^"]*)"\s*/?>$')
+_ATTR_PATTERN = re.compile(br'(\w+)\s*=\s*"([^"]*)"')
+_COMMENT_TAG_PATTERN = re.compile(br'<!--\s*([A-Z][A-Z_]+)\b')
+
+
+def _to_str(b):
+    """Convert bytes to native str (no-op in python 2)"""
+    if isinstance(b, str):
+        return b
+    return b.decode("utf-8")
+
+
+def _open_binary(source):
+    """Return (file object, whether we should close it) for a filename or binary file object"""
+    if hasattr(source, "read"):
+        return source, False
+    return io.open(source, "rb"), True
+
+
+def _iter_raw_tokens(source, chunk_size):
+    """Yield (text, offset) for each comment/element, see iter_xml_tokens()"""
+    f, should_close = _open_binary(source)
+    try:
+        buf = b""
+        base = 0  # file offset of buf[0]
+        while True:
+            chunk = f.read(chunk_size)
+            buf += chunk
+            pos = 0
+            for match in _TOKEN_PATTERN.finditer(buf):
+                text = match.group(0)
+                if text == b"<!--":
+                    # comment continues into the next chunk
+                    break
+                pos = match.end()
+                yield text, base + match.start()
+
+            # Keep any partial token for the next chunk, drop everything else
+            partial = buf.find(b"<", pos)
+            if partial == -1:
+                partial = len(buf)
+            if not chunk:
+                if partial < len(buf):
+                    raise ValueError("Unterminated token at byte %d in %s"
+                                     % (base + partial, getattr(f, "name", "XML")))
+                break
+            buf = buf[partial:]
+            base += partial
+    finally:
+        if should_close:
+            f.close()
+
+
+def iter_xml_tokens(source, chunk_size=CHUNK_SIZE):
+    """Yield comments & elements from an XML file, one at a time.
+
+    Text between tokens (i.e. whitespace) is skipped.
+    Comments can span multiple lines (& chunks).
+
+    Parameters
+    ----------
+    source : str or file
+        XML filename, or file-like object opened in binary mode
+    chunk_size : int, optional
+        Number of bytes to read at a time
+
+    Yields
+    ------
+    XMLToken
+
+    Raises
+    ------
+    ValueError
+        If the file ends in the middle of a comment or element
+    """
+    for text, offset in _iter_raw_tokens(source, chunk_size):
+        kind = COMMENT if text.startswith(b"<!--") else ELEMENT
+        yield XMLToken(kind, text, offset, offset + len(text))
+
+
+def _parse_in_element(text):
+    """Get (FileName, Lumi) from <In .../> element text, as bytes.
+
+    Returns None if `text` is not an <In .../> element.
+    """
+    fast_match = _IN_FAST_PATTERN.match(text)
+    if fast_match is not None:
+        return fast_match.groups()
+    if not _IN_PATTERN.match(text):
+        return None
+    attrs = dict(_ATTR_PATTERN.findall(text))
+    return attrs.get(b"FileName", b""), attrs.get(b"Lumi")
+
+
+def _make_record(text, offset, commented, comment_tag):
+    """Make NtupleRecord from element text, or None if it isn't an <In .../> element"""
+    parsed = _parse_in_element(text)
+    if parsed is None:
+        return None
+    filename, lumi = parsed
+    return NtupleRecord(filename=_to_str(filename),
+                        lumi=float(lumi) if lumi is not None else None,
+                        commented=commented,
+                        comment_tag=comment_tag,
+                        offset=offset,
+                        end=offset + len(text))
+
+
+def iter_ntuple_records(source, include_commented=True, chunk_size=CHUNK_SIZE):
+    """Yield a record for each <In FileName=... /> entry in an XML file.
+
+    Parameters
+    ----------
+    source : str or file
+        XML filename, or file-like object opened in binary mode
+    include_commented : bool, optional
+        If True, also yield entries that are commented out
+    chunk_size : int, optional
+        Number of bytes to read at a time
+
+    Yields
+    ------
+    NtupleRecord
+    """
+    for text, offset in _iter_raw_tokens(source, chunk_size):
+        if not text.startswith(b"<!--"):
+            record = _make_record(text, offset, commented=False, comment_tag=None)
+            if record is not None:
+                yield record
+        elif include_commented:
+            tag_match = _COMMENT_TAG_PATTERN.match(text)
+            comment_tag = _to_str(tag_match.group(1)) if tag_match else None
+            for match in _IN_PATTERN.finditer(text):
+                yield _make_record(match.group(0), offset + match.start(),
+                                   commented=True, comment_tag=comment_tag)
+
+
+def get_token_records(token):
+    """Get records for all <In FileName=... /> entries in a single token from iter_xml_tokens()
+
+    Parameters
+    ----------
+    token : XMLToken
+
+    Returns
+    -------
+    list[NtupleRecord]
+        Empty if the token is neither an <In .../> element nor a comment containing them
+    """
+    if token.kind == ELEMENT:
+        record = _make_record(token.text, token.offset, commented=False, comment_tag=None)
+        return [record] if record is not None else []
+    tag_match = _COMMENT_TAG_PATTERN.match(token.text)
+    comment_tag = _to_str(tag_match.group(1)) if tag_match else None
+    return [_make_record(match.group(0), token.offset + match.start(),
+                         commented=True, comment_tag=comment_tag)
+            for match in _IN_PATTERN.finditer(token.text)]
+
+
+def get_ntuple_filenames(source):
+    """Yield filenames of all ntuples that are not commented out in an XML file
+
+    Parameters
+    ----------
+    source : str or file
+        XML filename, or file-like object opened in binary mode
+
+    Yields
+    ------
+    str
+        Ntuple filename
+    """
+    # Skip building full records, since this is the most common use
+    for text, _ in _iter_raw_tokens(source, CHUNK_SIZE):
+        if text.startswith(b"<!--"):
+            continue
+        parsed = _parse_in_element(text)
+        if parsed is not None and parsed[0]:
+            yield _to_str(parsed[0])
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+
+"""Export the SQLite catalogue from create_sql_db_xml.py / create_sql_db_user_dirs.py to Parquet files,
+and load Parquet files made by this or datasetInfo.py --parquet.
+
+Parquet files are much quicker to load than CSV, and only the columns
+needed are read. Repeated strings like user & year are stored once
+per row group (dictionary-encoded), and load as pandas categoricals.
+
+Needs pyarrow (pip install pyarrow).
+
+Usage, to export:
+
+    ./parquet_export.py xml_table.sqlite --outputDir catalogue_parquet
+
+makes catalogue_parquet/xml_ntuple_dir.parquet & catalogue_parquet/user_dir.parquet.
+
+and to load, e.g. in a notebook:
+
+    from parquet_export import load_parquet
+
+    df = load_parquet("catalogue_parquet/xml_ntuple_dir.parquet", columns=["user", "size"]).to_pandas()
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import sqlite3
+import argparse
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from fs_utils import atomic_output
+
+
+# Number of rows per Parquet row group, i.e. how many are held in memory before writing
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+# Columns that have few distinct values, so are dictionary-encoded
+CATEGORICAL_COLUMNS = ["user", "xmldir", "year", "branch", "git_src"]
+
+# Types of non-string columns in the catalogue tables, as pyarrow type names
+CATALOGUE_COLUMN_TYPES = {"id": "int64", "xml_id": "int64", "size": "float64"}
+
+# Catalogue tables/views to export, and the columns to order them by
+CATALOGUE_TABLES = [
+    ("xml_ntuple_dir", "xml_ntuple_dir_info", ["git_src", "xml_filepath", "ntuple_dir"]),
+    ("user_dir", "user_dir", ["dirname"]),
+]
+
+
+def _check_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is needed for Parquet files: pip install pyarrow")
+
+
+class ParquetRowWriter(object):
+    """Write rows (dicts) to a Parquet file, one row group at a time,
+    so that only one row group is held in memory.
+
+    The file only appears once it is closed, so a failed run doesn't leave
+    a partial file behind.
+
+    Usage:
+
+        with ParquetRowWriter("ntuples.parquet", columns=["ntuple", "size", "user"]) as writer:
+            for row in rows:
+                writer.add(row)
+    """
+
+    def __init__(self, filename, columns, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 categorical_columns=CATEGORICAL_COLUMNS, column_types=None):
+        """
+        Parameters
+        ----------
+        filename : str
+            Output Parquet file
+        columns : list[str]
+            Column names, in order. Each row must have all of them.
+        row_group_size : int, optional
+            Number of rows per row group
+        categorical_columns : list[str], optional
+            Columns to dictionary-encode, if they are in `columns`
+        column_types : dict[str, str], optional
+            Type of each non-string column, as a pyarrow type name, e.g. "float64".
+            Columns not in it are strings. The schema is fixed from these,
+            so a row group where a column is all None is still written with the right type.
+        """
+        _check_pyarrow()
+        column_types = column_types or {}
+        self.filename = filename
+        self.columns = list(columns)
+        self.row_group_size = row_group_size
+        self.categorical_columns = [c for c in self.columns if c in categorical_columns]
+        fields = []
+        for c in self.columns:
+            column_type = pa.type_for_alias(column_types.get(c, "string"))
+            if c in self.categorical_columns:
+                column_type = pa.dictionary(pa.int32(), column_type)
+            fields.append(pa.field(c, column_type))
+        self.schema = pa.schema(fields)
+        self.n_rows = 0
+        self.n_row_groups = 0
+        self._values = {c: [] for c in self.columns}
+        self._output = atomic_output(filename, "wb")
+        self._file = self._output.__enter__()
+        self._writer = pq.ParquetWriter(self._file, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, row):
+        for c in self.columns:
+            self._values[c].append(row[c])
+        if len(self._values[self.columns[0]]) >= self.row_group_size:
+            self.flush()
+
+    def add_columns(self, columns):
+        """Write a chunk of rows as a row group
+
+        Parameters
+        ----------
+        columns : dict[str, array-like]
+            Values for each column, e.g. lists, numpy arrays, or pandas Series
+            (categorical Series are written as they are)
+        """
+        self.flush()
+        self._write_row_group(columns)
+
+    def flush(self):
+        """Write rows added so far as a row group"""
+        self._write_row_group(self._values)
+        self._values = {c: [] for c in self.columns}
+
+    def _write_row_group(self, values):
+        n_rows = len(values[self.columns[0]])
+        if n_rows == 0:
+            return
+        arrays = []
+        for field in self.schema:
+            if pa.types.is_dictionary(field.type):
+                array = pa.array(values[field.name], from_pandas=True)
+                if pa.types.is_dictionary(array.type):
+                    # e.g. from a categorical Series
+                    array = array.dictionary_decode()
+                array = array.cast(field.type.value_type).dictionary_encode().cast(field.type)
+            else:
+                array = pa.array(values[field.name], type=field.type, from_pandas=True)
+            arrays.append(array)
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.n_rows += n_rows
+        self.n_row_groups += 1
+
+    def close(self):
+        if self._output is None:
+            return
+        self.flush()
+        self._writer.close()
+        self._output.__exit__(None, None, None)
+        self._output = None
+        print("Wrote %d rows in %d row groups to %s" % (self.n_rows, self.n_row_groups, self.filename))
+
+    def abort(self):
+        """Close without keeping the output file"""
+        if self._output is None:
+            return
+        self._writer.close()
+        error = RuntimeError("Writing %s aborted" % self.filename)
+        self._output.__exit__(type(error), error, None)  # removes the temporary file
+        self._output = None
+
+
+def export_table(connection, query, filename, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 column_types=CATALOGUE_COLUMN_TYPES):
+    """Write results of SQL `query` to a Parquet file, one row group at a time
+
+    `column_types` is as for ParquetRowWriter.
+
+    Returns
+    -------
+    int
+        Number of rows written
+    """
+    cursor = connection.execute(query)
+    columns = [d[0] for d in cursor.description]
+    with ParquetRowWriter(filename, columns, row_group_size=row_group_size, column_types=column_types) as writer:
+        while True:
+            rows = cursor.fetchmany(row_group_size)
+            if not rows:
+                break
+            for row in rows:
+                writer.add(dict(zip(columns, row)))
+    return writer.n_rows
+
+
+def export_catalogue(sqlite_filename, output_dir, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """Export the catalogue tables in `sqlite_filename` to <output_dir>/<table>.parquet
+
+    Tables that aren't in the database are skipped.
+
+    Returns
+    -------
+    list[str]
+        Parquet files written
+    """
+    _check_pyarrow()
+    if not os.path.isfile(sqlite_filename):
+        raise IOError("%s does not exist" % sqlite_filename)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    connection = sqlite3.connect(sqlite_filename)
+    filenames = []
+    try:
+        for name, source, order_columns in CATALOGUE_TABLES:
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (source,)).fetchone()
+            if not exists:
+                print("No", source, "in", sqlite_filename, "- skipping")
+                continue
+            filename = os.path.join(output_dir, name + ".parquet")
+            print("Exporting", source, "to", filename)
+            export_table(connection, "SELECT * FROM %s ORDER BY %s" % (source, ", ".join(order_columns)),
+                         filename, row_group_size)
+            filenames.append(filename)
+    finally:
+        connection.close()
+    return filenames
+
+
+def load_parquet(filename, columns=None, filters=None):
+    """Load Parquet file, memory-mapping it and only reading `columns`
+
+    Parameters
+    ----------
+    filename : str
+    columns : list[str], optional
+        Columns to read, default is all
+    filters : list, optional
+        Row filters, in the pyarrow format, e.g. [("year", "=", "2017")]
+
+    Returns
+    -------
+    pyarrow.Table
+        Use .to_pandas() to get a DataFrame
+    """
+    _check_pyarrow()
+    return pq.read_table(filename, columns=columns, filters=filters, memory_map=True)
+
+
+def get_parquet_columns(filename):
+    """Get column names of Parquet file, without reading any rows"""
+    _check_pyarrow()
+    return pq.read_schema(filename).names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sqlite", help="SQLite catalogue from create_sql_db_xml.py/create_sql_db_user_dirs.py")
+    parser.add_argument("--outputDir",
+                        default="catalogue_parquet",
+                        help="Directory to put Parquet files in")
+    parser.add_argument("--rowGroupSize",
+                        type=int,
+                        default=DEFAULT_ROW_GROUP_SIZE,
+                        help="Number of rows per Parquet row group")
+    args = parser.parse_args()
+    export_catalogue(args.sqlite, args.outputDir, args.rowGroupSize)
@@ -10,6 +10,7 @@ import sys, multiprocessing, time, os
 import subprocess
 import xml.etree.ElementTree as ET
 from CommentedTreeBuilder import CommentedTreeBuilder
+from ntuple_xml import get_ntuple_filenames
 import ROOT
 from ROOT import *
 
@@ -28,16 +29,7 @@ def get_xml_tree(xmlFileDir):
 
 def get_root_filenames_from_xml(xmlFileDir):
     # skips commented out lines, no matter if it has FileName="..."
-    rootFileStore = []
-    root = get_xml_tree(xmlFileDir)
-    for child in root:
-        if child.tag != "In":
-            # this will also skip commented out lines
-            continue
-        filename = child.attrib['FileName']
-        if ".root" in filename:
-            rootFileStore.append(filename)
-    return rootFileStore
+    return [f for f in get_ntuple_filenames(xmlFileDir) if ".root" in f]
 
 
 def read_tree(rootDir):
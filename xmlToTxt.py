@@ -9,32 +9,13 @@ from __future__ import print_function
 
 import os
 import argparse
-import xml.etree.ElementTree as ET
 import sys
-from CommentedTreeBuilder import CommentedTreeBuilder
-
-
-def get_xml_tree(xml_filename):
-    with open(xml_filename) as f:
-        # hack to trick XML parsing - put under a root node
-        xml_str = "<data>%s</data>" % f.read()
-    parser = ET.XMLParser(target=CommentedTreeBuilder())
-    root = ET.fromstring(xml_str, parser)
-    return root
+from ntuple_xml import get_ntuple_filenames
 
 
 def get_root_filenames_from_xml(xml_filename):
     # skips commented out lines, no matter if it has FileName="..."
-    rootFileStore = []
-    root = get_xml_tree(xml_filename)
-    for child in root:
-        if child.tag != "In":
-            # this will also skip commented out lines
-            continue
-        filename = child.attrib['FileName']
-        if ".root" in filename:
-            rootFileStore.append(filename)
-    return rootFileStore
+    return [f for f in get_ntuple_filenames(xml_filename) if ".root" in f]
 
 
 def dump_root_filenames_from_xml_to_txt(xml_filename, txt_filename):
@@ -0,0 +1,191 @@
+"""Persistent on-disk cache of parsed ntuple XML files.
+
+Stores the list of NtupleRecords for each XML file in a SQLite file, keyed by
+the absolute path of the XML. An entry is reused if the file's (mtime, size)
+is unchanged, or failing that, if the SHA1 of its contents is unchanged
+(e.g. after a git checkout that touched the file without changing it).
+Otherwise the XML is re-parsed.
+
+The cache has a maximum size: when closed, the least-recently-used entries
+are evicted until it fits.
+
+Usage:
+
+    from xml_cache import XMLCache
+
+    with XMLCache("xml_cache.sqlite") as cache:
+        for fname in cache.get_ntuple_filenames("MC_TTbar.xml"):
+            ...
+    cache.print_stats()
+"""
+
+
+from __future__ import print_function, division
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+
+from ntuple_xml import NtupleRecord, iter_ntuple_records, get_ntuple_filenames
+
+
+# Maximum total size of stored (compressed) records, in MB
+DEFAULT_MAX_SIZE = 500
+
+
+def get_file_hash(filename, chunk_size=1 << 16):
+    """Get SHA1 hex digest of file contents"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class XMLCache(object):
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite file to store cache in. Created if it doesn't exist.
+        max_size : float, optional
+            Maximum size of stored records in MB
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.hash_hits = 0  # subset of hits where the file had been touched but was unchanged
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS xml_cache (
+                path TEXT PRIMARY KEY,
+                mtime FLOAT NOT NULL,
+                size INTEGER NOT NULL,
+                sha1 TEXT NOT NULL,
+                records BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used FLOAT NOT NULL
+            );
+            """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS xml_cache_last_used ON xml_cache (last_used);")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _encode(records):
+        return sqlite3.Binary(zlib.compress(json.dumps(records).encode()))
+
+    @staticmethod
+    def _decode(blob):
+        return [NtupleRecord(*r) for r in json.loads(zlib.decompress(blob).decode())]
+
+    def get_records(self, xml_filename):
+        """Get all NtupleRecords for an XML file, from the cache if possible.
+
+        Parameters
+        ----------
+        xml_filename : str
+
+        Returns
+        -------
+        list[NtupleRecord]
+        """
+        path = os.path.abspath(xml_filename)
+        stat = os.stat(path)
+        now = time.time()
+        row = self.connection.execute("SELECT mtime, size, sha1, records FROM xml_cache WHERE path = ?",
+                                      (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            self.hits += 1
+            self.connection.execute("UPDATE xml_cache SET last_used = ? WHERE path = ?", (now, path))
+            return self._decode(row[3])
+
+        sha1 = get_file_hash(path)
+        if row is not None and row[2] == sha1:
+            self.hits += 1
+            self.hash_hits += 1
+            self.connection.execute("UPDATE xml_cache SET mtime = ?, size = ?, last_used = ? WHERE path = ?",
+                                    (stat.st_mtime, stat.st_size, now, path))
+            return self._decode(row[3])
+
+        self.misses += 1
+        records = list(iter_ntuple_records(path))
+        blob = self._encode(records)
+        self.connection.execute("INSERT OR REPLACE INTO xml_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (path, stat.st_mtime, stat.st_size, sha1, blob, len(blob), now))
+        return records
+
+    def get_ntuple_filenames(self, xml_filename):
+        """Get filenames of ntuples that are not commented out, like ntuple_xml.get_ntuple_filenames
+
+        Parameters
+        ----------
+        xml_filename : str
+
+        Returns
+        -------
+        list[str]
+        """
+        return [r.filename for r in self.get_records(xml_filename)
+                if not r.commented and r.filename]
+
+    def evict(self):
+        """Remove least-recently-used entries until total size is below max_size"""
+        max_bytes = self.max_size * 1024 * 1024
+        total = self.connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM xml_cache").fetchone()[0]
+        if total <= max_bytes:
+            return
+        cursor = self.connection.execute("SELECT path, nbytes FROM xml_cache ORDER BY last_used ASC")
+        to_remove = []
+        for path, nbytes in cursor:
+            if total <= max_bytes:
+                break
+            to_remove.append((path,))
+            total -= nbytes
+        self.connection.executemany("DELETE FROM xml_cache WHERE path = ?", to_remove)
+        self.evictions += len(to_remove)
+
+    def close(self):
+        """Evict old entries, save & close the cache"""
+        if self.connection is None:
+            return
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print("XML cache %s: %d hits (%d after checking contents), %d misses, %d evicted, hit rate %.1f%%"
+              % (self.path, self.hits, self.hash_hits, self.misses, self.evictions,
+                 100. * self.hits / total if total else 0))
+
+
+def cached_ntuple_filenames(xml_filename, cache=None):
+    """Get list of ntuple filenames that are not commented out in an XML file,
+    using `cache` if it is not None
+
+    Parameters
+    ----------
+    xml_filename : str
+    cache : XMLCache, optional
+
+    Returns
+    -------
+    list[str]
+    """
+    if cache is None:
+        return list(get_ntuple_filenames(xml_filename))
+    return cache.get_ntuple_filenames(xml_filename)